@@ -0,0 +1,81 @@
+""" Netsplit bursts sent by hircd: time to handle the QUITs one by one,
+in blocking or inline handlers, against a single handler of the netsplit
+batch.
+
+    PYTHONPATH=lib python bench/bench_batch.py [quits]
+"""
+import gevent.monkey
+gevent.monkey.patch_all()
+
+import os
+import sys
+import time
+
+import gevent
+import gevent.event
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lib', 'tests'))
+import hircd
+
+from geventirc import Client, cap, irc, message
+from geventirc.handlers import inline
+
+
+def netsplit(port, count, caps=(), aggregate_batches=(), blocking=True):
+    """ Return the seconds taken to receive and handle a netsplit of
+    `count` users, and the number of handler calls.
+    """
+    done = gevent.event.Event()
+    calls = [0, 0]
+
+    def on_quit(client, msg):
+        calls[0] += 1
+        calls[1] += 1
+        if calls[1] == count:
+            done.set()
+
+    def on_batch(client, msg):
+        calls[0] += 1
+        calls[1] += len(msg.messages)
+        if calls[1] == count:
+            done.set()
+
+    if not blocking:
+        on_quit = inline(on_quit)
+    client = Client('localhost', 'bench', port=port, caps=caps,
+            aggregate_batches=aggregate_batches)
+    client.add_handler(on_quit, 'QUIT')
+    if caps:
+        client.add_handler(on_batch, 'BATCH')
+    client.start()
+    with gevent.Timeout(5):
+        while client.state != irc.CONNECTED:
+            gevent.sleep(0.01)
+    start = time.time()
+    client.send_message(message.Command([str(count)], command='NETSPLIT'))
+    done.wait()
+    elapsed = time.time() - start
+    client.stop()
+    gevent.sleep(0.2)
+    return elapsed, calls[0]
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    server = hircd.IRCServer(('127.0.0.1', 0), hircd.IRCClient)
+    gevent.spawn(server.serve_forever)
+    port = server.server_address[1]
+    print '%d QUITs' % count
+    for name, kwargs in [
+            ('blocking QUIT handler', {}),
+            ('inline QUIT handler', {'blocking': False}),
+            ('netsplit batch handler', {'caps': (cap.BATCH,),
+                    'aggregate_batches': ('netsplit',)})]:
+        elapsed, calls = netsplit(port, count, **kwargs)
+        print '%-24s %7.3f s %9.0f QUITs/s %7d handler calls' % (
+                name, elapsed, count / elapsed, calls)
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
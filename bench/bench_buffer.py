@@ -0,0 +1,61 @@
+""" Memory retained per direct message by PrivMsgBuffer: (nick, message)
+tuples in a list against BufferedMessage records, and the cost of
+appending to a full buffer.
+
+    PYTHONPATH=lib python bench/bench_buffer.py
+"""
+import sys
+import time
+
+from geventirc.handlers import PrivMsgBuffer
+from geventirc.message import LazyMessage
+
+import corpus
+
+
+def deep_size(obj, seen):
+    """ Bytes of `obj` and of the objects it holds, each counted once.
+    """
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    total = sys.getsizeof(obj)
+    if isinstance(obj, (tuple, list)):
+        total += sum(deep_size(item, seen) for item in obj)
+    elif hasattr(type(obj), '__slots__'):
+        for cls in type(obj).__mro__:
+            for name in cls.__dict__.get('__slots__', ()):
+                value = cls.__dict__[name].__get__(obj, cls)
+                total += deep_size(value, seen)
+    return total
+
+
+def direct_lines(count):
+    return [':nick%d!user@host.example.net PRIVMSG bot :%s' % (i % 500, line.split(' :', 1)[-1])
+            for i, line in zip(range(count), corpus.server_lines())]
+
+
+def main():
+    lines = direct_lines(20000)
+    old = []
+    for line in lines:
+        msg = LazyMessage(line)
+        old.append((msg.prefix_parts[0], msg))
+    buffer = PrivMsgBuffer(maxlen=len(lines))
+    for nick, msg in old:
+        buffer.append(nick, ' '.join(msg.params[1:]))
+    seen = set()
+    old_size = deep_size(old, seen) - sys.getsizeof(old)
+    seen = set()
+    new_size = sum(deep_size(record, seen) for record in buffer.buffer)
+    print 'tuple + message: %6.1f bytes/message' % (old_size / float(len(lines)))
+    print 'record:          %6.1f bytes/message' % (new_size / float(len(lines)))
+
+    start = time.time()
+    for nick, msg in old * 5:
+        buffer.append(nick, 'text')
+    print 'append to a full buffer: %.2f us' % ((time.time() - start) / (5 * len(old)) * 1e6)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+""" Cost of handling a bot command line with 10 to 10000 commands
+registered.
+
+    PYTHONPATH=lib python bench/bench_commands.py
+"""
+import random
+import time
+
+from geventirc import Client
+from geventirc.handlers import CommandHandler
+from geventirc.message import LazyMessage
+
+
+def run(count, lines=20000):
+    client = Client('localhost', 'bot', recv_queue_size=0)
+    commands = CommandHandler()
+    noop = lambda client, msg, **args: None
+    names = ['command%d' % i for i in range(count)]
+    for name in names:
+        commands.add(name, noop, args=['*text'], blocking=False)
+    client.add_handler(commands)
+    rnd = random.Random(42)
+    messages = [LazyMessage(':user%d!u@h PRIVMSG #chan :!%s some text' % (i, rnd.choice(names)))
+            for i in range(lines)]
+    start = time.time()
+    for msg in messages:
+        client._process(msg)
+    elapsed = time.time() - start
+    assert client.stats['commands'] == lines
+    return elapsed / lines
+
+
+def main():
+    for count in (10, 100, 1000, 10000):
+        print '%5d commands: %5.2f us/command line' % (count, run(count) * 1e6)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+""" Dispatch cost per message with 1, 10 and 100 registered handlers.
+
+The first table does not run handlers: the client pool is replaced by a
+counter so only the lookup and the loop over matching handlers are
+measured. The second one runs them, spawned in the handler pool or
+inline.
+
+    PYTHONPATH=lib python bench/bench_dispatch.py
+"""
+import time
+
+from geventirc import Client
+from geventirc.message import LazyMessage
+
+import corpus
+
+
+class CountingGroup(object):
+
+    def __init__(self):
+        self.count = 0
+
+    def spawn(self, handler, *args):
+        self.count += 1
+
+
+def handler_factory():
+    def handler(client, msg):
+        pass
+    return handler
+
+
+def legacy_handle(handlers, global_handlers, group, client, msg):
+    handlers = global_handlers | handlers.get(msg.command, set())
+    if handlers is not None:
+        for handler in handlers:
+            group.spawn(handler, client, msg)
+
+
+COMMANDS = ['PRIVMSG', 'JOIN', 'PART', 'KICK', 'NOTICE', '001', '353', '366']
+
+
+def setup(count, **kwargs):
+    client = Client('localhost', 'bot', **kwargs)
+    legacy = {}
+    legacy_global = set()
+    for i in range(count):
+        handler = handler_factory()
+        if i % 10 == 9:
+            client.add_handler(handler)
+            legacy_global.add(handler)
+        else:
+            command = COMMANDS[i % len(COMMANDS)]
+            client.add_handler(handler, command)
+            legacy.setdefault(command, set()).add(handler)
+    return client, legacy, legacy_global
+
+
+def main():
+    messages = [LazyMessage(line) for line in corpus.server_lines(2 * 1024 * 1024)]
+    for msg in messages:
+        msg.command
+    print 'dispatching %d messages' % len(messages)
+    for count in (1, 10, 100):
+        client, legacy, legacy_global = setup(count)
+
+        group = CountingGroup()
+        start = time.time()
+        for msg in messages:
+            legacy_handle(legacy, legacy_global, group, client, msg)
+        legacy_elapsed = time.time() - start
+        legacy_calls = group.count
+
+        client._pool = group = CountingGroup()
+        start = time.time()
+        for msg in messages:
+            client._handle(msg)
+        elapsed = time.time() - start
+        assert group.count == legacy_calls
+
+        print '%3d handlers: legacy %6.2f us/msg  compiled %6.2f us/msg  (%d calls)' % (
+                count, legacy_elapsed / len(messages) * 1e6,
+                elapsed / len(messages) * 1e6, group.count)
+
+    for count in (1, 10, 100):
+        timings = []
+        for inline in (False, True):
+            client, _, _ = setup(count, inline_handlers=inline)
+            start = time.time()
+            for msg in messages:
+                client._handle(msg)
+            client._pool.join()
+            timings.append((time.time() - start) / len(messages) * 1e6)
+        print '%3d handlers: spawned %6.2f us/msg  inline %6.2f us/msg' % (
+                count, timings[0], timings[1])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+""" Throughput of repeated replies with and without the encode cache.
+
+Replays the replies of ReplyWhenQuoted (per channel), MeHandler and
+ReplyToDirectMessage (per nick) through Client.send_message.
+
+    PYTHONPATH=lib python bench/bench_encode_cache.py
+"""
+import random
+import time
+
+from geventirc import Client, message
+
+import corpus
+
+
+def replies(count, seed=42):
+    rnd = random.Random(seed)
+    nicks = corpus.NICKS[:200]
+    result = []
+    for _ in range(count):
+        kind = rnd.random()
+        if kind < 0.5:
+            result.append(message.PrivMsg(rnd.choice(corpus.CHANNELS), "I'm just a bot"))
+        elif kind < 0.75:
+            result.append(message.Me(rnd.choice(nicks), 'is just a bot'))
+        else:
+            result.append(message.PrivMsg(rnd.choice(nicks), "I'm just a bot"))
+    return result
+
+
+def run(msgs, **kwargs):
+    client = Client('localhost', 'bot', **kwargs)
+    start = time.time()
+    for pos, msg in enumerate(msgs):
+        client.send_message(msg)
+        if not pos % 1000:
+            client._send_queue.clear()
+    elapsed = time.time() - start
+    return elapsed, client.encode_cache
+
+
+def encode_only(msgs, cache):
+    encode = cache.encode if cache is not None else lambda msg: msg.encode()
+    start = time.time()
+    for msg in msgs:
+        encode(msg)
+    return len(msgs) / (time.time() - start)
+
+
+def main():
+    msgs = replies(200000)
+    print 'encoding %d replies' % len(msgs)
+    print 'no cache      %8.0f msg/s' % encode_only(msgs, None)
+    print 'cache 1024    %8.0f msg/s' % encode_only(msgs, message.EncodeCache(1024))
+
+    print 'sending %d replies through Client.send_message' % len(msgs)
+    elapsed, _ = run(msgs)
+    print 'no cache      %8.0f msg/s' % (len(msgs) / elapsed)
+    for size in (64, 256, 1024):
+        elapsed, cache = run(msgs, encode_cache_size=size)
+        print 'cache %-6d  %8.0f msg/s  hit rate %.1f%%' % (
+                size, len(msgs) / elapsed, cache.hit_rate * 100)
+
+
+if __name__ == '__main__':
+    main()
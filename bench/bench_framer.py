@@ -0,0 +1,53 @@
+""" Compare the legacy string buffer of Client._recv_loop with LineFramer.
+
+    PYTHONPATH=lib python bench/bench_framer.py
+"""
+import time
+
+from geventirc.framer import LineFramer
+
+import corpus
+
+
+def legacy(chunks):
+    count = 0
+    buf = ''
+    for data in chunks:
+        buf += data
+        pos = buf.find("\r\n")
+        while pos >= 0:
+            line = buf[0:pos]
+            count += 1
+            buf = buf[pos + 2:]
+            pos = buf.find("\r\n")
+    return count
+
+
+def framed(chunks):
+    count = 0
+    framer = LineFramer()
+    for data in chunks:
+        count += len(framer.feed(data))
+    return count
+
+
+def run(name, func, chunks, size):
+    start = time.time()
+    count = func(chunks)
+    elapsed = time.time() - start
+    print '%-8s recv=%-8d %8d lines %8.3fs %8.1f MB/s' % (
+            name, len(chunks[0]), count, elapsed, size / elapsed / 1e6)
+    return count
+
+
+def main():
+    data = corpus.server_stream()
+    print 'replaying %.1f MB of server traffic' % (len(data) / 1e6)
+    for recv_size in (512, 4096, 65536, 1024 * 1024):
+        chunks = corpus.chunks(data, recv_size)
+        expected = run('legacy', legacy, chunks, len(data))
+        assert run('framer', framed, chunks, len(data)) == expected
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+""" Error storm logged to IRC: time spent in the logging call and lines
+queued for the server, by the old handler sending every record and by
+IRCLogHandler.
+
+    PYTHONPATH=lib python bench/bench_log.py [records]
+"""
+import logging
+import sys
+import time
+
+from geventirc import Client, irc
+from geventirc.log import IRCLogHandler
+
+
+class SendEveryRecord(logging.Handler):
+
+    def __init__(self, client, channel):
+        logging.Handler.__init__(self)
+        self.client = client
+        self.channel = channel
+
+    def emit(self, record):
+        self.client.msg(self.channel, self.format(record))
+
+
+def storm(handler, count):
+    logger = logging.getLogger('storm.%s' % type(handler).__name__)
+    logger.propagate = False
+    logger.addHandler(handler)
+    start = time.time()
+    for i in range(count):
+        logger.error('request %d failed', i)
+    return (time.time() - start) / count
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    client = Client('localhost', 'bench')
+    client.state = irc.CONNECTED
+    elapsed = storm(SendEveryRecord(client, '#log'), count)
+    print 'send every record: %5.2f us/record, %6d lines queued' % (
+            elapsed * 1e6, len(client._send_queue.drain()))
+    handler = IRCLogHandler(client, '#log')
+    elapsed = storm(handler, count)
+    handler._flush()
+    print 'IRCLogHandler:     %5.2f us/record, %6d lines queued' % (
+            elapsed * 1e6, len(client._send_queue.drain()))
+    handler.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+""" Bytes per retained message, dict based messages vs __slots__ ones.
+
+The dict based classes replicate the attributes the message classes had
+before they used __slots__. Sizes include the message object, its
+attribute dict if any, and the params and ctcp params containers; the
+strings themselves are the same in both cases and are not counted.
+
+    PYTHONPATH=lib python bench/bench_memory.py
+"""
+import sys
+
+from geventirc import message
+
+import corpus
+
+
+class DictLazyMessage(object):
+
+    def __init__(self, data):
+        self.raw = data
+        self._prefix = None
+        self._command = None
+        self._rest = None
+        self._params = None
+        self._ctcp_params = None
+
+    def parse(self):
+        self._prefix, self._command, rest = message._split_command(self.raw)
+        self._params, self._ctcp_params = message.ctcp_split(
+                message._split_params(rest))
+
+
+class DictPrivMsg(object):
+
+    def __init__(self, to, msg):
+        self.prefix = None
+        self.command = 'PRIVMSG'
+        self.params = [to, msg]
+
+
+def size(obj):
+    total = sys.getsizeof(obj)
+    if hasattr(obj, '__dict__'):
+        total += sys.getsizeof(obj.__dict__)
+        values = obj.__dict__.values()
+    else:
+        # read slots through their descriptor, LazyMessage hides some of
+        # them behind parsing properties
+        values = [cls.__dict__[name].__get__(obj, cls)
+                for cls in type(obj).__mro__
+                for name in cls.__dict__.get('__slots__', ())]
+    for value in values:
+        if isinstance(value, (list, tuple)):
+            total += sys.getsizeof(value)
+    return total
+
+
+def report(name, before, after):
+    before = sum(size(m) for m in before) / float(len(before))
+    after = sum(size(m) for m in after) / float(len(after))
+    print '%-22s dict %6.1f bytes  slots %6.1f bytes  (-%.0f%%)' % (
+            name, before, after, (1 - after / before) * 100)
+
+
+def main():
+    lines = corpus.server_lines(1024 * 1024)
+    print 'retaining %d messages' % len(lines)
+
+    before = [DictLazyMessage(line) for line in lines]
+    after = [message.LazyMessage(line) for line in lines]
+    report('received, unparsed', before, after)
+
+    for msg in before:
+        msg.parse()
+    for msg in after:
+        msg.params
+    report('received, parsed', before, after)
+
+    before = [DictPrivMsg('#chan', line) for line in lines]
+    after = [message.PrivMsg('#chan', line) for line in lines]
+    report('PrivMsg', before, after)
+
+
+if __name__ == '__main__':
+    main()
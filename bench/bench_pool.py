@@ -0,0 +1,76 @@
+""" Memory and greenlets per connection for a ClientPool of 1000 clients
+connected to a minimal local IRC server.
+
+    PYTHONPATH=lib python bench/bench_pool.py [clients]
+"""
+import gevent.monkey
+gevent.monkey.patch_all()
+
+import gc
+import resource
+import sys
+import time
+
+import gevent
+from gevent.server import StreamServer
+
+from geventirc import ClientPool, handlers
+
+
+def serve(sock, address):
+    """ Welcome every client and answer its PINGs.
+    """
+    welcomed = False
+    stream = sock.makefile()
+    for line in stream:
+        if line.startswith('NICK') and not welcomed:
+            sock.sendall(':srv 001 %s :Welcome\r\n' % line.split()[1])
+            welcomed = True
+        elif line.startswith('PING'):
+            sock.sendall(':srv PONG srv\r\n')
+
+
+def rss():
+    gc.collect()
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def greenlets():
+    from greenlet import greenlet
+    return sum(1 for obj in gc.get_objects() if isinstance(obj, greenlet))
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    server = StreamServer(('127.0.0.1', 0), serve)
+    server.start()
+    port = server.address[1]
+
+    welcomed = []
+    pool = ClientPool(stagger=0)
+    pool.add_handler(handlers.ping_handler, 'PING')
+    pool.add_handler(handlers.inline(lambda client, msg: welcomed.append(client)), '001')
+    for i in range(count):
+        pool.add_client('127.0.0.1', 'bot%d' % i, port=port)
+
+    before_rss, before_greenlets = rss(), greenlets()
+    start = time.time()
+    pool.start()
+    while len(welcomed) < count:
+        gevent.sleep(0.05)
+    elapsed = time.time() - start
+    after_rss, after_greenlets = rss(), greenlets()
+
+    stats = pool.stats()
+    print '%d clients connected in %.2fs' % (count, elapsed)
+    print 'client greenlets: %d (%.2f per connection)' % (
+            stats['greenlets'], stats['greenlets'] / float(count))
+    print 'process greenlets: +%d, server included' % (after_greenlets - before_greenlets)
+    print 'max RSS: +%.1f KB per connection, server included' % (
+            (after_rss - before_rss) / 1024.0 / count)
+    pool.stop()
+    server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+""" Compare the legacy char by char quoting functions with the regex based
+ones on typical chat lines.
+
+    PYTHONPATH=lib python bench/bench_quoting.py
+"""
+import random
+import time
+
+from geventirc import message
+
+import corpus
+
+
+def legacy_quote(string, table):
+    cursor = 0
+    buf = ''
+    for pos, char in enumerate(string):
+        if pos is 0:
+            continue
+        if char in table:
+            buf += string[cursor:pos] + table[char]
+            cursor = pos + 1
+    buf += string[cursor:]
+    return buf
+
+
+def legacy_dequote(string, table):
+    cursor = 0
+    buf = ''
+    last_char = ''
+    for pos, char in enumerate(string):
+        if pos is 0:
+            last_char = char
+            continue
+        if last_char + char in table:
+            buf += string[cursor:pos] + table[char]
+            cursor = pos + 1
+        last_char = char
+
+    buf += string[cursor:]
+    return buf
+
+
+def legacy_low_level_quote(string):
+    return legacy_quote(string, message._low_level_quote_table)
+
+def legacy_low_level_dequote(string):
+    return legacy_dequote(string, message._low_level_dequote_table)
+
+def legacy_ctcp_quote(string):
+    return legacy_quote(string, message._ctcp_quote_table)
+
+def legacy_ctcp_dequote(string):
+    return legacy_dequote(string, message._ctcp_dequote_table)
+
+
+FUNCTIONS = (
+    ('low_level_quote', legacy_low_level_quote, message.low_level_quote),
+    ('low_level_dequote', legacy_low_level_dequote, message.low_level_dequote),
+    ('ctcp_quote', legacy_ctcp_quote, message.ctcp_quote),
+    ('ctcp_dequote', legacy_ctcp_dequote, message.ctcp_dequote),
+)
+
+
+def timed(func, lines):
+    start = time.time()
+    for line in lines:
+        func(line)
+    return time.time() - start
+
+
+def main():
+    rnd = random.Random(42)
+    lines = [corpus.chat_line(rnd) for _ in range(100000)]
+    print 'quoting %d chat lines' % len(lines)
+    for name, legacy, current in FUNCTIONS:
+        for line in lines[:1000]:
+            assert legacy(line) == current(line)
+        legacy_elapsed = timed(legacy, lines)
+        elapsed = timed(current, lines)
+        print '%-18s legacy %6.2f us/line  regex %6.2f us/line  x%.0f' % (
+                name, legacy_elapsed / len(lines) * 1e6,
+                elapsed / len(lines) * 1e6, legacy_elapsed / elapsed)
+
+
+if __name__ == '__main__':
+    main()
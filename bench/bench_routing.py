@@ -0,0 +1,78 @@
+""" 50 keyword handlers on a busy channel: each handler registered on
+PRIVMSG and checking the content itself, against routes evaluated once
+per message.
+
+    PYTHONPATH=lib python bench/bench_routing.py
+"""
+import random
+import time
+
+from geventirc import Client
+from geventirc.message import LazyMessage
+from geventirc.routing import Route
+
+import corpus
+
+KEYWORDS = ['keyword%d' % i for i in range(50)]
+
+
+def channel_lines(count, seed=42):
+    """ PRIVMSGs of 5000 users in #big, 1% of them with a keyword.
+    """
+    rnd = random.Random(seed)
+    lines = []
+    for i in range(count):
+        content = corpus.chat_line(rnd)
+        if rnd.random() < 0.01:
+            content += ' ' + rnd.choice(KEYWORDS)
+        lines.append(':user%d!u@h PRIVMSG #big :%s' % (rnd.randrange(5000), content))
+    return lines
+
+
+class KeywordHandler(object):
+
+    commands = ['PRIVMSG']
+
+    def __init__(self, keyword, blocking):
+        self.keyword = keyword
+        self.blocking = blocking
+        self.route = Route(keywords=[keyword])
+        self.calls = 0
+
+    def __call__(self, client, msg):
+        if self.keyword in ' '.join(msg.params[1:]).split():
+            self.calls += 1
+
+
+def run(lines, route, blocking):
+    client = Client('localhost', 'bot', recv_queue_size=0)
+    keyword_handlers = [KeywordHandler(keyword, blocking) for keyword in KEYWORDS]
+    for handler in keyword_handlers:
+        if route:
+            client.add_route(handler)
+        else:
+            client.add_handler(handler, 'PRIVMSG')
+    messages = [LazyMessage(line) for line in lines]
+    start = time.time()
+    for msg in messages:
+        client._process(msg)
+    client._pool.join()
+    elapsed = time.time() - start
+    return elapsed, sum(handler.calls for handler in keyword_handlers)
+
+
+def main():
+    lines = channel_lines(20000)
+    print '%d PRIVMSGs, %d keyword handlers' % (len(lines), len(KEYWORDS))
+    for name, route, blocking in [
+            ('PRIVMSG handlers, blocking', False, True),
+            ('PRIVMSG handlers, inline', False, False),
+            ('routes, blocking', True, True),
+            ('routes, inline', True, False)]:
+        elapsed, calls = run(lines, route, blocking)
+        print '%-28s %6.2f us/message (%d matches)' % (
+                name, elapsed / len(lines) * 1e6, calls)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+""" Thousands of periodic announcements: CPU time per tick and timers
+held, with a libev timer and a greenlet per tick (the old
+PeriodicMessage) and with a single Scheduler.
+
+    PYTHONPATH=lib python bench/bench_schedule.py [jobs] [seconds]
+"""
+import resource
+import sys
+
+import gevent
+
+from geventirc import schedule
+
+INTERVAL = 0.5
+
+
+def cpu():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+class TimerPerJob(object):
+    """ What PeriodicMessage did: a new hub timer for each tick, firing a
+    new greenlet.
+    """
+
+    def __init__(self, func):
+        self.func = func
+        self.timer = None
+
+    def schedule(self):
+        self.timer = gevent.get_hub().loop.timer(INTERVAL)
+        self.timer.start(self.tick)
+
+    def tick(self):
+        gevent.spawn(self.func)
+        self.schedule()
+
+    def cancel(self):
+        self.timer.stop()
+
+
+def run(name, count, seconds, start):
+    ticks = [0]
+
+    def announce():
+        ticks[0] += 1
+
+    jobs, timers = start(count, announce)
+    before = cpu()
+    gevent.sleep(seconds)
+    elapsed = cpu() - before
+    for job in jobs:
+        job.cancel()
+    gevent.sleep(0.01)
+    print '%-20s %7d ticks %6.2f us CPU/tick %6d timers' % (
+            name, ticks[0], elapsed * 1e6 / max(ticks[0], 1), timers)
+
+
+def timer_per_job(count, announce):
+    jobs = [TimerPerJob(announce) for _ in range(count)]
+    for job in jobs:
+        job.schedule()
+    return jobs, count
+
+def scheduler(count, announce, jitter=0):
+    timers = schedule.Scheduler()
+    jobs = [timers.call_every(INTERVAL, announce, jitter=jitter) for _ in range(count)]
+    return jobs, 1
+
+def scheduler_jitter(count, announce):
+    return scheduler(count, announce, INTERVAL / 2)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 3
+    print '%d jobs every %ss for %ss' % (count, INTERVAL, seconds)
+    run('timer per job', count, seconds, timer_per_job)
+    run('Scheduler', count, seconds, scheduler)
+    run('Scheduler, jitter', count, seconds, scheduler_jitter)
+
+
+if __name__ == '__main__':
+    main()
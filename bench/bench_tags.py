@@ -0,0 +1,62 @@
+""" Cost of IRCv3 message tags support: splitting untagged lines against
+the split without tag handling, and tagged lines with and without reading
+the tags.
+
+    PYTHONPATH=lib python bench/bench_tags.py
+"""
+import time
+
+from geventirc import message
+from geventirc.message import LazyMessage
+
+import corpus
+
+
+def legacy_irc_split(data):
+    prefix, command, buf = message._split_command(data)
+    return prefix, command, message._split_params(buf)
+
+
+def route(lines):
+    for line in lines:
+        LazyMessage(line).command
+
+def route_and_read_tags(lines):
+    for line in lines:
+        msg = LazyMessage(line)
+        msg.command
+        msg.tags
+
+def split_all(split, lines):
+    for line in lines:
+        split(line)
+
+
+def timed(func, *args):
+    best = None
+    for _ in range(3):
+        start = time.time()
+        func(*args)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def report(name, elapsed, lines):
+    print '%-36s %6.2f us/line' % (name, elapsed / len(lines) * 1e6)
+
+
+def main():
+    untagged = corpus.server_lines(2 * 1024 * 1024)
+    tagged = corpus.tagged_lines(2 * 1024 * 1024)
+    print '%d lines' % len(untagged)
+    report('untagged irc_split, no tag support', timed(split_all, legacy_irc_split, untagged), untagged)
+    report('untagged irc_split', timed(split_all, message.irc_split, untagged), untagged)
+    report('untagged routing (command)', timed(route, untagged), untagged)
+    report('tagged routing (command)', timed(route, tagged), tagged)
+    report('tagged routing, tags read', timed(route_and_read_tags, tagged), tagged)
+    report('tagged irc_split_tags', timed(split_all, message.irc_split_tags, tagged), tagged)
+
+
+if __name__ == '__main__':
+    main()
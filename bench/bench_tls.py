@@ -0,0 +1,72 @@
+""" Time to connect to a local TLS server: plain TCP, full TLS handshakes
+and TLS handshakes resuming the previous session (when the ssl module
+supports it).
+
+    PYTHONPATH=lib python bench/bench_tls.py [connections]
+"""
+import gevent.monkey
+gevent.monkey.patch_all()
+
+import os
+import socket
+import ssl
+import sys
+import time
+
+from gevent.server import StreamServer
+
+from geventirc import Client, tls
+
+CERTFILE = os.path.join(os.path.dirname(__file__), '..', 'lib', 'tests', 'localhost.pem')
+
+
+def serve(sock, address):
+    try:
+        while sock.recv(1024):
+            pass
+    except (socket.error, ssl.SSLError):
+        # the client closes without TLS close_notify
+        pass
+
+
+def connect(count, port, resume=False, **kwargs):
+    """ Return the average connection time in ms and the number of
+    resumed TLS sessions.
+    """
+    client = Client('localhost', 'bench', port=port, **kwargs)
+    client.connect()
+    client._disconnect()
+    start = time.time()
+    for _ in range(count):
+        if not resume:
+            client._tls_sessions.clear()
+        client.connect()
+        client._disconnect()
+    elapsed = time.time() - start
+    return elapsed / count * 1000, client.stats['tls_resumed']
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    server_context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+    server_context.load_cert_chain(CERTFILE)
+    plain = StreamServer(('127.0.0.1', 0), serve)
+    secure = StreamServer(('127.0.0.1', 0), serve, ssl_context=server_context)
+    plain.start()
+    secure.start()
+    context = ssl.create_default_context(cafile=CERTFILE)
+
+    print 'plain TCP:   %6.2f ms per connection' % connect(count, plain.address[1])[0]
+    print 'TLS:         %6.2f ms per connection' % connect(
+            count, secure.address[1], ssl_context=context)[0]
+    if tls.HAS_SESSIONS:
+        print 'TLS resumed: %6.2f ms per connection (%d resumed)' % connect(
+                count, secure.address[1], resume=True, ssl_context=context)
+    else:
+        print 'TLS resumed: not supported by this ssl module'
+    plain.stop()
+    secure.stop()
+
+
+if __name__ == '__main__':
+    main()
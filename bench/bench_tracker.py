@@ -0,0 +1,57 @@
+""" Cost of the channel state tracker per event, in channels of different
+sizes, and memory per member.
+
+    PYTHONPATH=lib python bench/bench_tracker.py
+"""
+import sys
+import time
+
+from geventirc import Client
+from geventirc.message import LazyMessage
+
+
+def member_bytes(tracker, channel):
+    """ Bytes of the user records and index entries per member, the name
+    strings aside.
+    """
+    total = sys.getsizeof(tracker.users) + sys.getsizeof(channel.members)
+    for user in tracker.users.values():
+        total += sys.getsizeof(user) + sys.getsizeof(user.channels)
+    return total / float(len(channel.members))
+
+
+def populated(size):
+    client = Client('localhost', 'bench', recv_queue_size=0, track_state=True)
+    client._process(LazyMessage(':bench!b@h JOIN #big'))
+    names = ['user%d' % i for i in range(size)]
+    for start in range(0, size, 50):
+        client._process(LazyMessage(':srv 353 bench = #big :' + ' '.join(names[start:start + 50])))
+    client._process(LazyMessage(':srv 366 bench #big :End of /NAMES list.'))
+    return client
+
+
+def churn(client, count):
+    lines = []
+    for i in range(count):
+        lines.append(':new%d!n@h JOIN #big' % i)
+        lines.append(':new%d!n@h NICK renamed%d' % (i, i))
+        lines.append(':op!o@h MODE #big +v renamed%d' % i)
+        lines.append(':renamed%d!n@h QUIT :bye' % i)
+    messages = [LazyMessage(line) for line in lines]
+    start = time.time()
+    for msg in messages:
+        client._process(msg)
+    return (time.time() - start) / len(lines)
+
+
+def main():
+    for size in (100, 10000, 100000):
+        client = populated(size)
+        tracker = client.tracker
+        used = member_bytes(tracker, tracker.channel('#big'))
+        print '%6d members: %5.2f us/event, %4.0f bytes/member' % (
+                size, churn(client, 20000) * 1e6, used)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+""" Synthetic server traffic shared by the benchmarks.
+"""
+import random
+
+NICKS = ['nick%d' % i for i in range(2000)]
+CHANNELS = ['#chan%d' % i for i in range(20)]
+WORDS = ('the quick brown fox jumps over the lazy dog gevent irc bot '
+         'hello world ping pong netsplit lag').split()
+
+
+def chat_line(rnd):
+    return ' '.join(rnd.choice(WORDS) for _ in range(rnd.randint(3, 20)))
+
+
+def server_lines(size=4 * 1024 * 1024, seed=42):
+    """ Return a list of lines (without terminator) totalling about `size`
+    bytes: mostly PRIVMSGs, with NAMES bursts, PINGs and numerics.
+    """
+    rnd = random.Random(seed)
+    lines = []
+    total = 0
+    while total < size:
+        start = len(lines)
+        kind = rnd.random()
+        if kind < 0.02:
+            channel = rnd.choice(CHANNELS)
+            for pos in range(0, len(NICKS), 40):
+                lines.append(':irc.example.net 353 bot = %s :%s' % (
+                    channel, ' '.join(NICKS[pos:pos + 40])))
+            lines.append(':irc.example.net 366 bot %s :End of /NAMES list.' % channel)
+        elif kind < 0.05:
+            lines.append('PING :irc.example.net')
+        elif kind < 0.10:
+            nick = rnd.choice(NICKS)
+            lines.append(':%s!user@host.example.net JOIN %s' % (nick, rnd.choice(CHANNELS)))
+        else:
+            nick = rnd.choice(NICKS)
+            lines.append(':%s!user@host.example.net PRIVMSG %s :%s' % (
+                nick, rnd.choice(CHANNELS), chat_line(rnd)))
+        total += sum(len(line) + 2 for line in lines[start:])
+    return lines
+
+
+def tagged_lines(size=4 * 1024 * 1024, seed=42):
+    """ Return the lines of `server_lines` with the IRCv3 tags a modern
+    server sends: server-time and msgid on every line, account on most
+    and batch on the NAMES replies.
+    """
+    rnd = random.Random(seed)
+    lines = []
+    for count, line in enumerate(server_lines(size, seed)):
+        tags = 'time=2024-01-01T00:%02d:%02d.%03dZ;msgid=%016x' % (
+                count // 60000 % 60, count // 1000 % 60, count % 1000,
+                rnd.getrandbits(64))
+        if ' 353 ' in line:
+            tags += ';batch=names'
+        elif rnd.random() < 0.7:
+            tags += ';account=%s' % rnd.choice(NICKS)
+        lines.append('@%s %s' % (tags, line))
+    return lines
+
+
+def server_stream(size=4 * 1024 * 1024, seed=42):
+    return ''.join(line + '\r\n' for line in server_lines(size, seed))
+
+
+def chunks(data, size):
+    return [data[pos:pos + size] for pos in xrange(0, len(data), size)]
@@ -1,3 +1,3 @@
 from geventirc.irc import Client
+from geventirc.pool import ClientPool
 from geventirc.log import IRCLogHandler
-
@@ -0,0 +1,117 @@
+""" IRCv3 capability negotiation.
+"""
+from __future__ import absolute_import
+
+from geventirc import message
+
+CAP_VERSION = '302'
+
+BATCH = 'batch'
+ECHO_MESSAGE = 'echo-message'
+MESSAGE_TAGS = 'message-tags'
+
+DEFAULT_CAPS = (BATCH, ECHO_MESSAGE, MESSAGE_TAGS)
+
+
+class Capabilities(object):
+    """ Negotiate the `wanted` capabilities with the server.
+
+    `start` sends CAP LS before NICK and USER so that the server holds the
+    registration until CAP END. The capabilities advertised by the server
+    (`available`, mapping their name to their value or '') which are
+    wanted are requested at once, and the negotiation ends when the
+    server acknowledged or rejected them. Acknowledged capabilities are
+    in `enabled`.
+
+    Capabilities advertised later with CAP NEW are requested too, and the
+    ones removed with CAP DEL are disabled. Servers which do not know CAP
+    reply with ERR_UNKNOWNCOMMAND and register the client anyway.
+    """
+
+    def __init__(self, wanted=()):
+        self.wanted = frozenset(wanted)
+        self.available = {}
+        self.enabled = set()
+        self.negotiating = False
+        self._requested = set()
+
+    def __contains__(self, name):
+        return name in self.enabled
+
+    def start(self, client):
+        self.available.clear()
+        self.enabled.clear()
+        self._requested.clear()
+        self.negotiating = True
+        client.send_message(message.Cap('LS', CAP_VERSION))
+
+    def end(self, client):
+        if self.negotiating:
+            self.negotiating = False
+            client.send_message(message.Cap('END'))
+
+    def request(self, client, names):
+        """ Request the capabilities of `names` which are neither enabled
+        nor already requested, return them.
+        """
+        names = [name for name in names
+                if name not in self.enabled and name not in self._requested]
+        if names:
+            self._requested.update(names)
+            client.send_message(message.Cap('REQ', ' '.join(names)))
+        return names
+
+    def _advertised(self, caps):
+        """ Add `caps` to the available capabilities, return the wanted ones.
+        """
+        names = []
+        for cap in caps:
+            name, _, value = cap.partition('=')
+            self.available[name] = value
+            names.append(name)
+        return sorted(self.wanted.intersection(names))
+
+    def handle(self, client, msg):
+        params = msg.params
+        if msg.command != 'CAP':
+            # ERR_UNKNOWNCOMMAND, the server does not negotiate
+            if len(params) > 1 and params[1].upper() == 'CAP':
+                self.negotiating = False
+            return
+        if len(params) < 2:
+            raise message.ProtocolViolationError('invalid CAP reply: %r' % (params,))
+        subcommand = params[1].upper()
+        # received params are split on spaces
+        caps = ' '.join(params[2:]).split()
+        if subcommand == 'LS':
+            more = caps[:1] == ['*']
+            if more:
+                caps = caps[1:]
+            self._advertised(caps)
+            if more:
+                # more lines to come
+                return
+            wanted = sorted(self.wanted.intersection(self.available))
+            if not self.request(client, wanted):
+                self.end(client)
+        elif subcommand == 'ACK':
+            for name in caps:
+                if name.startswith('-'):
+                    self.enabled.discard(name[1:])
+                else:
+                    self.enabled.add(name)
+            self._answered(client, caps)
+        elif subcommand == 'NAK':
+            self._answered(client, caps)
+        elif subcommand == 'NEW':
+            self.request(client, self._advertised(caps))
+        elif subcommand == 'DEL':
+            for name in caps:
+                self.available.pop(name, None)
+                self.enabled.discard(name)
+
+    def _answered(self, client, caps):
+        self._requested.difference_update(name.lstrip('-') for name in caps)
+        if not self._requested:
+            self.end(client)
+
@@ -0,0 +1,104 @@
+""" Handler registry compiled into a per command dispatch table.
+"""
+
+
+def normalize_command(command):
+    """ Return the command as received from the server: upper cased, and
+    numeric replies zero padded to 3 digits (1, '1' -> '001').
+    """
+    if isinstance(command, (int, long)):
+        return '%03d' % command
+    command = str(command).upper()
+    if command.isdigit():
+        return command.zfill(3)
+    return command
+
+
+def is_blocking(handler, default=True):
+    """ Tell whether `handler` must run in its own greenlet. Handlers
+    decide with a `blocking` attribute, see `handlers.inline` and
+    `handlers.blocking`.
+    """
+    return getattr(handler, 'blocking', default)
+
+
+class Dispatcher(object):
+    """ Keep track of registered handlers and of the handlers to call for
+    each command, global handlers included.
+
+    The table maps a command to a pair of immutable tuples: the handlers
+    to run inline, in registration order, and the blocking ones to run in
+    their own greenlet. Handlers without a `blocking` attribute are inline
+    only when `inline` is true. The table is only rebuilt when a handler
+    is added or removed so a lookup is a single dict access.
+    """
+
+    def __init__(self, inline=False):
+        self.inline = inline
+        # routing.Router of the handlers added with a route, if any
+        self.router = None
+        self._handlers = {}
+        self._global_handlers = []
+        self._table = {}
+        self._default = ((), ())
+
+    def add(self, to_call, *commands):
+        if not commands:
+            if hasattr(to_call, 'commands'):
+                commands = to_call.commands
+            else:
+                if to_call not in self._global_handlers:
+                    self._global_handlers.append(to_call)
+                self._compile()
+                return
+
+        for command in commands:
+            handlers = self._handlers.setdefault(normalize_command(command), [])
+            if to_call not in handlers:
+                handlers.append(to_call)
+        self._compile()
+
+    def remove(self, to_call, *commands):
+        """ Unregister `to_call` from `commands` (or the commands it was
+        registered with by default). Raise ValueError if it is not registered.
+        """
+        if not commands:
+            if hasattr(to_call, 'commands'):
+                commands = to_call.commands
+            else:
+                self._global_handlers.remove(to_call)
+                self._compile()
+                return
+
+        # checked first, so that a failed removal leaves everything in place
+        commands = set(normalize_command(command) for command in commands)
+        for command in commands:
+            if to_call not in self._handlers.get(command, ()):
+                raise ValueError('%r is not registered for %s' % (to_call, command))
+        for command in commands:
+            handlers = self._handlers[command]
+            handlers.remove(to_call)
+            if not handlers:
+                del self._handlers[command]
+        self._compile()
+
+    def get(self, command):
+        """ Return the (inline, blocking) tuples of handlers to call for
+        `command`.
+        """
+        return self._table.get(command, self._default)
+
+    def _split(self, handlers):
+        default = not self.inline
+        inline = tuple(h for h in handlers if not is_blocking(h, default))
+        blocking = tuple(h for h in handlers if is_blocking(h, default))
+        return inline, blocking
+
+    def _compile(self):
+        table = {}
+        for command, handlers in self._handlers.items():
+            merged = list(self._global_handlers)
+            merged += [h for h in handlers if h not in merged]
+            table[command] = self._split(merged)
+        self._table = table
+        self._default = self._split(self._global_handlers)
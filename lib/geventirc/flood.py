@@ -0,0 +1,227 @@
+""" Outgoing message scheduling: send queue and flood control.
+"""
+import time
+from collections import deque, OrderedDict
+
+import gevent.queue
+from gevent.event import Event
+
+# Send queue lanes, a lane is only served when the ones before it are empty.
+CONTROL = 0
+INTERACTIVE = 1
+BULK = 2
+
+# Lane of the commands not sent in the INTERACTIVE lane by default.
+LANE_COMMANDS = {
+    'PING': CONTROL,
+    'PONG': CONTROL,
+    'QUIT': CONTROL,
+    'PASS': CONTROL,
+    'NICK': CONTROL,
+    'USER': CONTROL,
+    'CAP': CONTROL,
+}
+
+# Commands kept across a reconnection by default, see Journal.
+JOURNAL_COMMANDS = ('PRIVMSG', 'NOTICE')
+
+
+class TokenBucket(object):
+    """ Allow `rate` messages per second on average, with bursts of at
+    most `burst` messages.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = float(burst)
+        self._last = time.time()
+
+    def _refill(self):
+        now = time.time()
+        self.tokens = min(self.burst, self.tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def take(self):
+        """ Consume a token, return False if there is none available.
+        """
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def delay(self):
+        """ Seconds to wait before a token is available.
+        """
+        self._refill()
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class Lane(object):
+    """ FIFO of queued items, or one FIFO per target served round robin
+    when `fair` is true.
+    """
+
+    def __init__(self, fair=False):
+        self.fair = fair
+        self._items = deque()
+        self._targets = OrderedDict()
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def put(self, item, target):
+        if self.fair:
+            queue = self._targets.get(target)
+            if queue is None:
+                queue = self._targets[target] = deque()
+            queue.append(item)
+        else:
+            self._items.append(item)
+        self._size += 1
+
+    def pop(self):
+        if self.fair:
+            # serve the first target and move it to the end of the line
+            target, queue = self._targets.popitem(last=False)
+            item = queue.popleft()
+            if queue:
+                self._targets[target] = queue
+        else:
+            item = self._items.popleft()
+        self._size -= 1
+        return item
+
+    def clear(self):
+        self._items.clear()
+        self._targets.clear()
+        self._size = 0
+
+
+class SendQueue(object):
+    """ Queue of encoded messages waiting to be sent.
+
+    Messages are queued in the CONTROL, INTERACTIVE or BULK lane, given
+    explicitly or looked up by command in `lane_commands`, and a lane is
+    only served once the ones before it are empty. When `fair` is true
+    the INTERACTIVE and BULK lanes queue messages per target (the first
+    param of the message) and serve targets round robin, so a chatty
+    channel does not starve the others.
+
+    Items are (data, target, enqueue time, command) tuples. `put` blocks
+    while `maxsize` items are queued.
+    """
+
+    def __init__(self, maxsize=None, fair=False, lane_commands=LANE_COMMANDS):
+        self.maxsize = maxsize
+        self.lane_commands = lane_commands
+        self.lanes = (Lane(), Lane(fair), Lane(fair))
+        self._size = 0
+        self._readable = Event()
+        self._writable = Event()
+        self._writable.set()
+
+    def __len__(self):
+        return self._size
+
+    def full(self):
+        return self.maxsize is not None and self._size >= self.maxsize
+
+    def put(self, data, command=None, target=None, lane=None):
+        while self.full():
+            self._writable.clear()
+            self._writable.wait()
+        if lane is None:
+            lane = self.lane_commands.get(command, INTERACTIVE)
+        self.lanes[lane].put((data, target, time.time(), command), target)
+        self._size += 1
+        self._readable.set()
+
+    def wait(self):
+        """ Block until the queue is not empty.
+        """
+        while not self._size:
+            self._readable.clear()
+            self._readable.wait()
+
+    def get(self):
+        self.wait()
+        return self.get_nowait()
+
+    def get_nowait(self):
+        for lane in self.lanes:
+            if lane:
+                item = lane.pop()
+                break
+        else:
+            raise gevent.queue.Empty()
+        self._size -= 1
+        self._writable.set()
+        return item
+
+    def drain(self):
+        """ Remove and return all the queued items, in the order they would
+        have been sent.
+        """
+        items = []
+        while self._size:
+            items.append(self.get_nowait())
+        return items
+
+    def clear(self):
+        for lane in self.lanes:
+            lane.clear()
+        self._size = 0
+        self._writable.set()
+
+
+class Journal(object):
+    """ Outgoing messages kept while reconnecting, to be sent again once
+    registered on the new connection.
+
+    Only messages of `commands` are kept, registration and other
+    connection specific commands would be wrong on the new connection.
+    At most `maxsize` messages are kept, the oldest are dropped first, and
+    messages queued more than `ttl` seconds before they are replayed are
+    dropped as stale.
+    """
+
+    def __init__(self, maxsize=100, ttl=60, commands=JOURNAL_COMMANDS):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.commands = frozenset(commands)
+        self._items = deque()
+
+    def __len__(self):
+        return len(self._items)
+
+    def keep(self, items):
+        """ Keep the resendable `items` of a send queue, return the number of
+        messages kept and dropped (not resendable or over `maxsize`).
+        """
+        kept = dropped = 0
+        journal = self._items
+        for item in items:
+            if item[3] not in self.commands or not self.maxsize:
+                dropped += 1
+                continue
+            if len(journal) >= self.maxsize:
+                journal.popleft()
+                dropped += 1
+            journal.append(item)
+            kept += 1
+        return kept, dropped
+
+    def replay(self):
+        """ Empty the journal, return the items which are not stale and the
+        number of stale items dropped.
+        """
+        deadline = time.time() - self.ttl
+        items = [item for item in self._items if item[2] >= deadline]
+        dropped = len(self._items) - len(items)
+        self._items.clear()
+        return items, dropped
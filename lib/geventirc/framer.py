@@ -0,0 +1,90 @@
+""" Incremental line framing for the IRC byte stream.
+"""
+
+CR = ord("\r")
+NL = "\n"
+
+# RFC 2812 limits a line to 512 bytes, IRCv3 message tags add up to 8191
+# more; leave some slack for servers that do not play by the rules.
+MAX_LINE_LENGTH = 16384
+RECV_SIZE = 4096
+
+
+class LineFramer(object):
+    """ Split a stream of bytes into IRC lines.
+
+    Data is accumulated in a single bytearray which is only compacted once
+    per `feed`, so the cost of framing stays linear in the amount of data
+    received whatever the size of the bursts sent by the server.
+
+    Lines longer than `max_line_length` are dropped (and counted in
+    `dropped`) instead of letting the buffer grow without bound.
+    """
+
+    def __init__(self, recv_size=RECV_SIZE, max_line_length=MAX_LINE_LENGTH):
+        self.recv_size = recv_size
+        self.max_line_length = max_line_length
+        self.dropped = 0
+        self._buffer = bytearray()
+        self._scan = 0
+        self._discard = False
+        self._recv_buffer = bytearray(recv_size)
+        self._recv_view = memoryview(self._recv_buffer)
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def clear(self):
+        del self._buffer[:]
+        self._scan = 0
+        self._discard = False
+
+    def feed(self, data):
+        """ Append `data` and return the list of complete lines it made
+        available, without their line terminator.
+        """
+        buf = self._buffer
+        buf += data
+        return self._frame()
+
+    def recv_from(self, sock):
+        """ Receive at most `recv_size` bytes from `sock` and return the
+        complete lines. Returns None when the peer closed the connection.
+        """
+        size = sock.recv_into(self._recv_buffer, self.recv_size)
+        if not size:
+            return None
+        self._buffer += self._recv_view[:size]
+        return self._frame()
+
+    def _frame(self):
+        buf = self._buffer
+        max_length = self.max_line_length
+        lines = []
+        append = lines.append
+        start = 0
+        pos = buf.find(NL, self._scan)
+        while pos >= 0:
+            end = pos
+            if end > start and buf[end - 1] == CR:
+                end -= 1
+            if self._discard:
+                self._discard = False
+            elif end - start > max_length:
+                self.dropped += 1
+            else:
+                append(str(buf[start:end]))
+            start = pos + 1
+            pos = buf.find(NL, start)
+
+        if start:
+            del buf[:start]
+        if len(buf) > max_length:
+            # no terminator in sight, forget what we have and skip
+            # everything up to the next one.
+            if not self._discard:
+                self.dropped += 1
+                self._discard = True
+            del buf[:]
+        self._scan = len(buf)
+        return lines
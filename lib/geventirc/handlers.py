@@ -1,24 +1,49 @@
-import gevent
+import collections
+import functools
+import time
+
 from geventirc import message
 from geventirc import replycode
+from geventirc import schedule
+from geventirc import tracker
+from geventirc.routing import Route
+
 
+def inline(handler):
+    """ Mark `handler` as non blocking, it is run by the client process
+    loop without spawning a greenlet.
+    """
+    handler.blocking = False
+    return handler
+
+def blocking(handler):
+    """ Mark `handler` as blocking, it is run in the client handler pool.
+    """
+    handler.blocking = True
+    return handler
 
+
+@inline
 def ping_handler(client, msg):
     client.send_message(message.Pong(client.nick))
 
+@inline
 def print_handler(client, msg):
     print msg.encode()[:-2]
 
+@inline
 def log_handler(client, msg):
     client.logger.debug("recv: " + msg.encode()[:-2])
 
+@inline
 def nick_in_use_handler(client, msg):
     client.nick = msg.params[1] + '_'
     client.send_message(message.Nick(client.nick))
 
 
 class AuthHandler(object):
-    
+
+    blocking = False
     commands = ['001']
 
     def __init__(self, name, password, command='OPER'):
@@ -31,21 +56,20 @@ class AuthHandler(object):
 
         
 class IRCShutdownHandler(object):
-    """ Reconnect when server dies 
+    """ Reconnect when server dies, after the client backoff delay
     """
+    blocking = False
     commands = ['NOTICE']
     
     def __call__(self, client, msg):
         if "Exiting" in msg.params:
-            client.logger.info("Stopping client")
-            client.stop()
-            gevent.sleep(10)
-            client.logger.info("Starting client")
-            client.start()
+            client.logger.info("Server is exiting, reconnecting")
+            client.reconnect(wait=False)
             
             
 class JoinHandler(object):
-    
+
+    blocking = False
     commands = ['001', 'KICK']
 
     def __init__(self, channel, rejoin=True, rejoinmsg=''):
@@ -72,7 +96,8 @@ class JoinHandler(object):
 
 
 class NickServHandler(object):
-    
+
+    blocking = False
     commands = ['001',
         replycode.ERR_NICKNAMEINUSE,
         replycode.ERR_NICKCOLLISION]
@@ -97,13 +122,18 @@ class NickServHandler(object):
 
 
 class ReplyWhenQuoted(object):
-    
+
+    blocking = False
     commands = ['PRIVMSG']
+    route = Route(channel=True, mention=True)
 
     def __init__(self, reply):
         self.reply = reply
 
     def __call__(self, client, msg):
+        if msg.prefix_parts[0] == client.nick:
+            # our own message, sent back with echo-message
+            return
         channel, content = msg.params[0], " ".join(msg.params[1:])
         if client.nick in content:
             # check if this is a direct message
@@ -112,7 +142,10 @@ class ReplyWhenQuoted(object):
 
 
 class MeHandler(object):
+
+    blocking = False
     commands = ['PRIVMSG']
+    route = Route(direct=True)
 
     def __init__(self, reply):
         self.reply = reply
@@ -126,7 +159,9 @@ class MeHandler(object):
 
 class ReplyToDirectMessage(object):
 
+    blocking = False
     commands = ['PRIVMSG']
+    route = Route(direct=True)
 
     def __init__(self, reply):
         self.reply = reply
@@ -139,47 +174,391 @@ class ReplyToDirectMessage(object):
                 client.msg(nick, self.reply)
 
 
+class BufferedMessage(object):
+    """ A direct message kept by `PrivMsgBuffer`: the sender nick, the
+    text and the time it was received.
+    """
+
+    __slots__ = ('nick', 'text', 'time')
+
+    def __init__(self, nick, text, time):
+        self.nick = nick
+        self.text = text
+        self.time = time
+
+    def __repr__(self):
+        return '<BufferedMessage %s: %r>' % (self.nick, self.text)
+
+
 class PrivMsgBuffer(object):
+    """ The last `maxlen` direct messages received, and only the ones
+    received less than `max_age` seconds ago if it is set.
+
+    Messages are kept in a ring (`buffer`, oldest first) and in a ring
+    per sender nick (folded as RFC1459), the oldest message is evicted
+    from both in constant time. Iterating over the buffer or `from_nick`
+    does not copy it.
+    """
+
+    blocking = False
     commands = ['PRIVMSG']
-    
-    def __init__(self):
-        self.buffer = []
+    route = Route(direct=True)
+
+    def __init__(self, maxlen=1000, max_age=None):
+        if maxlen < 1:
+            raise ValueError('maxlen must be at least 1, not %r' % (maxlen,))
+        self.maxlen = maxlen
+        self.max_age = max_age
+        self.buffer = collections.deque()
+        self._by_nick = {}
 
     def __call__(self, client, msg):
         channel = msg.params[0]
         if client.nick == channel:
             nick, user_agent, host = msg.prefix_parts
             if nick is not None:
-                self.buffer.append((nick, msg))
-                
+                # received params are split on spaces
+                self.append(nick, ' '.join(msg.params[1:]))
+
+    def append(self, nick, text, now=None):
+        if now is None:
+            now = time.time()
+        record = BufferedMessage(intern(nick), text, now)
+        if len(self.buffer) >= self.maxlen:
+            self._evict()
+        self.buffer.append(record)
+        key = tracker.fold(nick)
+        queue = self._by_nick.get(key)
+        if queue is None:
+            queue = self._by_nick[key] = collections.deque()
+        queue.append(record)
+        self.expire(now)
+
+    def _evict(self):
+        record = self.buffer.popleft()
+        key = tracker.fold(record.nick)
+        queue = self._by_nick[key]
+        queue.popleft()
+        if not queue:
+            del self._by_nick[key]
+
+    def expire(self, now=None):
+        """ Evict the messages older than `max_age`.
+        """
+        if self.max_age is None:
+            return
+        if now is None:
+            now = time.time()
+        limit = now - self.max_age
+        buffer = self.buffer
+        while buffer and buffer[0].time <= limit:
+            self._evict()
+
+    def from_nick(self, nick):
+        """ Iterate over the messages of `nick`, oldest first.
+        """
+        self.expire()
+        return iter(self._by_nick.get(tracker.fold(nick), ()))
+
+    def nicks(self):
+        self.expire()
+        return [queue[0].nick for queue in self._by_nick.itervalues()]
+
+    def clear(self):
+        self.buffer.clear()
+        self._by_nick.clear()
+
+    def __iter__(self):
+        self.expire()
+        return iter(self.buffer)
+
     def __len__(self):
+        self.expire()
         return len(self.buffer)
-        
+
+
+class CommandError(ValueError):
+    """ Raised when the arguments of a bot command do not match its schema.
+    """
+
+
+class BotCommand(object):
+    """ A bot command: `func(client, msg, **args)` is called with the
+    arguments parsed after the command name according to `args`.
+
+    Each argument is a name, a (name, type) or a (name, type, default)
+    tuple. Arguments with a default are optional and a name starting
+    with '*' takes the rest of the line. `user_cooldown` and
+    `channel_cooldown` are the seconds before the same user, or anyone in
+    the same channel, can run the command again.
+    """
+
+    __slots__ = ('name', 'func', 'args', 'aliases', 'user_cooldown',
+            'channel_cooldown', 'blocking')
+
+    def __init__(self, name, func, args=(), aliases=(), user_cooldown=0,
+            channel_cooldown=0, blocking=True):
+        self.name = name.lower()
+        self.func = func
+        self.args = []
+        for arg in args:
+            if isinstance(arg, basestring):
+                arg = (arg,)
+            name = arg[0]
+            kind = arg[1] if len(arg) > 1 else str
+            self.args.append((name.lstrip('*'), kind, arg[2:], name.startswith('*')))
+        self.aliases = tuple(alias.lower() for alias in aliases)
+        self.user_cooldown = user_cooldown
+        self.channel_cooldown = channel_cooldown
+        self.blocking = blocking
+
+    def usage(self, prefix=''):
+        parts = [prefix + self.name]
+        for name, _, default, rest in self.args:
+            name = name + '...' if rest else name
+            parts.append('[%s]' % name if default or rest else '<%s>' % name)
+        return ' '.join(parts)
+
+    def parse(self, words):
+        """ Return the arguments of the command line split in `words`.
+        """
+        values = {}
+        for position, (name, kind, default, rest) in enumerate(self.args):
+            if rest:
+                values[name] = ' '.join(words[position:])
+                return values
+            if position < len(words):
+                try:
+                    values[name] = kind(words[position])
+                except ValueError:
+                    raise CommandError('invalid %s: %r' % (name, words[position]))
+            elif default:
+                values[name] = default[0]
+            else:
+                raise CommandError('missing %s' % name)
+        if len(words) > len(self.args):
+            raise CommandError('too many arguments')
+        return values
+
+
+class _TrieNode(object):
+
+    __slots__ = ('children', 'command', 'below')
+
+    def __init__(self):
+        self.children = {}
+        # command named by the path to this node
+        self.command = None
+        # the only command below this node, or _AMBIGUOUS
+        self.below = None
+
+
+_AMBIGUOUS = object()
+
+
+class CommandTrie(object):
+    """ Commands by name and alias. Any unambiguous prefix of a name or
+    alias resolves to its command too. A lookup walks one node per
+    character, whatever the number of commands.
+    """
+
+    def __init__(self):
+        self._root = _TrieNode()
+
+    def add(self, name, command):
+        node = self._root
+        for char in name:
+            child = node.children.get(char)
+            if child is None:
+                child = node.children[char] = _TrieNode()
+            node = child
+            if node.below is None:
+                node.below = command
+            elif node.below is not command:
+                node.below = _AMBIGUOUS
+        node.command = command
+
+    def lookup(self, name):
+        """ Return the command named `name`, or the only command starting
+        with `name`, or None.
+        """
+        node = self._root
+        for char in name:
+            node = node.children.get(char)
+            if node is None:
+                return None
+        if node.command is not None:
+            return node.command
+        if node.below is _AMBIGUOUS:
+            return None
+        return node.below
+
+
+class CommandHandler(object):
+    """ Bot commands: PRIVMSGs starting with `prefix`, such as
+    '!weather paris', call the command registered under that name, an
+    alias, or an unambiguous prefix of one of them. Direct messages do not
+    need the prefix.
+
+    Cooldowns are checked before the command runs, a command in cooldown
+    is ignored and counted in the client `stats` as command_cooldown. A
+    command line not matching the command arguments is answered with the
+    usage. Blocking commands run in the client handler pool.
+    """
+
+    blocking = False
+    commands = ['PRIVMSG']
+
+    def __init__(self, prefix='!', reply_usage=True):
+        self.prefix = prefix
+        self.reply_usage = reply_usage
+        self._commands = {}
+        self._trie = CommandTrie()
+        self._cooldowns = {}
+        self._expired_check = 0
+
+    def __len__(self):
+        return len(self._commands)
+
+    def add(self, name, func, **options):
+        """ Register `func` as the command `name`, see `BotCommand` for the
+        options.
+        """
+        command = BotCommand(name, func, **options)
+        replaced = command.name in self._commands
+        self._commands[command.name] = command
+        if replaced:
+            self._build()
+        else:
+            self._index(self._trie, command)
+        return command
+
+    def command(self, name=None, **options):
+        """ Decorator registering a function as a command, named after the
+        function by default.
+        """
+        def register(func):
+            self.add(name or func.__name__, func, **options)
+            return func
+        return register
+
+    def remove(self, name):
+        del self._commands[name.lower()]
+        self._build()
+
+    def lookup(self, name):
+        return self._trie.lookup(name.lower())
+
+    def _index(self, trie, command):
+        trie.add(command.name, command)
+        for alias in command.aliases:
+            trie.add(alias, command)
+
+    def _build(self):
+        trie = CommandTrie()
+        for command in self._commands.values():
+            self._index(trie, command)
+        self._trie = trie
+
+    def _cooldown(self, command, nick, channel, now):
+        """ Return True if `command` is in cooldown for `nick` or
+        `channel`, else start the cooldowns.
+        """
+        cooldowns = self._cooldowns
+        keys = []
+        if command.user_cooldown:
+            keys.append(((command.name, nick), command.user_cooldown))
+        if command.channel_cooldown and channel is not None:
+            keys.append(((command.name, channel), command.channel_cooldown))
+        for key, _ in keys:
+            if cooldowns.get(key, 0) > now:
+                return True
+        for key, delay in keys:
+            cooldowns[key] = now + delay
+        if len(cooldowns) > self._expired_check:
+            # forget the cooldowns over, once their number doubled
+            for key, until in cooldowns.items():
+                if until <= now:
+                    del cooldowns[key]
+            self._expired_check = 2 * len(cooldowns) + 64
+        return False
+
+    def __call__(self, client, msg):
+        nick = msg.prefix_parts[0]
+        target = msg.params[0]
+        fold = tracker.fold
+        if client.tracker is not None:
+            fold = client.tracker.fold
+        direct = fold(target) == fold(client.nick)
+        # received params are split on spaces
+        words = ' '.join(msg.params[1:]).split()
+        if not words or nick is None:
+            return
+        name = words[0]
+        if name.startswith(self.prefix):
+            name = name[len(self.prefix):]
+        elif not direct:
+            return
+        command = self.lookup(name)
+        if command is None:
+            return
+        channel = None if direct else fold(target)
+        # before any reply, malformed commands must not flood either
+        if self._cooldown(command, fold(nick), channel, time.time()):
+            client.stats['command_cooldown'] += 1
+            return
+        try:
+            args = command.parse(words[1:])
+        except CommandError as e:
+            if self.reply_usage:
+                reply_to = nick if direct else target
+                client.msg(reply_to, '%s (usage: %s)' % (e, command.usage(self.prefix)))
+            return
+        client.stats['commands'] += 1
+        call = functools.partial(command.func, **args)
+        if command.blocking:
+            client._call_handlers((), (call,), msg)
+        else:
+            client._call_handlers((call,), (), msg)
+
 
 class PeriodicMessage(object):
-    """ Send a message every interval or `wait`
-    !!! gevent 1.0 only !!!
+    """ Send `msg` to `channel` every `wait` seconds, up to `jitter` random
+    seconds later, from the welcome message on. The job of each client
+    (in `jobs`) is kept by the client `timers` so it pauses while the
+    client reconnects, the ticks missed meanwhile are skipped by default
+    (see `missed`). The job is dropped when the client is stopped.
     """
-    
+
+    blocking = False
     commands = ['001']
 
-    def __init__(self, channel, msg='hello', wait=1.0):
+    def __init__(self, channel, msg='hello', wait=1.0, jitter=0, missed=schedule.SKIP):
         self.channel = channel
-        self.msg = 'hello'
+        self.msg = msg
         self.wait = wait
+        self.jitter = jitter
+        self.missed = missed
+        self.jobs = {}
 
-    def start(self, client, msg):
-        self.client = client
-        self._schedule()
-
-    def _schedule(self):
-        timer = gevent.get_hub().loop.timer(self.wait) #@UndefinedVariable
-        timer.start(self.__call__)
-
-    def run(self):
-        self.client.msg(self.channel, self.msg)
-    
-    def __call__(self):
-        gevent.spawn(self.run)
-        self._schedule()
-
+    def __call__(self, client, msg):
+        if client not in self.jobs:
+            self.jobs[client] = client.timers.call_every(self.wait, client.msg,
+                    self.channel, self.msg, jitter=self.jitter, missed=self.missed)
+            client.add_state_handler(self._state_changed)
+
+    def _state_changed(self, client, old, new):
+        # irc imports this module
+        from geventirc.irc import CLOSED
+        if new == CLOSED:
+            self.cancel(client)
+
+    def cancel(self, client=None):
+        """ Stop sending the message from `client`, or from every client.
+        """
+        clients = [client] if client is not None else list(self.jobs)
+        for client in clients:
+            job = self.jobs.pop(client, None)
+            if job is not None:
+                job.cancel()
+                client.remove_state_handler(self._state_changed)
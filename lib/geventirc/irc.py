@@ -1,6 +1,9 @@
 from __future__ import absolute_import
 
 import logging
+import random
+import time
+from collections import Counter
 
 import gevent.queue
 import gevent.pool
@@ -9,61 +12,348 @@ from gevent import socket
 from geventirc import message
 from geventirc import replycode
 from geventirc import handlers
+from geventirc import framer
+from geventirc import dispatch
+from geventirc import flood
+from geventirc import resolver
+from geventirc import tls
+from geventirc import cap
+from geventirc import tracker
+from geventirc import routing
+from geventirc import schedule
 
 IRC_PORT = 6667
 IRCS_PORT = 6697
+HANDLER_POOL_SIZE = 100
+RECV_QUEUE_SIZE = 1000
+SEND_BATCH_BYTES = 8192
+SEND_BATCH_MESSAGES = 64
+
+# What to do with an incoming message when the receive queue is full
+BLOCK = 'block'                 # stop reading from the socket
+DROP_OLDEST = 'drop_oldest'     # make room by dropping the oldest message
+DROP_COMMAND = 'drop_command'   # drop it if its command is droppable, else block
+
+# Connection states
+CONNECTING = 'connecting'       # opening the socket
+REGISTERING = 'registering'     # connected, waiting for the welcome (001)
+CONNECTED = 'connected'         # registered
+BACKOFF = 'backoff'             # waiting before reconnecting
+CLOSED = 'closed'               # not started or stopped
+
+RECONNECT_DELAY = 1
+RECONNECT_MAX_DELAY = 300
+REGISTRATION_TIMEOUT = 60
+
+# Commands queued before a connection which are part of the registration,
+# sent at once rather than after the welcome.
+REGISTRATION_COMMANDS = frozenset(['PASS', 'CAP', 'NICK', 'USER'])
 
 module_logger = logging.getLogger(__name__)
 
+
+@handlers.inline
+def _welcome_handler(client, msg):
+    client._welcomed()
+
+
+@handlers.inline
+def _cap_handler(client, msg):
+    client.caps.handle(client, msg)
+
+
+@handlers.inline
+def _tracker_handler(client, msg):
+    if client.tracker is not None:
+        client.tracker.handle(client, msg)
+
+
+# the client own handlers, called even for the messages of aggregated batches
+_INTERNAL_HANDLERS = frozenset((_welcome_handler, _cap_handler, _tracker_handler))
+
+
 class Client(object):
+    """ IRC client connection.
 
-    def __init__(self, hostname, nick, port=IRC_PORT,
-            local_hostname=None, server_name=None, real_name=None, ssl=False, logger=None):
+    Received messages are handled by the handlers registered with
+    `add_handler` and `add_route`, from a receive queue of
+    `recv_queue_size` messages or, when it is 0, from the receive loop
+    itself. Sent messages wait in a `flood.SendQueue`, with flood control
+    if `flood_rate` is set. The connection goes through the CONNECTING,
+    REGISTERING and CONNECTED states and is opened again after a backoff
+    when it is lost, see `reconnect`. IRCv3 capabilities (`caps`), state
+    tracking (`track_state`), TLS (`ssl`) and timers (`timers`) are
+    implemented by the cap, tracker, tls and schedule modules. What
+    happened to the connection is counted in `stats`.
+
+    The handler registry (`dispatcher`), the pool of blocking handlers
+    (`handler_pool`) and the greenlet sending messages (`scheduler`) can
+    be shared between clients, see `pool.ClientPool`.
+    """
+
+    def __init__(self, hostname, nick, port=None,
+            local_hostname=None, server_name=None, real_name=None, ssl=False, logger=None,
+            recv_size=framer.RECV_SIZE, max_line_length=framer.MAX_LINE_LENGTH,
+            inline_handlers=False, handler_pool_size=HANDLER_POOL_SIZE,
+            recv_queue_size=RECV_QUEUE_SIZE, send_queue_size=None,
+            overflow_policy=BLOCK, droppable_commands=('PRIVMSG', 'NOTICE'),
+            send_batch_bytes=SEND_BATCH_BYTES, send_batch_messages=SEND_BATCH_MESSAGES,
+            flood_rate=None, flood_burst=5, flood_fair=False, encode_cache_size=0,
+            dispatcher=None, handler_pool=None, scheduler=None, auto_reconnect=True,
+            reconnect_delay=RECONNECT_DELAY, reconnect_max_delay=RECONNECT_MAX_DELAY,
+            reconnect_jitter=0, registration_timeout=REGISTRATION_TIMEOUT,
+            journal_size=100, journal_ttl=60,
+            journal_commands=flood.JOURNAL_COMMANDS, fallback_servers=(),
+            connect_timeout=resolver.CONNECT_TIMEOUT, attempt_delay=resolver.ATTEMPT_DELAY,
+            address_cache=None, ssl_context=None, caps=(), aggregate_batches=(),
+            track_state=False):
         self.hostname = hostname
+        self.ssl = ssl or ssl_context is not None
+        self.ssl_context = ssl_context
+        self._tls_sessions = {}
+        if port is None:
+            port = IRCS_PORT if self.ssl else IRC_PORT
         self.port = port
+        self.fallback_servers = fallback_servers
+        self.connect_timeout = connect_timeout
+        self.attempt_delay = attempt_delay
+        self.address_cache = address_cache
         self.nick = nick
-        self.ssl = ssl
         self._socket = None
+        self._framer = framer.LineFramer(recv_size, max_line_length)
         self.real_name = real_name or nick
         self.local_hostname = local_hostname or socket.gethostname() #@UndefinedVariable
         self.server_name = server_name or 'gevent-irc'
-        self._recv_queue = gevent.queue.Queue()
-        self._send_queue = gevent.queue.Queue()
+        self._recv_queue = None
+        if recv_queue_size != 0:
+            self._recv_queue = gevent.queue.Queue(recv_queue_size)
+        self._send_queue = flood.SendQueue(send_queue_size, fair=flood_fair)
+        self._bucket = None
+        if flood_rate:
+            self._bucket = flood.TokenBucket(flood_rate, flood_burst)
+        self.overflow_policy = overflow_policy
+        self.droppable_commands = frozenset(droppable_commands)
+        self.send_batch_bytes = send_batch_bytes
+        self.send_batch_messages = send_batch_messages
+        self.stats = Counter()
+        self.journal = flood.Journal(journal_size, journal_ttl, journal_commands)
+        self.encode_cache = None
+        if encode_cache_size:
+            self.encode_cache = message.EncodeCache(encode_cache_size)
+        self.auto_reconnect = auto_reconnect
+        self.reconnect_delay = reconnect_delay
+        self.reconnect_max_delay = reconnect_max_delay
+        self.reconnect_jitter = reconnect_jitter
+        self.registration_timeout = registration_timeout
+        self._registration = None
+        self._held = []
+        self.state = CLOSED
+        self._state_handlers = []
+        self._attempts = 0
+        self._reconnector = None
         self._group = gevent.pool.Group()
-        self._handlers = {}
-        self._global_handlers = set()
+        self._own_pool = handler_pool is None
+        self._pool = handler_pool
+        if self._own_pool:
+            self._pool = gevent.pool.Pool(handler_pool_size)
+        self.timers = schedule.Scheduler(self._pool, logger or module_logger, paused=True)
+        self._dispatcher = dispatcher
+        if dispatcher is None:
+            self._dispatcher = dispatch.Dispatcher(inline=inline_handlers)
+        self._scheduler = scheduler
+        if _welcome_handler not in self._dispatcher.get('001')[0]:
+            self._dispatcher.add(_welcome_handler, '001')
+        if _cap_handler not in self._dispatcher.get('CAP')[0]:
+            self._dispatcher.add(_cap_handler, 'CAP', replycode.ERR_UNKNOWNCOMMAND)
+        self.caps = cap.Capabilities(caps)
+        self._batches = {}
+        self.aggregate_batches = frozenset(aggregate_batches)
+        self.tracker = None
+        if track_state:
+            self.tracker = tracker.StateTracker()
+            if _tracker_handler not in self._dispatcher.get('JOIN')[0]:
+                self._dispatcher.add(_tracker_handler, *tracker.StateTracker.commands)
         self.channels = set()
         self.logger = logger or module_logger
 
     def add_handler(self, to_call, *commands):
-        if not commands:
-            if hasattr(to_call, 'commands'):
-                commands = to_call.commands
-            else:
-                self._global_handlers.add(to_call)
-                return
+        """ Register `to_call` for `commands`, or for its `commands`
+        attribute, or for every message if it has none. Without
+        `commands`, a handler with a `route` attribute is registered with
+        `add_route`.
 
-        for command in commands:
-            command = str(command).upper()
-            if self._handlers.has_key(command):
-                self._handlers[command].add(to_call)
-                continue
-            self._handlers[command] = set([to_call])
+        Handlers with a false `blocking` attribute (see `handlers.inline`)
+        are called directly by the process loop, in registration order.
+        Others are run in the bounded handler pool, unless the client was
+        created with `inline_handlers` and they are not marked `blocking`.
+        """
+        if not commands and getattr(to_call, 'route', None) is not None:
+            self.add_route(to_call)
+        else:
+            self._dispatcher.add(to_call, *commands)
+
+    def remove_handler(self, to_call, *commands):
+        if not commands and getattr(to_call, 'route', None) is not None:
+            self.remove_route(to_call)
+        else:
+            self._dispatcher.remove(to_call, *commands)
+
+    def add_route(self, to_call, route=None):
+        """ Call `to_call` for the PRIVMSGs matching `route`, by default its
+        `route` attribute (see `routing.Route`). The routes are evaluated
+        once per message for all the handlers.
+        """
+        routing.add_route(self._dispatcher, to_call, route or to_call.route)
+
+    def remove_route(self, to_call):
+        routing.remove_route(self._dispatcher, to_call)
+
+    def add_state_handler(self, to_call):
+        """ Call `to_call(client, old_state, new_state)` when the connection
+        state changes.
+        """
+        if to_call not in self._state_handlers:
+            self._state_handlers.append(to_call)
+
+    def remove_state_handler(self, to_call):
+        self._state_handlers.remove(to_call)
+
+    def _set_state(self, state):
+        """ Change the state and call the state handlers. The `timers` only
+        run while CONNECTED.
+        """
+        old = self.state
+        if old == state:
+            return
+        self.state = state
+        self.logger.debug('Connection state: %s -> %s', old, state)
+        if state == CONNECTED:
+            self.timers.resume()
+        elif old == CONNECTED:
+            self.timers.pause()
+        for handler in list(self._state_handlers):
+            try:
+                handler(self, old, state)
+            except Exception:
+                self.logger.exception('State handler %r failed', handler)
+
+    def _welcomed(self):
+        self.caps.negotiating = False
+        if self.state == REGISTERING:
+            self._attempts = 0
+            self._cancel_registration_timeout()
+            self._set_state(CONNECTED)
+            held, self._held = self._held, []
+            for data, target, _, command in held:
+                self._send_queue.put(data, command, target)
+            if held and self._scheduler is not None:
+                self._scheduler.notify(self)
+            if self.journal:
+                # after the other welcome handlers, which join the channels
+                self._group.spawn(self._replay_journal)
+
+    def _keep(self, items):
+        kept, dropped = self.journal.keep(items)
+        self.stats['journal_kept'] += kept
+        self.stats['journal_dropped'] += dropped
+
+    def _replay_journal(self):
+        """ Queue the messages kept in `journal` (see `flood.Journal`),
+        those queued more than `journal_ttl` seconds before are dropped.
+        Messages which failed to be sent are kept too, so they may be
+        received twice.
+        """
+        items, dropped = self.journal.replay()
+        self.stats['journal_dropped'] += dropped
+        self.stats['journal_replayed'] += len(items)
+        for data, target, _, command in items:
+            self._send_queue.put(data, command, target)
+        if items and self._scheduler is not None:
+            self._scheduler.notify(self)
 
     def _handle(self, msg):
-        handlers = self._global_handlers | self._handlers.get(msg.command, set())
-        if handlers is not None:
-            for handler in handlers:
-                self._group.spawn(handler, self, msg)
+        inline, blocking = self._dispatcher.get(msg.command)
+        self._call_handlers(inline, blocking, msg)
+
+    def _call_handlers(self, inline, blocking, msg):
+        for handler in inline:
+            try:
+                handler(self, msg)
+            except Exception:
+                self.logger.exception('Handler %r failed', handler)
+        if blocking:
+            if self._pool.full():
+                self.stats['pool_full'] += 1
+            spawn = self._pool.spawn
+            for handler in blocking:
+                spawn(handler, self, msg)
 
-    def send_message(self, msg):
-        self._send_queue.put(msg.encode())
+    def send_message(self, msg, lane=None):
+        """ Queue `msg` in the given lane (flood.CONTROL, INTERACTIVE or
+        BULK), by default the lane of its command. This blocks while
+        `send_queue_size` messages are waiting. Until the client is
+        registered, the commands of `journal_commands` wait in the journal.
+        """
+        if self._send_queue.full():
+            self.stats['send_blocked'] += 1
+        target = None
+        if isinstance(msg.params, list) and msg.params:
+            target = msg.params[0]
+        if self.encode_cache is None:
+            data = msg.encode()
+        else:
+            data = self.encode_cache.encode(msg)
+        if self.state in (CONNECTING, REGISTERING) and msg.command in self.journal.commands:
+            # sent once registered, as the messages kept while reconnecting
+            self._keep([(data, target, time.time(), msg.command)])
+            return
+        self._send_queue.put(data, msg.command, target, lane)
+        if self._scheduler is not None:
+            self._scheduler.notify(self)
 
     def start(self):
+        try:
+            self._start()
+        except Exception:
+            self._set_state(CLOSED)
+            raise
+
+    def _hold(self, items):
+        """ Keep the queued `items` until the client is registered, except
+        the registration commands which are queued again at once.
+        """
+        journal, registration = [], []
+        for item in items:
+            command = item[3]
+            if command in self.journal.commands:
+                journal.append(item)
+            elif command in REGISTRATION_COMMANDS:
+                registration.append(item)
+            else:
+                self._held.append(item)
+        self._keep(journal)
+        for data, target, _, command in registration:
+            self._send_queue.put(data, command, target)
+
+    def _start(self):
+        # messages queued meanwhile wait for the registration too
+        self._hold(self._send_queue.drain())
+        self._set_state(CONNECTING)
         self.connect()
-        self._group.spawn(self._send_loop)
-        self._group.spawn(self._process_loop)
+        self._set_state(REGISTERING)
+        if self.registration_timeout:
+            self._registration = gevent.spawn_later(self.registration_timeout,
+                    self._registration_expired)
+        if self._scheduler is None:
+            self._group.spawn(self._send_loop)
+        if self._recv_queue is not None:
+            self._group.spawn(self._process_loop)
         self._group.spawn(self._recv_loop)
+        self._batches.clear()
+        if self.tracker is not None:
+            self.tracker.clear()
+        if self.caps.wanted:
+            self.caps.start(self)
         self.send_message(message.Nick(self.nick))
         self.send_message(
                 message.User(
@@ -73,67 +363,249 @@ class Client(object):
                     self.real_name))
 
     def connect(self):
-        address = None
+        """ Connect to `hostname` or one of `fallback_servers`, resolved
+        concurrently and cached in `address_cache`, see
+        `resolver.create_connection`. With `ssl` the connection uses TLS.
+        """
+        servers = [(self.hostname, self.port)] + list(self.fallback_servers)
+        self.logger.debug('Connecting to %r...', servers)
+        sock, (hostname, _) = resolver.create_connection(servers, self.connect_timeout,
+                self.attempt_delay, self.address_cache, self.logger)
+        if self.ssl:
+            sock = self._start_tls(sock, hostname)
+        self._socket = sock
+        self.logger.debug('Connection established with %r', sock.getpeername())
+
+    def _start_tls(self, sock, hostname):
+        """ Wrap `sock` with `ssl_context`, by default `tls.default_context`,
+        resuming the last session with `hostname` if possible.
+        """
+        context = self.ssl_context or tls.default_context()
         try:
-            address = (socket.gethostbyname(self.hostname), self.port)
-        except socket.gaierror: #@UndefinedVariable
-            self.logger.error('Hostname not found')
+            sock = tls.wrap(sock, context, hostname,
+                    self._tls_sessions.get(hostname), self.connect_timeout)
+        except Exception:
+            sock.close()
             raise
-        self.logger.debug('Connecting to %r...', address)
-        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM) #@UndefinedVariable
-        if self.ssl:
-            self._socket = gevent.ssl.SSLSocket(self._socket)
-        self._socket.connect(address)
-        self.logger.debug('Connection established')
+        if tls.session_reused(sock):
+            self.stats['tls_resumed'] += 1
+        self._tls_sessions[hostname] = tls.session(sock)
+        return sock
 
     def _recv_loop(self):
-        buf = ''
+        framer = self._framer
+        framer.clear()
+        dropped = framer.dropped
+        if self._recv_queue is None:
+            enqueue = self._process
+        else:
+            enqueue = self._enqueue
         while 1:
             try:
-                data = self._socket.recv(512)
+                lines = framer.recv_from(self._socket)
             except gevent.GreenletExit:
                 raise
             except Exception as e:
                 self.logger.exception("Disconnected from IRC: %s %s", type(e).__name__, str(e))
-                gevent.spawn(self.reconnect)
-            buf += data
-            pos = buf.find("\r\n")
-            while pos >= 0:
-                line = buf[0:pos]
-                self._recv_queue.put(line)
-                buf = buf[pos + 2:]
-                pos = buf.find("\r\n")
+                self._connection_lost()
+                return
+            if lines is None:
+                self.logger.error("Disconnected from IRC: connection closed by server")
+                self._connection_lost()
+                return
+            if framer.dropped != dropped:
+                self.logger.warn('Dropped %d line(s) longer than %d bytes',
+                        framer.dropped - dropped, framer.max_line_length)
+                dropped = framer.dropped
+            for line in lines:
+                enqueue(message.LazyMessage(line))
+
+    def _enqueue(self, msg):
+        """ Queue `msg` for the process loop. When the queue is full,
+        `overflow_policy` tells whether to wait (BLOCK), drop the oldest
+        message (DROP_OLDEST) or drop `msg` if its command is one of
+        `droppable_commands` (DROP_COMMAND).
+        """
+        queue = self._recv_queue
+        if not queue.full():
+            queue.put_nowait(msg)
+            return
+        policy = self.overflow_policy
+        if policy == DROP_OLDEST:
+            queue.get_nowait()
+            queue.put_nowait(msg)
+            self.stats['recv_dropped_oldest'] += 1
+            return
+        if policy == DROP_COMMAND:
+            try:
+                command = msg.command
+            except message.ProtocolViolationError:
+                command = None
+            if command in self.droppable_commands:
+                self.stats['recv_dropped_command'] += 1
+                return
+        self.stats['recv_blocked'] += 1
+        queue.put(msg)
 
     def _send_loop(self):
+        """ Write the queued messages, as many at once as `send_batch_bytes`,
+        `send_batch_messages` and the flood control allow.
+        """
+        queue = self._send_queue
+        bucket = self._bucket
         while 1:
-            command = self._send_queue.get()
-            try:
-                enc_cmd = command.decode('utf8')
-            except UnicodeError:
-                try:
-                    enc_cmd = command.decode('latin1')
-                except UnicodeError:
-                    self.logger.warn('Send failed due to character conversion error')
-                    continue
-
-            enc_cmd = enc_cmd.encode('utf8', 'ignore')
-            self.logger.debug('send: %r', enc_cmd[:-2])
-            try:
-                self._socket.sendall(enc_cmd)
-            except Exception as e:
-                self.logger.exception("Client._send_loop failed")
-                gevent.spawn(self.reconnect)
+            queue.wait()
+            if bucket is not None:
+                self._throttle(bucket)
+            if not self._send_batch(self._take_batch()):
                 return
 
+    def _throttle(self, bucket):
+        delay = bucket.delay()
+        while delay:
+            self.stats['throttled'] += 1
+            gevent.sleep(delay)
+            delay = bucket.delay()
+
+    def _take_batch(self):
+        """ Pop the messages to send in one write, as many as the flood
+        control allows right now.
+        """
+        queue = self._send_queue
+        bucket = self._bucket
+        batch = []
+        size = 0
+        while queue and size < self.send_batch_bytes and \
+                len(batch) < self.send_batch_messages:
+            if bucket is not None and not bucket.take():
+                break
+            item = queue.get_nowait()
+            batch.append(item)
+            size += len(item[0])
+        return batch
+
+    def _send_batch(self, batch):
+        """ Write `batch` to the socket, return False if the connection
+        failed.
+        """
+        if not batch:
+            return True
+        data = [item[0] for item in batch]
+        if self.logger.isEnabledFor(logging.DEBUG):
+            for line in data:
+                self.logger.debug('send: %r', line[:-2])
+        try:
+            self._socket.sendall(''.join(data))
+        except Exception:
+            self.logger.exception("Client._send_loop failed")
+            self._keep(batch)
+            self._connection_lost()
+            return False
+
+        stats = self.stats
+        now = time.time()
+        for item in batch:
+            delay = now - item[2]
+            stats['queue_delay_total'] += delay
+            if delay > stats['queue_delay_max']:
+                stats['queue_delay_max'] = delay
+        stats['send_batches'] += 1
+        stats['sent_messages'] += len(batch)
+        return True
+
     def _process_loop(self):
         while 1:
-            data = self._recv_queue.get()
-            # self.logger.debug("Handling: %s", data)
-            msg = message.CTCPMessage.decode(data)
+            self._process(self._recv_queue.get())
+
+    def _process(self, msg):
+        try:
+            if self._batches or msg.command == 'BATCH':
+                msg = self._batch(msg)
+                if msg is None:
+                    return
             self._handle(msg)
+        except message.ProtocolViolationError:
+            self.logger.warn('Ignoring malformed message: %r', msg.raw)
+
+    def _batch(self, msg):
+        """ Keep `msg` in the batch it belongs to and return None, or return
+        the message to handle: `msg` itself or a batch just completed.
+        """
+        parent = None
+        if self._batches:
+            parent = self._batches.get(msg.tags.get('batch'))
+        if msg.command == 'BATCH':
+            reference = msg.params[0]
+            if reference.startswith('+'):
+                batch = message.Batch(reference[1:], msg.params[1:],
+                        prefix=msg.prefix, tags=msg.tags)
+                self._batches[batch.reference] = (batch, parent)
+                if parent is not None:
+                    parent[0].messages.append(batch)
+                return None
+            if reference.startswith('-'):
+                batch, parent = self._batches.pop(reference[1:], (None, None))
+                if parent is not None:
+                    # handled with the outer batch
+                    return None
+                if batch is not None:
+                    self._handle_batch(batch)
+                return batch
+        if parent is not None:
+            parent[0].messages.append(msg)
+            return None
+        return msg
+
+    def _handle_batch(self, batch, aggregated=False):
+        """ Handle the messages of `batch` one by one, only by the internal
+        handlers if its type is in `aggregate_batches` (such as 'netsplit'):
+        the other handlers only get the batch, as a `message.Batch` sent to
+        the BATCH handlers.
+        """
+        aggregated = aggregated or batch.type in self.aggregate_batches
+        for msg in batch.messages:
+            if isinstance(msg, message.Batch):
+                self._handle_batch(msg, aggregated)
+            elif aggregated:
+                inline = self._dispatcher.get(msg.command)[0]
+                self._call_handlers(
+                        [h for h in inline if h in _INTERNAL_HANDLERS], (), msg)
+            else:
+                self._handle(msg)
 
     def stop(self):
-        self._group.kill()
+        """ Close the connection for good, this can be called from a handler
+        or a state handler.
+        """
+        self._set_state(CLOSED)
+        current = gevent.getcurrent()
+        if self._reconnector is not None and self._reconnector is not current:
+            self._reconnector.kill()
+        self._reconnector = None
+        self._disconnect()
+        if self._own_pool:
+            gevent.killall([g for g in self._pool if g is not current])
+
+    def _registration_expired(self):
+        """ The connection is lost if the server does not welcome the client
+        within `registration_timeout` seconds.
+        """
+        self._registration = None
+        if self.state == REGISTERING:
+            self.logger.error("No welcome from the server after %s seconds",
+                    self.registration_timeout)
+            self._connection_lost()
+
+    def _cancel_registration_timeout(self):
+        registration = self._registration
+        self._registration = None
+        if registration is not None and registration is not gevent.getcurrent():
+            registration.kill(block=False)
+
+    def _disconnect(self):
+        self._cancel_registration_timeout()
+        current = gevent.getcurrent()
+        gevent.killall([g for g in self._group if g is not current])
         if self._socket is not None:
             try:
                 self._socket.shutdown(2)
@@ -142,25 +614,89 @@ class Client(object):
             self._socket.close()
             self._socket = None
 
-    def reconnect(self, delay=1, flush=True):
+    def reconnect(self, delay=None, flush=False, wait=True):
+        """ Close the connection and connect again after `delay` seconds,
+        by default the backoff delay. Queued messages are sent once
+        registered again, or dropped if `flush` is true. Wait until
+        connected again (or stopped) if `wait` is true.
+
+        Nothing more happens if the client is already reconnecting. This is
+        called when the connection is lost, unless `auto_reconnect` is
+        false.
+        """
+        if self.state != BACKOFF:
+            self._set_state(BACKOFF)
+            self._reconnector = gevent.spawn(self._reconnect, delay, flush)
+        if wait and self._reconnector is not None and \
+                self._reconnector is not gevent.getcurrent():
+            self._reconnector.join()
+
+    def _connection_lost(self):
+        if self.state in (BACKOFF, CLOSED):
+            return
+        if self.auto_reconnect:
+            self.reconnect(wait=False)
+        else:
+            self.stop()
+
+    def backoff_delay(self):
+        """ Seconds to wait before the next connection attempt:
+        `reconnect_delay` doubled after each attempt that did not get to the
+        welcome, up to `reconnect_max_delay`, plus up to `reconnect_jitter`
+        random seconds so that clients disconnected together do not come
+        back together.
+        """
+        delay = min(self.reconnect_max_delay,
+                self.reconnect_delay * 2 ** min(self._attempts, 32))
+        return delay + random.uniform(0, self.reconnect_jitter)
+
+    def _reconnect(self, delay, flush):
         self.logger.info("Shutdown for reconnect")
-        self.stop()
-        self.join()
+        self._disconnect()
         if flush:
-            self._send_queue.queue.clear()
-        gevent.sleep(delay)
-        self.start()
-        self.logger.info("Reconnected")
+            self.stats['journal_dropped'] += len(self._send_queue) + len(self._held)
+            self._send_queue.clear()
+            del self._held[:]
+        while 1:
+            if delay is None:
+                delay = self.backoff_delay()
+            self._attempts += 1
+            self.stats['reconnect_attempts'] += 1
+            self.logger.info("Reconnecting in %.1f seconds", delay)
+            gevent.sleep(delay)
+            delay = None
+            try:
+                # not start, the client is not closed in between
+                self._start()
+            except Exception:
+                self.logger.exception("Reconnection to %s failed", self.hostname)
+                self._set_state(BACKOFF)
+            else:
+                self.logger.info("Reconnected")
+                self.stats['reconnects'] += 1
+                break
+        self._reconnector = None
 
     def join(self):
-        self._group.join()
+        while 1:
+            self._group.join()
+            reconnector = self._reconnector
+            if reconnector is None:
+                break
+            reconnector.join()
 
-    def msg(self, to, content):
+    def msg(self, to, content, lane=None):
         for line in content.strip().split('\n'):
-            self.send_message(message.PrivMsg(to, line))
+            self.send_message(message.PrivMsg(to, line), lane)
 
-    def quit(self, msg=None):
+    def quit(self, msg=None, timeout=5):
+        """ Send QUIT and stop once it is sent, or after `timeout` seconds.
+        """
+        self._set_state(CLOSED)
         self.send_message(message.Quit(msg))
+        with gevent.Timeout(timeout, False):
+            while self._send_queue and self._socket is not None:
+                gevent.sleep(0.05)
         self.stop()
 
 
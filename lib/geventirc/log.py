@@ -3,20 +3,100 @@ Created on 10.11.2012
 
 @author: nimrod
 '''
+import collections
 import logging
+import time
+
+import gevent
+
+from geventirc import flood
+from geventirc import handlers
+from geventirc import irc
+from geventirc import message
 
 
 class IRCLogHandler(logging.Handler):
     """ Dumps usual log output to some IRC channel
+
+    Records are only queued by `emit`, up to `capacity` records, and sent
+    by a greenlet every `interval` seconds in the bulk lane. At most
+    `burst` records are sent each time, the others are summed up by level
+    ("37 more ERRORs in the last 5s", since the oldest of them), as are
+    the records dropped because the queue was full. Only the first line
+    of a record is sent. Nothing is sent while the client is not
+    connected, the records wait in the queue.
     """
-    
-    def __init__(self, client, channel, level=logging.NOTSET):
+
+    def __init__(self, client, channel, level=logging.NOTSET, capacity=1000,
+            interval=5, burst=5, lane=flood.BULK):
         logging.Handler.__init__(self, level=level)
         self.client = client
         self.channel = channel
-        self.client.join_channel(self.channel)
+        self.capacity = capacity
+        self.interval = interval
+        self.burst = burst
+        self.lane = lane
+        self._records = collections.deque()
+        self._dropped = collections.Counter()
+        self._since = None
+        self.client.add_handler(handlers.JoinHandler(self.channel))
+        if self.client.state == irc.CONNECTED:
+            self.client.send_message(message.Join(self.channel))
+        self._sender = gevent.spawn(self._send_loop)
 
     def emit(self, record):
-        self.client.msg(self.channel, self.format(record))
+        """ Queue `record`, never blocks.
+        """
+        if self._since is None:
+            self._since = record.created
+        if len(self._records) >= self.capacity:
+            self._dropped[record.levelname] += 1
+            return
+        try:
+            line = self.format(record).split('\n', 1)[0]
+        except Exception:
+            self.handleError(record)
+            return
+        if not line.strip():
+            return
+        self._records.append((record.levelname, line))
+
+    def _send_loop(self):
+        while 1:
+            gevent.sleep(self.interval)
+            self._flush()
+
+    def flush(self):
+        """ Nothing to do: records are sent by the sender greenlet, not by
+        the caller (logging.shutdown calls this).
+        """
 
+    def _flush(self):
+        """ Send the queued records, `burst` at most, and the summary of
+        the others, if the client is connected.
+        """
+        if self.client.state != irc.CONNECTED:
+            return
+        records = self._records
+        skipped = self._dropped
+        since = self._since
+        self._dropped = collections.Counter()
+        self._since = None
+        sent = 0
+        while records:
+            level, line = records.popleft()
+            if sent < self.burst:
+                self.client.msg(self.channel, line, self.lane)
+                sent += 1
+            else:
+                skipped[level] += 1
+        if skipped:
+            counts = ', '.join('%d more %ss' % (count, level)
+                    for level, count in sorted(skipped.items()))
+            elapsed = round(time.time() - since, 1)
+            self.client.msg(self.channel, '%s in the last %gs' % (counts, elapsed),
+                    self.lane)
 
+    def close(self):
+        self._sender.kill(block=False)
+        logging.Handler.close(self)
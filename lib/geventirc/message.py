@@ -1,3 +1,5 @@
+import re
+
 DELIM = chr(040)
 INVALID_CHARS = ["\r", "\n", "\0"]
 CR = "\r"
@@ -7,6 +9,9 @@ X_DELIM = chr(001)
 X_QUOTE = chr(134)
 M_QUOTE = chr(020)
 
+# Encoding of unicode messages on the wire, byte strings are sent as is.
+ENCODING = 'utf8'
+
 _low_level_quote_table = {
     NUL: M_QUOTE + '0',
     NL: M_QUOTE + 'n',
@@ -19,8 +24,18 @@ _ctcp_quote_table = {
     X_QUOTE: X_QUOTE * 2
 }
 
+# IRCv3 message tag values
+_tag_quote_table = {
+    ';': '\\:',
+    DELIM: '\\s',
+    '\\': '\\\\',
+    CR: '\\r',
+    NL: '\\n',
+}
+
 _low_level_dequote_table = dict((v, k) for k, v in _low_level_quote_table.items())
 _ctcp_dequote_table = dict((v, k) for k, v in _ctcp_quote_table.items())
+_tag_dequote_table = dict((v, k) for k, v in _tag_quote_table.items())
 
 
 class ProtocolViolationError(StandardError):
@@ -34,54 +49,90 @@ def is_valid_param(param):
     return True
 
 
-def _quote(string, table):
-    cursor = 0
-    buf = ''
-    for pos, char in enumerate(string):
-        if pos is 0:
-            continue
-        if char in table:
-            buf += string[cursor:pos] + table[char]
-            cursor = pos + 1
-    buf += string[cursor:]
-    return buf
+def _quoter(table):
+    """ Return a function quoting the characters of `table` in a single
+    regex pass, strings without any of them are returned as is.
+    """
+    chars = tuple(table)
+    sub = re.compile('[%s]' % re.escape(''.join(chars))).sub
 
+    def replace(match):
+        return table[match.group()]
 
-def _dequote(string, table):
-    cursor = 0
-    buf = ''
-    last_char = ''
-    for pos, char in enumerate(string):
-        if pos is 0:
-            last_char = char
-            continue
-        if last_char + char in table:
-            buf += string[cursor:pos] + table[char]
-            cursor = pos + 1
-        last_char = char
+    def quote(string):
+        for char in chars:
+            if char in string:
+                return sub(replace, string)
+        return string
+    return quote
 
-    buf += string[cursor:]
-    return buf
 
+def _dequoter(table):
+    """ Return a function undoing the quoting of `table`. A quote character
+    followed by an unknown one is dropped, as required by the CTCP spec.
+    """
+    quote_char = table.keys()[0][0]
+    unquoted = dict((k[1], v) for k, v in table.items())
+    sub = re.compile(re.escape(quote_char) + '(.?)', re.S).sub
 
-def low_level_quote(string):
-    return _quote(string, _low_level_quote_table)
+    def replace(match):
+        char = match.group(1)
+        return unquoted.get(char, char)
 
-def low_level_dequote(string):
-    return _dequote(string, _low_level_dequote_table)
+    def dequote(string):
+        if quote_char not in string:
+            return string
+        return sub(replace, string)
+    return dequote
 
-def ctcp_quote(string):
-    return _quote(string, _ctcp_quote_table)
 
-def ctcp_dequote(string):
-    return _dequote(string, _ctcp_dequote_table)
+low_level_quote = _quoter(_low_level_quote_table)
+low_level_dequote = _dequoter(_low_level_dequote_table)
+ctcp_quote = _quoter(_ctcp_quote_table)
+ctcp_dequote = _dequoter(_ctcp_dequote_table)
+tag_quote = _quoter(_tag_quote_table)
+tag_dequote = _dequoter(_tag_dequote_table)
 
 
-def irc_split(data):
+def _split_tags(data):
+    """ return tuple(<unparsed tags>, <rest of the line>) of a line starting
+    with @
+    """
+    try:
+        tags, buf = data[1:].split(DELIM, 1)
+    except ValueError:
+        raise ProtocolViolationError('no command received: %r' % data)
+    return tags, buf
+
+
+def parse_tags(data):
+    """ Return the dict of IRCv3 message tags from the tags part of a line
+    (without the @). Tags without a value are mapped to ''.
+    """
+    tags = {}
+    for tag in data.split(';'):
+        if not tag:
+            continue
+        key, _, value = tag.partition('=')
+        tags[key] = tag_dequote(value)
+    return tags
+
+
+def unparse_tags(tags):
+    parts = []
+    for key, value in sorted(tags.items()):
+        if value is None or value == '':
+            parts.append(key)
+        else:
+            parts.append(key + '=' + tag_quote(value))
+    return ';'.join(parts)
+
+
+def _split_command(data):
+    """ return tuple(<prefix>, <command>, <unparsed params>)
+    """
     prefix = ''
     buf = data
-    trailing = None
-    command = None
 
     if buf.startswith(':'):
         try:
@@ -92,6 +143,11 @@ def irc_split(data):
         command, buf = buf.split(DELIM, 1)
     except ValueError:
         raise ProtocolViolationError('no command received: %r' % buf)
+    return prefix, command, buf
+
+
+def _split_params(buf):
+    trailing = None
     if buf.startswith(':'):
         params = [buf[1:]]
     else:
@@ -102,11 +158,38 @@ def irc_split(data):
         params = buf.split(DELIM)
         if trailing is not None:
             params.append(trailing)
-    return prefix, command, params
+    return params
+
+
+def irc_split(data):
+    """ return tuple(<prefix>, <command>, <params>), ignoring message tags
+    """
+    if data.startswith('@'):
+        data = _split_tags(data)[1]
+    prefix, command, buf = _split_command(data)
+    return prefix, command, _split_params(buf)
+
+
+def irc_split_tags(data):
+    """ return tuple(<tags dict>, <prefix>, <command>, <params>)
+    """
+    tags = {}
+    if data.startswith('@'):
+        tags, data = _split_tags(data)
+        tags = parse_tags(tags)
+    prefix, command, buf = _split_command(data)
+    return tags, prefix, command, _split_params(buf)
 
 
-def irc_unsplit(prefix, command, params):
+def irc_unsplit(prefix, command, params, tags=None):
+    """ Return the line of a message, `tags` being a dict or the tags part
+    of a received line.
+    """
     buf = ''
+    if tags:
+        if not isinstance(tags, basestring):
+            tags = unparse_tags(tags)
+        buf += '@' + tags + DELIM
     if prefix:
         buf += ':' + prefix + DELIM
     buf += command + DELIM
@@ -126,6 +209,14 @@ def irc_unsplit(prefix, command, params):
     return buf.strip()
 
 
+def encode_line(line):
+    """ Return `line` as bytes terminated by CR LF.
+    """
+    if isinstance(line, unicode):
+        line = line.encode(ENCODING)
+    return line + "\r\n"
+
+
 def prefix_split(prefix):
     """ return tuple(<servername/nick>, <user agent>, <host>)
     """
@@ -145,66 +236,116 @@ def prefix_split(prefix):
     return server_name, user, host
 
 
+def ctcp_split(params):
+    """ return tuple(<normal params>, <list of (tag, data) extended messages>)
+    """
+    extended_messages = []
+    normal_messages = []
+    if params:
+        params = DELIM.join(params)
+        decoded = low_level_dequote(params)
+        messages = decoded.split(X_DELIM)
+        messages.reverse()
+
+        odd = False
+
+        while messages:
+            message = messages.pop()
+            if odd:
+                if message:
+                    ctcp_decoded = ctcp_dequote(message)
+                    split = ctcp_decoded.split(DELIM, 1)
+                    tag = split[0]
+                    data = None
+                    if len(split) > 1:
+                        data = split[1]
+                    extended_messages.append((tag, data))
+            else:
+                if message:
+                    normal_messages += filter(None, message.split(DELIM))
+            odd = not odd
+    return normal_messages, extended_messages
+
 
 class Message(object):
+    """ Messages use __slots__ to keep retained messages small, subclasses
+    must define __slots__ too.
+
+    `tags` are the IRCv3 message tags, a dict. Decoded messages keep the
+    tags part of the line as is until `tags` is first read.
+    """
+
+    __slots__ = ('prefix', 'command', 'params', '_prefix_parts', '_tags')
 
     @classmethod
     def decode(cls, data):
+        tags = None
+        if data.startswith('@'):
+            tags, data = _split_tags(data)
         prefix, command, params = irc_split(data)
-        return cls(command, params, prefix=prefix)
+        return cls(command, params, prefix=prefix, tags=tags)
 
-    def __init__(self, command, params, prefix=None):
+    def __init__(self, command, params, prefix=None, tags=None):
         assert command, 'command is mandatory'
         self.prefix = prefix
         self.command = command
         self.params = params
+        self._prefix_parts = None
+        self._tags = tags
+
+    @property
+    def tags(self):
+        tags = self._tags
+        if tags is None:
+            tags = self._tags = {}
+        elif isinstance(tags, basestring):
+            tags = self._tags = parse_tags(tags)
+        return tags
+
+    @tags.setter
+    def tags(self, tags):
+        self._tags = tags
 
     @property
     def prefix_parts(self):
-        return prefix_split(self.prefix)
+        prefix = self.prefix
+        cached = self._prefix_parts
+        if cached is None or cached[0] is not prefix:
+            cached = self._prefix_parts = (prefix, prefix_split(prefix))
+        return cached[1]
 
     def encode(self):
-        return irc_unsplit(self.prefix, self.command, self.params) + "\r\n"
+        return encode_line(irc_unsplit(self.prefix, self.command, self.params, self._tags))
+
+    def cache_key(self):
+        """ Return a hashable key identifying the encoded message, or None
+        if it should not be cached.
+        """
+        if self._tags:
+            # tags such as msgid make every message different
+            return None
+        params = self.params
+        if isinstance(params, list):
+            params = tuple(params)
+        return self.prefix, self.command, params
 
 
 class CTCPMessage(Message):
 
-    def __init__(self, command, params, ctcp_params, prefix=None):
-        super(CTCPMessage, self).__init__(command, params, prefix=prefix)
+    __slots__ = ('ctcp_params',)
+
+    def __init__(self, command, params, ctcp_params, prefix=None, tags=None):
+        super(CTCPMessage, self).__init__(command, params, prefix=prefix, tags=tags)
         self.ctcp_params = ctcp_params
 
     @classmethod
     def decode(cls, data):
+        tags = None
+        if data.startswith('@'):
+            tags, data = _split_tags(data)
         prefix, command, params = irc_split(data)
-        extended_messages = []
-        normal_messages = []
-        if params:
-            params = DELIM.join(params)
-            decoded = low_level_dequote(params)
-            messages = decoded.split(X_DELIM)
-            messages.reverse()
-
-            odd = False
-            extended_messages = []
-            normal_messages = []
-
-            while messages:
-                message = messages.pop()
-                if odd:
-                    if message:
-                        ctcp_decoded = ctcp_dequote(message)
-                        split = ctcp_decoded.split(DELIM, 1)
-                        tag = split[0]
-                        data = None
-                        if len(split) > 1:
-                            data = split[1]
-                        extended_messages.append((tag, data))
-                else:
-                    if message:
-                        normal_messages += filter(None, message.split(DELIM))
-                odd = not odd
-
-        return cls(command, normal_messages, extended_messages, prefix=prefix)
+        normal_messages, extended_messages = ctcp_split(params)
+        return cls(command, normal_messages, extended_messages, prefix=prefix, tags=tags)
 
     def encode(self):
         ctcp_buf = ''
@@ -217,13 +358,205 @@ class CTCPMessage(Message):
                 m = str(tag)
             ctcp_buf += X_DELIM + ctcp_quote(m) + X_DELIM
 
-        return irc_unsplit(
-                self.prefix, self.command, self.params + 
-                [low_level_quote(ctcp_buf)]) + "\r\n"
+        return encode_line(irc_unsplit(
+                self.prefix, self.command, self.params +
+                [low_level_quote(ctcp_buf)], self._tags))
+
+    def cache_key(self):
+        key = super(CTCPMessage, self).cache_key()
+        if key is None:
+            return None
+        return key + (tuple(self.ctcp_params),)
+
+
+class LazyMessage(CTCPMessage):
+    """ A CTCPMessage decoded on demand from a raw line.
+
+    Prefix and command are split on first access, params and ctcp params
+    only when one of them is accessed, so routing on `command` does not
+    pay for parameter and CTCP parsing. Tags are only parsed when `tags`
+    is accessed. Parsed fields are cached.
+    """
+
+    __slots__ = ('raw', '_rest')
+
+    # Parsed fields are cached in the slots of the parent classes, the
+    # public names are properties reading them.
+    _prefix = Message.prefix
+    _command = Message.command
+    _params = Message.params
+    _ctcp_params = CTCPMessage.ctcp_params
+
+    @classmethod
+    def decode(cls, data):
+        return cls(data)
+
+    def __init__(self, data):
+        self.raw = data
+        self._prefix = None
+        self._command = None
+        self._rest = None
+        self._params = None
+        self._ctcp_params = None
+        self._prefix_parts = None
+        self._tags = None
+
+    def _split_command(self):
+        data = self.raw
+        if data.startswith('@'):
+            self._tags, data = _split_tags(data)
+        self._prefix, self._command, self._rest = _split_command(data)
+
+    def _split_params(self):
+        if self._command is None:
+            self._split_command()
+        self._params, self._ctcp_params = ctcp_split(_split_params(self._rest))
+        self._rest = None
+
+    @property
+    def prefix(self):
+        if self._command is None:
+            self._split_command()
+        return self._prefix
+
+    @property
+    def command(self):
+        if self._command is None:
+            self._split_command()
+        return self._command
+
+    @property
+    def params(self):
+        if self._params is None:
+            self._split_params()
+        return self._params
+
+    @property
+    def ctcp_params(self):
+        if self._params is None:
+            self._split_params()
+        return self._ctcp_params
+
+    @property
+    def tags(self):
+        if self._command is None:
+            self._split_command()
+        return Message.tags.fget(self)
+
+    def encode(self):
+        return self.raw + "\r\n"
+
+    def cache_key(self):
+        return None
+
+
+class PreEncoded(Message):
+    """ A message encoded once, for replies sent again and again.
+    """
+
+    __slots__ = ('data',)
+
+    def __init__(self, msg):
+        super(PreEncoded, self).__init__(msg.command, msg.params, prefix=msg.prefix,
+                tags=msg._tags)
+        self.data = msg.encode()
+
+    def encode(self):
+        return self.data
+
+    def cache_key(self):
+        return None
+
+
+class Batch(Message):
+    """ The messages of an IRCv3 batch, received between BATCH +reference
+    and BATCH -reference, handled as a single BATCH message.
+
+    `params` are the batch type and its parameters, `messages` are the
+    messages of the batch in the order received, nested batches included
+    as Batch messages.
+    """
+
+    __slots__ = ('reference', 'messages')
+
+    def __init__(self, reference, params, prefix=None, tags=None):
+        super(Batch, self).__init__('BATCH', params, prefix=prefix, tags=tags)
+        self.reference = reference
+        self.messages = []
+
+    @property
+    def type(self):
+        return self.params[0] if self.params else None
+
+    def encode(self):
+        """ Return the line starting the batch.
+        """
+        return encode_line(irc_unsplit(self.prefix, self.command,
+                ['+' + self.reference] + list(self.params), self._tags))
+
+    def cache_key(self):
+        return None
+
+
+class EncodeCache(object):
+    """ Bounded cache of encoded messages keyed by `Message.cache_key`.
+
+    Entries are kept in two generations of at most `maxsize / 2` entries:
+    hits in the old generation are moved to the new one, and the old
+    generation is dropped when the new one is full. This approximates LRU
+    eviction with plain dict operations.
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._new = {}
+        self._old = {}
+
+    def __len__(self):
+        return len(self._new) + len(self._old)
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return total and float(self.hits) / total
+
+    def encode(self, msg):
+        try:
+            key = msg.cache_key()
+            data = self._new.get(key)
+        except TypeError:
+            # unhashable params
+            key = None
+        if key is None:
+            return msg.encode()
+        if data is not None:
+            self.hits += 1
+            return data
+
+        data = self._old.pop(key, None)
+        if data is None:
+            self.misses += 1
+            data = msg.encode()
+        else:
+            self.hits += 1
+        new = self._new
+        if len(new) >= max(1, self.maxsize // 2):
+            self._old = new
+            self._new = new = {}
+        new[key] = data
+        return data
+
+    def clear(self):
+        self._new.clear()
+        self._old.clear()
 
 
 class Command(Message):
 
+    __slots__ = ()
+
     def __init__(self, params, command=None, prefix=None):
         if command is None:
             command = self.__class__.__name__.upper()
@@ -236,6 +569,8 @@ class Command(Message):
 
 class Nick(Command):
 
+    __slots__ = ()
+
     def __init__(self, nickname, hopcount=None, prefix=None):
         params = [nickname]
         if hopcount is not None:
@@ -246,6 +581,8 @@ class Nick(Command):
 
 class User(Command):
 
+    __slots__ = ()
+
     def __init__(self, username, hostname, servername, realname, prefix=None):
         params = [username, hostname, servername, realname]
         super(User, self).__init__(params, prefix=prefix)
@@ -253,12 +590,16 @@ class User(Command):
 
 class PrivMsg(Command):
 
+    __slots__ = ()
+
     def __init__(self, to, msg, prefix=None):
         super(PrivMsg, self).__init__([to, msg], prefix=prefix)
 
 
 class Quit(Command):
 
+    __slots__ = ()
+
     def __init__(self, msg, prefix=None):
         params = None
         if msg is not None:
@@ -268,6 +609,8 @@ class Quit(Command):
 
 class Join(Command):
 
+    __slots__ = ()
+
     def __init__(self, channels, prefix=None):
         params = []
         if isinstance(channels, basestring):
@@ -292,18 +635,43 @@ class Join(Command):
 
 class Kick(Command):
 
+    __slots__ = ()
+
     def __init__(self, channel, victim, reason='', prefix=None):
         super(Kick, self).__init__([channel, victim, reason], prefix=prefix)
 
 
+class Cap(Command):
+
+    __slots__ = ()
+
+    def __init__(self, subcommand, caps=None, prefix=None):
+        params = [subcommand]
+        if caps is not None:
+            params.append(caps)
+        super(Cap, self).__init__(params, prefix=prefix)
+
+
+class Ping(Command):
+
+    __slots__ = ()
+
+    def __init__(self, server, prefix=None):
+        super(Ping, self).__init__(server, prefix=prefix)
+
+
 class Pong(Command):
-    
+
+    __slots__ = ()
+
     def __init__(self, daemon, prefix=None):
         super(Pong, self).__init__(daemon, prefix=prefix)
 
 
 class Me(CTCPMessage):
 
+    __slots__ = ()
+
     def __init__(self, to, action, prefix=None):
         super(Me, self).__init__(
                 'PRIVMSG', [to], [('ACTION', action)], prefix=prefix)
@@ -0,0 +1,207 @@
+""" Many client connections in one process.
+"""
+from __future__ import absolute_import
+
+import logging
+from collections import Counter, deque
+
+import gevent
+import gevent.pool
+from gevent.event import Event
+
+from geventirc import dispatch
+from geventirc import routing
+from geventirc.irc import Client, HANDLER_POOL_SIZE
+
+module_logger = logging.getLogger(__name__)
+
+
+class OutboundScheduler(object):
+    """ Schedule the queued messages of many clients from a single greenlet.
+
+    Clients notify the scheduler when they queue a message. Ready clients
+    are served round robin, one batch at a time, and a client held back
+    by its flood control is put aside on a timer instead of blocking the
+    others. Each batch is written by a greenlet of its client, a client
+    whose socket is stalled only holds back its own messages.
+    """
+
+    def __init__(self):
+        self._ready = deque()
+        self._scheduled = set()
+        self._writing = set()
+        self._timers = {}
+        self._event = Event()
+        self._greenlet = None
+
+    def start(self):
+        if self._greenlet is None:
+            self._greenlet = gevent.spawn(self._run)
+
+    def stop(self):
+        if self._greenlet is not None:
+            self._greenlet.kill()
+            self._greenlet = None
+        for timer in self._timers.values():
+            timer.stop()
+        self._timers.clear()
+
+    def notify(self, client):
+        if client in self._scheduled or client in self._timers or \
+                client in self._writing:
+            return
+        self._scheduled.add(client)
+        self._ready.append(client)
+        self._event.set()
+
+    def _wake(self, client):
+        del self._timers[client]
+        self.notify(client)
+
+    def _run(self):
+        ready = self._ready
+        while 1:
+            while not ready:
+                self._event.clear()
+                self._event.wait()
+            client = ready.popleft()
+            self._scheduled.discard(client)
+            if client._socket is None:
+                # not connected, start() notifies us again
+                continue
+            batch = client._take_batch()
+            if not batch:
+                continue
+            # killed with the other greenlets of the client on disconnect
+            self._writing.add(client)
+            writer = client._group.spawn(client._send_batch, batch)
+            writer.rawlink(lambda writer, client=client: self._written(client, writer))
+
+    def _written(self, client, writer):
+        self._writing.discard(client)
+        if writer.value is not True or not client._send_queue:
+            # failed or killed: the connection is lost
+            return
+        delay = client._bucket.delay() if client._bucket else 0
+        if delay:
+            client.stats['throttled'] += 1
+            timer = gevent.get_hub().loop.timer(delay) #@UndefinedVariable
+            self._timers[client] = timer
+            timer.start(self._wake, client)
+        else:
+            self.notify(client)
+
+
+class ClientPool(object):
+    """ Run many `Client` connections sharing one handler registry, one
+    bounded pool for blocking handlers and one outbound scheduler.
+
+    Clients handle messages from their receive loop (no receive queue)
+    and handlers are inline unless marked blocking, so an idle connection
+    only costs one greenlet. Clients are started `stagger` seconds apart
+    and wait up to `reconnect_jitter` extra seconds before reconnecting so
+    that a server restart does not get all of them back at once.
+    """
+
+    def __init__(self, handler_pool_size=HANDLER_POOL_SIZE, inline_handlers=True,
+            stagger=0.05, reconnect_jitter=5, logger=None):
+        self.dispatcher = dispatch.Dispatcher(inline=inline_handlers)
+        self.handler_pool = gevent.pool.Pool(handler_pool_size)
+        self.scheduler = OutboundScheduler()
+        self.stagger = stagger
+        self.reconnect_jitter = reconnect_jitter
+        self.clients = []
+        self.logger = logger or module_logger
+        self._group = gevent.pool.Group()
+
+    def __len__(self):
+        return len(self.clients)
+
+    def __iter__(self):
+        return iter(self.clients)
+
+    def add_handler(self, to_call, *commands):
+        """ Register a handler for every client of the pool, see
+        `Client.add_handler`.
+        """
+        if not commands and getattr(to_call, 'route', None) is not None:
+            self.add_route(to_call)
+        else:
+            self.dispatcher.add(to_call, *commands)
+
+    def remove_handler(self, to_call, *commands):
+        if not commands and getattr(to_call, 'route', None) is not None:
+            self.remove_route(to_call)
+        else:
+            self.dispatcher.remove(to_call, *commands)
+
+    def add_route(self, to_call, route=None):
+        """ Route PRIVMSGs to `to_call` for every client of the pool, see
+        `Client.add_route`.
+        """
+        routing.add_route(self.dispatcher, to_call, route or to_call.route)
+
+    def remove_route(self, to_call):
+        routing.remove_route(self.dispatcher, to_call)
+
+    def add_client(self, hostname, nick, **kwargs):
+        """ Create a client sharing the pool resources, `kwargs` are passed
+        to `Client`.
+        """
+        kwargs.setdefault('recv_queue_size', 0)
+        kwargs.setdefault('reconnect_jitter', self.reconnect_jitter)
+        kwargs.setdefault('logger', self.logger)
+        client = Client(hostname, nick,
+                dispatcher=self.dispatcher,
+                handler_pool=self.handler_pool,
+                scheduler=self.scheduler,
+                **kwargs)
+        self.clients.append(client)
+        return client
+
+    def start(self):
+        self.scheduler.start()
+        self._group.spawn(self._start_all)
+
+    def _start_all(self):
+        for client in list(self.clients):
+            self._group.spawn(self._start, client)
+            gevent.sleep(self.stagger)
+
+    def _start(self, client):
+        try:
+            client.start()
+        except Exception:
+            self.logger.exception('%s failed to connect to %s', client.nick, client.hostname)
+            client.reconnect(wait=False)
+
+    def stop(self):
+        self._group.kill()
+        for client in self.clients:
+            client.stop()
+        self.scheduler.stop()
+        self.handler_pool.kill()
+
+    def join(self):
+        self._group.join()
+        for client in self.clients:
+            client.join()
+
+    def stats(self):
+        """ Return the sum of the clients stats (maximum for *_max keys),
+        with the number of clients, connected clients and greenlets.
+        """
+        total = Counter()
+        for client in self.clients:
+            for key, value in client.stats.items():
+                if key.endswith('_max'):
+                    total[key] = max(total[key], value)
+                else:
+                    total[key] += value
+        total['clients'] = len(self.clients)
+        total['connected'] = sum(1 for client in self.clients
+                if client._socket is not None)
+        total['greenlets'] = sum(len(client._group) for client in self.clients) + \
+                len(self.handler_pool) + len(self._group) + \
+                int(self.scheduler._greenlet is not None)
+        return total
@@ -0,0 +1,188 @@
+""" Name resolution and connection to the first reachable server address.
+"""
+from __future__ import absolute_import
+
+import logging
+import time
+
+import gevent
+import gevent.queue
+from gevent import socket
+
+ADDRESS_TTL = 300
+CONNECT_TIMEOUT = 10
+# Delay before trying the next address while an attempt is still pending
+ATTEMPT_DELAY = 0.25
+
+module_logger = logging.getLogger(__name__)
+
+
+class AddressCache(object):
+    """ Cache of `getaddrinfo` results kept for `ttl` seconds.
+
+    Names are resolved with gevent's resolver so that a slow DNS server
+    only blocks the greenlet waiting for it. Failures are not cached.
+    """
+
+    def __init__(self, ttl=ADDRESS_TTL):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def resolve(self, host, port):
+        """ Return the (family, type, proto, canonname, sockaddr) tuples of
+        the stream sockets for `host` and `port`.
+        """
+        key = (host, port)
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] > time.time():
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        infos = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM) #@UndefinedVariable
+        self._entries[key] = (time.time() + self.ttl, infos)
+        return infos
+
+    def invalidate(self, host, port):
+        self._entries.pop((host, port), None)
+
+    def clear(self):
+        self._entries.clear()
+
+
+default_cache = AddressCache()
+
+
+def interleave(infos):
+    """ Order addresses alternating address families, starting with the
+    family of the first one (the preferred one, RFC 8305).
+    """
+    families = []
+    by_family = {}
+    for info in infos:
+        family = info[0]
+        if family not in by_family:
+            families.append(family)
+            by_family[family] = []
+        by_family[family].append(info)
+    ordered = []
+    while len(ordered) < len(infos):
+        for family in families:
+            if by_family[family]:
+                ordered.append(by_family[family].pop(0))
+    return ordered
+
+
+def _connect(info, timeout):
+    family, socktype, proto, _, sockaddr = info
+    sock = socket.socket(family, socktype, proto) #@UndefinedVariable
+    sock.settimeout(timeout)
+    try:
+        sock.connect(sockaddr)
+    except:
+        sock.close()
+        raise
+    sock.settimeout(None)
+    return sock
+
+
+def connect_first(infos, timeout=CONNECT_TIMEOUT, delay=ATTEMPT_DELAY, logger=None):
+    """ Connect to the first address of `infos` which accepts the
+    connection, return the socket and the address info it is connected
+    to.
+
+    Attempts are started `delay` seconds apart, or as soon as the previous
+    one fails, and each one gives up after `timeout` seconds (happy
+    eyeballs, RFC 8305). The first successful attempt cancels the others.
+    Raise the last error if no attempt succeeds.
+    """
+    logger = logger or module_logger
+    results = gevent.queue.Queue()
+    attempts = []
+    error = socket.error('No address to connect to') #@UndefinedVariable
+    done = []
+
+    def attempt(info):
+        try:
+            sock = _connect(info, timeout)
+        except Exception as e:
+            results.put((info, None, e))
+            return
+        if done:
+            # connected after the winner was chosen
+            sock.close()
+        else:
+            results.put((info, sock, None))
+
+    pending = list(infos)
+    received = 0
+    try:
+        while pending or received < len(attempts):
+            if pending:
+                attempts.append(gevent.spawn(attempt, pending.pop(0)))
+            try:
+                info, sock, e = results.get(timeout=delay if pending else None)
+            except gevent.queue.Empty:
+                continue
+            received += 1
+            if sock is not None:
+                return sock, info
+            logger.debug('Connection to %r failed: %s', info[4], e)
+            error = e
+        raise error
+    finally:
+        done.append(True)
+        gevent.killall(attempts, block=False)
+        while not results.empty():
+            sock = results.get_nowait()[1]
+            if sock is not None:
+                sock.close()
+
+
+def _resolve(cache, host, port):
+    try:
+        return cache.resolve(host, port), None
+    except socket.error as e: #@UndefinedVariable
+        return None, e
+
+
+def create_connection(servers, timeout=CONNECT_TIMEOUT, delay=ATTEMPT_DELAY,
+        cache=None, logger=None):
+    """ Connect to the first reachable address of the (host, port) pairs of
+    `servers`, which are resolved concurrently. The addresses of a server
+    are tried before the ones of the next server. Return the socket and
+    the server it is connected to.
+
+    Cached addresses of the servers are dropped if no connection can be
+    made, so that they are resolved again on the next call.
+    """
+    logger = logger or module_logger
+    if cache is None:
+        cache = default_cache
+    jobs = [gevent.spawn(_resolve, cache, host, port) for host, port in servers]
+    gevent.joinall(jobs)
+    infos = []
+    owners = {}
+    error = socket.error('No address to connect to') #@UndefinedVariable
+    for server, job in zip(servers, jobs):
+        addresses, e = job.value
+        if e is None:
+            for info in interleave(addresses):
+                infos.append(info)
+                owners.setdefault(info, server)
+        else:
+            logger.error('Could not resolve %s: %s', server[0], e)
+            error = e
+    if not infos:
+        raise error
+    try:
+        sock, info = connect_first(infos, timeout, delay, logger)
+    except Exception:
+        for host, port in servers:
+            cache.invalidate(host, port)
+        raise
+    return sock, owners[info]
@@ -0,0 +1,214 @@
+""" Routing of PRIVMSGs to the handlers whose filters they match.
+"""
+from __future__ import absolute_import
+
+import re
+
+from geventirc import dispatch
+from geventirc import tracker
+
+
+class Route(object):
+    """ The PRIVMSGs a handler wants. Each condition given must hold: the
+    message is sent to one of `targets`, to the client nick (`direct`) or
+    to a channel (`channel`), it contains the client nick (`mention`) and
+    one of the `keywords` as a word (case insensitive), and `pattern` (a
+    regex) is found in it.
+    """
+
+    __slots__ = ('targets', 'direct', 'channel', 'mention', 'keywords', 'pattern')
+
+    def __init__(self, targets=(), direct=False, channel=False, mention=False,
+            keywords=(), pattern=None):
+        if isinstance(targets, basestring):
+            targets = (targets,)
+        self.targets = tuple(targets)
+        self.direct = direct
+        self.channel = channel
+        self.mention = mention
+        self.keywords = frozenset(keyword.lower() for keyword in keywords)
+        if isinstance(pattern, basestring):
+            pattern = re.compile(pattern)
+        self.pattern = pattern
+
+
+def add_route(dispatcher, to_call, route):
+    """ Route `to_call` through the router of `dispatcher`, registering
+    one on first use.
+    """
+    router = dispatcher.router
+    if router is None:
+        router = Router(dispatcher.inline)
+        dispatcher.router = router
+        dispatcher.add(router)
+    router.add(to_call, route)
+
+def remove_route(dispatcher, to_call):
+    if dispatcher.router is None:
+        raise ValueError('%r is not routed' % (to_call,))
+    dispatcher.router.remove(to_call)
+
+
+class Router(object):
+    """ Handler of PRIVMSG calling the handlers registered with a `Route`
+    only for the messages matching it.
+
+    The content is examined once per message whatever the number of
+    handlers: candidates are looked up by target, and by keyword once the
+    keywords in the message are found with a single regex. The nick is
+    searched once, and one regex combining the patterns tells whether any
+    could match before they are tried one by one. Targets are case folded
+    according to the casemapping of the client state tracker if it has
+    one, the table of each casemapping is built on first use.
+    """
+
+    blocking = False
+    commands = ['PRIVMSG']
+
+    def __init__(self, inline=False):
+        self.inline = inline
+        self._routes = []
+        self._targets = {}
+        self._by_target = {}
+        self._any_target = ((), {})
+        self._keywords = None
+        self._patterns = ()
+
+    def __len__(self):
+        return len(self._routes)
+
+    def add(self, to_call, route):
+        self._routes.append((to_call, route))
+        self._compile()
+
+    def remove(self, to_call):
+        """ Unregister `to_call`, raise ValueError if it is not registered.
+        """
+        routes = [entry for entry in self._routes if entry[0] != to_call]
+        if len(routes) == len(self._routes):
+            raise ValueError('%r is not routed' % (to_call,))
+        self._routes = routes
+        self._compile()
+
+    def _compile(self):
+        """ Build, per target as given, the routes without keywords and
+        the routes by keyword. Routes are numbered to be called in
+        registration order.
+        """
+        default = not self.inline
+        tables = {}
+        keywords = set()
+        patterns = {}
+        prefilters = []
+        for number, (to_call, route) in enumerate(self._routes):
+            entry = (number, to_call, route, dispatch.is_blocking(to_call, default))
+            targets = set(route.targets) or [None]
+            for target in targets:
+                plain, by_keyword = tables.setdefault(target, ([], {}))
+                if route.keywords:
+                    for keyword in route.keywords:
+                        by_keyword.setdefault(keyword, []).append(entry)
+                else:
+                    plain.append(entry)
+            keywords.update(route.keywords)
+            pattern = route.pattern
+            if pattern is not None:
+                if pattern.groups:
+                    # group numbers would change in a combined regex
+                    prefilters.append(pattern)
+                else:
+                    patterns.setdefault(pattern.flags, []).append(pattern.pattern)
+        # routes for any target apply to every target
+        any_plain, any_by_keyword = tables.pop(None, ([], {}))
+        self._any_target = self._table(any_plain, any_by_keyword)
+        self._targets = tables
+        self._by_target = {}
+        self._keywords = None
+        if keywords:
+            alternatives = '|'.join(re.escape(keyword)
+                    for keyword in sorted(keywords, key=len, reverse=True))
+            self._keywords = re.compile(r'(?<!\w)(?:%s)(?!\w)' % alternatives, re.I)
+        for flags, alternatives in patterns.items():
+            prefilters.append(re.compile(
+                    '|'.join('(?:%s)' % pattern for pattern in alternatives), flags))
+        self._patterns = tuple(prefilters)
+
+    def _table(self, plain, by_keyword):
+        # targets folded together may share routes
+        return (tuple(sorted(set(plain))),
+                dict((keyword, tuple(sorted(set(entries))))
+                    for keyword, entries in by_keyword.items()))
+
+    def _fold_targets(self, casemapping):
+        """ Return the routes by target folded according to `casemapping`,
+        routes for any target included.
+        """
+        by_target = self._by_target.get(casemapping)
+        if by_target is not None:
+            return by_target
+        any_plain, any_by_keyword = self._any_target
+        merged = {}
+        for target, (plain, by_keyword) in self._targets.items():
+            key = tracker.fold(target, casemapping)
+            merged_plain, merged_by_keyword = merged.setdefault(key,
+                    (list(any_plain), dict((keyword, list(entries))
+                        for keyword, entries in any_by_keyword.items())))
+            merged_plain.extend(plain)
+            for keyword, entries in by_keyword.items():
+                merged_by_keyword.setdefault(keyword, []).extend(entries)
+        by_target = self._by_target[casemapping] = dict(
+                (target, self._table(plain, by_keyword))
+                for target, (plain, by_keyword) in merged.items())
+        return by_target
+
+    def __call__(self, client, msg):
+        params = msg.params
+        if not params:
+            return
+        fold = tracker.fold
+        casemapping = tracker.RFC1459
+        if client.tracker is not None:
+            fold = client.tracker.fold
+            casemapping = client.tracker.casemapping
+        target = fold(params[0])
+        by_target = self._by_target.get(casemapping)
+        if by_target is None:
+            by_target = self._fold_targets(casemapping)
+        entries, by_keyword = by_target.get(target, self._any_target)
+        if not entries and not by_keyword:
+            return
+        # received params are split on spaces
+        content = ' '.join(params[1:])
+        if by_keyword:
+            matched = {}
+            for word in self._keywords.findall(content):
+                for entry in by_keyword.get(word.lower(), ()):
+                    matched[entry[0]] = entry
+            if matched:
+                entries = sorted(entries + tuple(matched.values()))
+        if not entries:
+            return
+        direct = target == fold(client.nick)
+        mentioned = patterns = None
+        inline = []
+        blocking = []
+        for _, to_call, route, is_blocking in entries:
+            if route.direct and not direct or route.channel and direct:
+                continue
+            if route.mention:
+                if mentioned is None:
+                    mentioned = client.nick in content
+                if not mentioned:
+                    continue
+            if route.pattern is not None:
+                if patterns is None:
+                    patterns = any(prefilter.search(content)
+                            for prefilter in self._patterns)
+                if not patterns or not route.pattern.search(content):
+                    continue
+            if is_blocking:
+                blocking.append(to_call)
+            else:
+                inline.append(to_call)
+        if inline or blocking:
+            client._call_handlers(inline, blocking, msg)
@@ -0,0 +1,206 @@
+""" Delayed and periodic jobs run by a single greenlet.
+"""
+from __future__ import absolute_import
+
+import heapq
+import itertools
+import logging
+import random
+import time
+
+import gevent
+import gevent.event
+
+# What a periodic job does with the ticks missed while it was late or the
+# scheduler was paused
+CATCH_UP = 'catch_up'   # run once per missed tick
+COALESCE = 'coalesce'   # run once for all of them
+SKIP = 'skip'           # do not run them, wait for the next tick
+
+# The scheduler sleeps at least this many seconds, so that jobs due close
+# together run in one go, a little late, instead of waking it up each time
+RESOLUTION = 0.01
+
+module_logger = logging.getLogger(__name__)
+
+
+class Job(object):
+    """ A function to call once at `due`, or every `interval` seconds.
+
+    `base` is the time the job is scheduled for, `due` the same plus up to
+    `jitter` random seconds. `active` is true until the job is cancelled,
+    or has run if it is not periodic.
+    """
+
+    __slots__ = ('func', 'args', 'interval', 'jitter', 'missed', 'blocking',
+            'base', 'due', 'active', '_scheduler')
+
+    def __init__(self, scheduler, func, args, base, interval=None, jitter=0,
+            missed=COALESCE, blocking=False):
+        self._scheduler = scheduler
+        self.func = func
+        self.args = args
+        self.interval = interval
+        self.jitter = jitter
+        self.missed = missed
+        self.blocking = blocking
+        self.active = True
+        self.base = base
+        self.due = base
+
+    def cancel(self):
+        self._scheduler.cancel(self)
+
+    def __repr__(self):
+        return '<Job %r due %.3f every %s>' % (self.func, self.due, self.interval)
+
+
+class Scheduler(object):
+    """ Jobs kept in a heap ordered by due time. One greenlet sleeps until
+    the first job is due, runs the jobs due and sleeps again, so there is
+    a single timer however many jobs are scheduled. Adding a job due
+    before the others wakes it up. Cancelled jobs are left in the heap
+    until they are due, or until they are too many.
+
+    Jobs run in the scheduler greenlet and should not block, unless they
+    are marked `blocking`: those are spawned in `pool` (by default a new
+    greenlet each time). Nothing runs while the scheduler is paused, see
+    `missed` for what periodic jobs do when it resumes.
+    """
+
+    def __init__(self, pool=None, logger=None, paused=False):
+        self.pool = pool
+        self.logger = logger or module_logger
+        self.paused = paused
+        self._heap = []
+        self._counter = itertools.count()
+        self._cancelled = 0
+        self._wakeup = gevent.event.Event()
+        self._runner = None
+
+    def __len__(self):
+        return len(self._heap) - self._cancelled
+
+    def call_later(self, delay, func, *args, **options):
+        """ Call `func(*args)` in `delay` seconds, return the Job. Options
+        are `jitter` and `blocking`.
+        """
+        return self._add(Job(self, func, args, time.time() + delay, **options))
+
+    def call_every(self, interval, func, *args, **options):
+        """ Call `func(*args)` every `interval` seconds, starting after
+        `delay` seconds (by default `interval`), return the Job.
+
+        Each run is delayed by up to `jitter` random seconds, without
+        drifting from the schedule. `missed` tells what to do with missed
+        ticks: CATCH_UP, COALESCE (the default) or SKIP.
+        """
+        if interval <= 0:
+            raise ValueError('interval must be positive, not %r' % (interval,))
+        delay = options.pop('delay', interval)
+        job = Job(self, func, args, time.time() + delay, interval=interval, **options)
+        return self._add(job)
+
+    def cancel(self, job):
+        if not job.active:
+            return
+        job.active = False
+        self._cancelled += 1
+        if self._cancelled > 64 and self._cancelled > len(self._heap) / 2:
+            # drop the cancelled jobs instead of waiting for them to be due
+            self._heap[:] = [entry for entry in self._heap if entry[2].active]
+            heapq.heapify(self._heap)
+            self._cancelled = 0
+
+    def clear(self):
+        for _, _, job in self._heap:
+            job.active = False
+        del self._heap[:]
+        self._cancelled = 0
+
+    def pause(self):
+        self.paused = True
+        self._wakeup.set()
+
+    def resume(self):
+        self.paused = False
+        self._wake()
+
+    def stop(self):
+        """ Stop the scheduler greenlet, the jobs are kept.
+        """
+        self.paused = True
+        if self._runner is not None and self._runner is not gevent.getcurrent():
+            self._runner.kill()
+        self._runner = None
+
+    def _add(self, job):
+        first = self._heap[0][0] if self._heap else None
+        heapq.heappush(self._heap, self._entry(job))
+        if first is None or job.due < first:
+            self._wake()
+        return job
+
+    def _entry(self, job):
+        job.due = job.base
+        if job.jitter:
+            job.due += random.random() * job.jitter
+        return (job.due, next(self._counter), job)
+
+    def _wake(self):
+        if self.paused:
+            return
+        if self._runner is None:
+            self._runner = gevent.spawn(self._run)
+        else:
+            self._wakeup.set()
+
+    def _run(self):
+        heap = self._heap
+        while not self.paused:
+            self._wakeup.clear()
+            if not heap:
+                self._wakeup.wait()
+                continue
+            now = time.time()
+            delay = heap[0][0] - now
+            if delay > 0:
+                self._wakeup.wait(max(delay, RESOLUTION))
+                continue
+            while heap and heap[0][0] <= now and not self.paused:
+                self._run_job(heap[0][2], now)
+        self._runner = None
+
+    def _run_job(self, job, now):
+        """ Run `job`, first in the heap, and put it back in its place if it
+        is periodic.
+        """
+        heap = self._heap
+        if not job.active:
+            heapq.heappop(heap)
+            self._cancelled -= 1
+            return
+        interval = job.interval
+        run = True
+        if interval is None:
+            heapq.heappop(heap)
+            job.active = False
+        else:
+            late = now - job.base >= interval
+            if job.missed == CATCH_UP:
+                job.base += interval
+            else:
+                ticks = int((now - job.base) // interval) + 1
+                job.base += ticks * interval
+                run = not (late and job.missed == SKIP)
+            heapq.heapreplace(heap, self._entry(job))
+        if not run:
+            return
+        if job.blocking:
+            spawn = self.pool.spawn if self.pool is not None else gevent.spawn
+            spawn(job.func, *job.args)
+            return
+        try:
+            job.func(*job.args)
+        except Exception:
+            self.logger.exception('Job %r failed', job)
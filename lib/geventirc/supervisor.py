@@ -0,0 +1,271 @@
+""" Shard client connections across worker processes.
+
+The supervisor forks one worker process per CPU (or `workers`), each
+running a `ClientPool` with its share of the connections, and restarts
+workers that die. Workers exchange events through the supervisor over a
+socketpair, as JSON lines.
+
+Workers are forked from the supervisor process, they start over with a
+new hub so the greenlets of the supervisor never run in a worker. Objects
+of the supervisor process, sockets included, are still copied by fork: the
+supervisor is better started before anything else.
+"""
+from __future__ import absolute_import
+
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import zlib
+
+import gevent
+import gevent.hub
+import gevent.os
+import gevent.pool
+from gevent import socket
+from gevent.lock import Semaphore
+
+from geventirc.framer import LineFramer
+from geventirc.pool import ClientPool
+
+module_logger = logging.getLogger(__name__)
+
+SUPERVISOR = -1
+
+
+class Channel(object):
+    """ One end of the socketpair between the supervisor and a worker.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self._lock = Semaphore()
+        self._framer = LineFramer()
+
+    def send(self, line):
+        with self._lock:
+            self.sock.sendall(line + '\n')
+
+    def recv(self):
+        """ Return the next lines received, None when the other end is
+        closed.
+        """
+        try:
+            return self._framer.recv_from(self.sock)
+        except socket.error: #@UndefinedVariable
+            return None
+
+    def close(self):
+        self.sock.close()
+
+
+def encode_event(event, data, origin):
+    return json.dumps({'event': event, 'data': data, 'origin': origin})
+
+
+def decode_event(line):
+    event = json.loads(line)
+    return event['event'], event['data'], event['origin']
+
+
+class Worker(object):
+    """ Worker side of the supervisor, given to the `setup` function along
+    with the `pool` of clients assigned to this worker.
+
+    Events published by a worker are received by the supervisor and by
+    every other worker.
+    """
+
+    def __init__(self, index, channel, pool, logger=None):
+        self.index = index
+        self.pool = pool
+        self.logger = logger or module_logger
+        self._channel = channel
+        self._subscribers = {}
+
+    def publish(self, event, data=None):
+        self._channel.send(encode_event(event, data, self.index))
+
+    def subscribe(self, event, callback):
+        """ Call `callback(worker, data, origin)` when `event` is received,
+        origin is the index of the worker which published it or SUPERVISOR.
+        """
+        self._subscribers.setdefault(event, []).append(callback)
+
+    def run(self):
+        """ Run the pool until the supervisor goes away.
+        """
+        self.pool.start()
+        while 1:
+            lines = self._channel.recv()
+            if lines is None:
+                break
+            for line in lines:
+                event, data, origin = decode_event(line)
+                for callback in self._subscribers.get(event, ()):
+                    try:
+                        callback(self, data, origin)
+                    except Exception:
+                        self.logger.exception('Event callback %r failed', callback)
+        self.pool.stop()
+
+
+class WorkerProcess(object):
+    """ Supervisor side of a worker.
+    """
+
+    def __init__(self, index, pid, channel):
+        self.index = index
+        self.pid = pid
+        self.channel = channel
+
+
+class Supervisor(object):
+    """ Run client connections in `workers` processes.
+
+    Clients are assigned to workers by `shard_key`, by default the network
+    (host and port) they connect to. In each worker `setup(worker)` is
+    called to register handlers on `worker.pool` and subscribe to events
+    before the clients are started. Other keyword arguments are passed to
+    the `ClientPool` of each worker.
+
+    Dead workers are restarted after `restart_delay` seconds.
+    """
+
+    def __init__(self, workers=None, setup=None, restart_delay=1, logger=None, **pool_kwargs):
+        self.workers_count = workers or multiprocessing.cpu_count()
+        self.setup = setup
+        self.restart_delay = restart_delay
+        self.logger = logger or module_logger
+        self.pool_kwargs = pool_kwargs
+        self.workers = {}
+        self._clients = []
+        self._subscribers = {}
+        self._group = gevent.pool.Group()
+        self._running = False
+
+    def add_client(self, hostname, nick, shard_key=None, **kwargs):
+        """ Register a client, `kwargs` are passed to `ClientPool.add_client`.
+        """
+        if shard_key is None:
+            shard_key = '%s:%s' % (hostname, kwargs.get('port', ''))
+        self._clients.append((shard_key, hostname, nick, kwargs))
+
+    def shard(self, key):
+        """ Return the index of the worker running the clients of `key`.
+        """
+        return (zlib.crc32(str(key)) & 0xffffffff) % self.workers_count
+
+    def subscribe(self, event, callback):
+        """ Call `callback(data, origin)` when a worker publishes `event`.
+        """
+        self._subscribers.setdefault(event, []).append(callback)
+
+    def publish(self, event, data=None):
+        """ Send `event` to every worker.
+        """
+        line = encode_event(event, data, SUPERVISOR)
+        for worker in self.workers.values():
+            self._send(worker, line)
+
+    def start(self):
+        self._running = True
+        for index in range(self.workers_count):
+            self._spawn(index)
+
+    def stop(self):
+        self._running = False
+        self._group.kill()
+        for worker in self.workers.values():
+            try:
+                os.kill(worker.pid, signal.SIGTERM)
+            except OSError:
+                pass
+            worker.channel.close()
+        for worker in self.workers.values():
+            try:
+                gevent.os.waitpid(worker.pid, 0)
+            except OSError:
+                pass
+        self.workers.clear()
+
+    def join(self):
+        self._group.join()
+
+    def _spawn(self, index):
+        parent_sock, child_sock = socket.socketpair() #@UndefinedVariable
+        pid = gevent.os.fork()
+        if pid == 0:
+            self._run_worker(index, parent_sock, child_sock.fileno())
+        child_sock.close()
+        worker = self.workers[index] = WorkerProcess(index, pid, Channel(parent_sock))
+        self.logger.info('Started worker %d (pid %d)', index, pid)
+        self._group.spawn(self._read, worker)
+        self._group.spawn(self._watch, worker)
+
+    def _run_worker(self, index, parent_sock, fd):
+        """ Worker process main, never returns.
+        """
+        status = 0
+        try:
+            # Leave the greenlets copied from the parent (including the one
+            # which called start) behind in the old hub, they never resume.
+            # The old hub must stay referenced: collecting it would switch
+            # to its parent greenlet.
+            old_hub = gevent.get_hub() #@UnusedVariable
+            gevent.hub.set_hub(gevent.hub.Hub(default=False))
+            # the worker only sees the supervisor go away once no copy
+            # of the supervisor end is left open
+            for worker in self.workers.values():
+                os.close(worker.channel.sock.fileno())
+            os.close(parent_sock.fileno())
+            channel = Channel(socket.fromfd(fd, socket.AF_UNIX, socket.SOCK_STREAM)) #@UndefinedVariable
+            os.close(fd)
+
+            pool = ClientPool(logger=self.logger, **self.pool_kwargs)
+            for key, hostname, nick, kwargs in self._clients:
+                if self.shard(key) == index:
+                    pool.add_client(hostname, nick, **kwargs)
+            worker = Worker(index, channel, pool, self.logger)
+            if self.setup is not None:
+                self.setup(worker)
+            worker.run()
+        except BaseException:
+            self.logger.exception('Worker %d failed', index)
+            status = 1
+        finally:
+            os._exit(status)
+
+    def _send(self, worker, line):
+        try:
+            worker.channel.send(line)
+        except socket.error: #@UndefinedVariable
+            self.logger.warn('Could not send event to worker %d', worker.index)
+
+    def _read(self, worker):
+        while 1:
+            lines = worker.channel.recv()
+            if lines is None:
+                return
+            for line in lines:
+                event, data, origin = decode_event(line)
+                for other in self.workers.values():
+                    if other is not worker:
+                        self._send(other, line)
+                for callback in self._subscribers.get(event, ()):
+                    try:
+                        callback(data, origin)
+                    except Exception:
+                        self.logger.exception('Event callback %r failed', callback)
+
+    def _watch(self, worker):
+        gevent.os.waitpid(worker.pid, 0)
+        worker.channel.close()
+        if not self._running:
+            return
+        del self.workers[worker.index]
+        self.logger.error('Worker %d (pid %d) died, restarting', worker.index, worker.pid)
+        gevent.sleep(self.restart_delay)
+        if self._running:
+            self._spawn(worker.index)
@@ -0,0 +1,47 @@
+""" TLS for client connections.
+"""
+from __future__ import absolute_import
+
+import gevent.ssl as ssl
+
+# TLS sessions can only be resumed where the ssl module exposes them
+HAS_SESSIONS = hasattr(ssl, 'SSLSession')
+
+_default_context = None
+
+
+def default_context():
+    """ Return the context shared by the clients which are not given one:
+    certificates are verified against the system CAs and must match the
+    server host name.
+    """
+    global _default_context
+    if _default_context is None:
+        _default_context = ssl.create_default_context()
+    return _default_context
+
+
+def wrap(sock, context, hostname, session=None, timeout=None):
+    """ Do the TLS handshake on the connected `sock` and return the TLS
+    socket. `hostname` is sent for SNI and checked against the server
+    certificate if the context requires it, and `session` (see `session`)
+    is resumed if possible. The handshake fails after `timeout` seconds.
+    """
+    kwargs = {}
+    if session is not None and HAS_SESSIONS:
+        kwargs['session'] = session
+    sock.settimeout(timeout)
+    tls_sock = context.wrap_socket(sock, server_hostname=hostname, **kwargs)
+    tls_sock.settimeout(None)
+    return tls_sock
+
+
+def session(sock):
+    """ Return the TLS session of `sock`, to resume it on the next
+    connection, or None.
+    """
+    return getattr(sock, 'session', None)
+
+
+def session_reused(sock):
+    return getattr(sock, 'session_reused', False)
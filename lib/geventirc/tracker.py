@@ -0,0 +1,388 @@
+""" Channel and user state of a connection, kept up to date from the
+messages received.
+"""
+from __future__ import absolute_import
+
+import string
+
+# CASEMAPPING values of RPL_ISUPPORT
+ASCII = 'ascii'
+RFC1459 = 'rfc1459'
+STRICT_RFC1459 = 'strict-rfc1459'
+
+_fold_tables = {
+    ASCII: string.maketrans(string.ascii_uppercase, string.ascii_lowercase),
+    RFC1459: string.maketrans(string.ascii_uppercase + '[]\\~',
+            string.ascii_lowercase + '{}|^'),
+    STRICT_RFC1459: string.maketrans(string.ascii_uppercase + '[]\\',
+            string.ascii_lowercase + '{}|'),
+}
+
+
+def fold(name, casemapping=RFC1459):
+    """ Return `name` case folded according to `casemapping`.
+    """
+    return name.translate(_fold_tables[casemapping])
+
+
+DEFAULT_PREFIX = ('ov', '@+')
+DEFAULT_CHANMODES = ('beI', 'k', 'l', 'imnpst')
+DEFAULT_CHANTYPES = '#&'
+
+_no_modes = intern('')
+
+
+class User(object):
+    """ A user seen in at least one of the channels of the client, with
+    the folded names of these channels. They are few, a tuple is smaller
+    than a set.
+    """
+
+    __slots__ = ('nick', 'user', 'host', 'channels')
+
+    def __init__(self, nick, user=None, host=None):
+        self.nick = nick
+        self.user = user
+        self.host = host
+        self.channels = ()
+
+    def __repr__(self):
+        return '<User %s>' % self.nick
+
+
+class Channel(object):
+    """ A channel the client is in. `members` maps the folded nicks of the
+    members to their prefix modes ('o', 'v', ...), `modes` the channel
+    modes to their parameter or None. `synced` tells whether the names
+    list has been received.
+    """
+
+    __slots__ = ('name', 'members', 'modes', 'synced', '_names')
+
+    def __init__(self, name):
+        self.name = name
+        self.members = {}
+        self.modes = {}
+        self.synced = False
+        self._names = None
+
+    def __len__(self):
+        return len(self.members)
+
+    def _member_tables(self):
+        """ Return the members, and the names list being received if any,
+        which both follow the events received meanwhile.
+        """
+        if self._names is None:
+            return (self.members,)
+        return (self.members, self._names)
+
+    def __repr__(self):
+        return '<Channel %s (%d members)>' % (self.name, len(self.members))
+
+
+class StateTracker(object):
+    """ Index of the channels the client is in and of their members, fed
+    by JOIN, PART, KICK, QUIT, NICK, MODE and the names (353, 366) and
+    ISUPPORT (005) replies.
+
+    Channels and nicks are looked up by their name folded according to
+    the server CASEMAPPING, so each event costs the same whatever the size
+    of the channel. Leaving a channel costs a lookup per member. Names
+    are interned so that a user in many channels, or seen again after a
+    reconnection, is stored once.
+    """
+
+    blocking = False
+    commands = ['JOIN', 'PART', 'KICK', 'QUIT', 'NICK', 'MODE', '353', '366', '005']
+
+    def __init__(self):
+        self.channels = {}
+        self.users = {}
+        self._table = _fold_tables[RFC1459]
+        self.casemapping = RFC1459
+        self.prefix_modes = DEFAULT_PREFIX[0]
+        self._prefixes = dict(zip(DEFAULT_PREFIX[1], DEFAULT_PREFIX[0]))
+        self.chanmodes = DEFAULT_CHANMODES
+        self.chantypes = DEFAULT_CHANTYPES
+        self._handlers = dict((command, getattr(self, '_on_' + command.lower()))
+                for command in self.commands)
+
+    def fold(self, name):
+        return name.translate(self._table)
+
+    def clear(self):
+        self.channels.clear()
+        self.users.clear()
+
+    def channel(self, name):
+        return self.channels.get(self.fold(name))
+
+    def user(self, nick):
+        return self.users.get(self.fold(nick))
+
+    def nicks(self, channel):
+        """ Return the nicks of the members of `channel`.
+        """
+        channel = self.channel(channel)
+        if channel is None:
+            return []
+        users = self.users
+        return [users[key].nick for key in channel.members if key in users]
+
+    def channels_of(self, nick):
+        """ Return the names of the channels shared with `nick`.
+        """
+        user = self.user(nick)
+        if user is None:
+            return []
+        channels = self.channels
+        return [channels[key].name for key in user.channels if key in channels]
+
+    def is_member(self, nick, channel):
+        channel = self.channel(channel)
+        return channel is not None and self.fold(nick) in channel.members
+
+    def modes(self, nick, channel):
+        """ Return the prefix modes of `nick` in `channel` ('o', 'v'...) or
+        None if it is not a member.
+        """
+        channel = self.channel(channel)
+        if channel is None:
+            return None
+        return channel.members.get(self.fold(nick))
+
+    def is_channel(self, name):
+        return name[:1] in self.chantypes
+
+    def __call__(self, client, msg):
+        self.handle(client, msg)
+
+    def handle(self, client, msg):
+        handler = self._handlers.get(msg.command)
+        if handler is not None:
+            handler(client, msg)
+
+    # Indexes
+
+    def _add_member(self, channel, nick, user=None, host=None):
+        key = intern(self.fold(nick))
+        record = self.users.get(key)
+        if record is None:
+            record = self.users[key] = User(intern(nick), user, host)
+        elif user is not None:
+            record.user = user
+            record.host = host
+        if channel not in record.channels:
+            record.channels += (channel,)
+        return key, record
+
+    def _remove_member(self, channel, key):
+        record = self.users.get(key)
+        if record is None:
+            return
+        record.channels = tuple(name for name in record.channels if name != channel)
+        if not record.channels:
+            del self.users[key]
+
+    def _remove_channel(self, key):
+        channel = self.channels.pop(key, None)
+        if channel is None:
+            return
+        for member in channel.members:
+            self._remove_member(key, member)
+
+    def _is_me(self, client, key):
+        return key == self.fold(client.nick)
+
+    # Events
+
+    def _on_join(self, client, msg):
+        nick, user, host = msg.prefix_parts
+        name = msg.params[0]
+        key = intern(self.fold(name))
+        if self._is_me(client, self.fold(nick)):
+            self._remove_channel(key)
+            self.channels[key] = Channel(intern(name))
+        channel = self.channels.get(key)
+        if channel is None:
+            return
+        member, _ = self._add_member(key, nick, user=user, host=host)
+        for members in channel._member_tables():
+            members[member] = _no_modes
+
+    def _on_part(self, client, msg):
+        nick = self.fold(msg.prefix_parts[0])
+        for name in msg.params[0].split(','):
+            self._leave(client, self.fold(name), nick)
+
+    def _on_kick(self, client, msg):
+        self._leave(client, self.fold(msg.params[0]), self.fold(msg.params[1]))
+
+    def _leave(self, client, key, nick):
+        if self._is_me(client, nick):
+            self._remove_channel(key)
+            return
+        channel = self.channels.get(key)
+        if channel is None:
+            return
+        found = False
+        for members in channel._member_tables():
+            if members.pop(nick, None) is not None:
+                found = True
+        if found:
+            self._remove_member(key, nick)
+
+    def _on_quit(self, client, msg):
+        key = self.fold(msg.prefix_parts[0])
+        if self._is_me(client, key):
+            self.clear()
+            return
+        record = self.users.pop(key, None)
+        if record is None:
+            return
+        channels = self.channels
+        for name in record.channels:
+            for members in channels[name]._member_tables():
+                members.pop(key, None)
+
+    def _on_nick(self, client, msg):
+        old = self.fold(msg.prefix_parts[0])
+        nick = msg.params[0]
+        new = intern(self.fold(nick))
+        record = self.users.pop(old, None)
+        if record is None:
+            return
+        record.nick = intern(nick)
+        self.users[new] = record
+        channels = self.channels
+        for name in record.channels:
+            for members in channels[name]._member_tables():
+                if old in members:
+                    members[new] = members.pop(old)
+
+    def _on_mode(self, client, msg):
+        params = msg.params
+        channel = self.channels.get(self.fold(params[0]))
+        if channel is None or len(params) < 2:
+            return
+        args = params[2:]
+        always, on_set = self.chanmodes[0] + self.chanmodes[1], self.chanmodes[2]
+        adding = True
+        for mode in params[1]:
+            if mode == '+':
+                adding = True
+            elif mode == '-':
+                adding = False
+            elif mode in self.prefix_modes:
+                if not args:
+                    break
+                key = self.fold(args.pop(0))
+                for members in channel._member_tables():
+                    modes = members.get(key)
+                    if modes is None:
+                        continue
+                    if adding and mode not in modes:
+                        modes = ''.join(m for m in self.prefix_modes
+                                if m in modes or m == mode)
+                    elif not adding:
+                        modes = modes.replace(mode, '')
+                    members[key] = intern(modes)
+            elif mode in always or (adding and mode in on_set):
+                arg = args.pop(0) if args else None
+                if mode in self.chanmodes[0]:
+                    # list modes (bans...) are not tracked
+                    continue
+                if adding:
+                    channel.modes[mode] = arg
+                else:
+                    channel.modes.pop(mode, None)
+            elif adding:
+                channel.modes[mode] = None
+            else:
+                channel.modes.pop(mode, None)
+
+    def _on_353(self, client, msg):
+        # <me> <type> <channel> :<names>
+        params = msg.params
+        if len(params) < 3:
+            return
+        key = self.fold(params[2])
+        channel = self.channels.get(key)
+        if channel is None:
+            return
+        if channel._names is None:
+            channel._names = {}
+        names = channel._names
+        prefixes = self._prefixes
+        # received params are split on spaces
+        for name in ' '.join(params[3:]).split():
+            modes = ''
+            while name and name[0] in prefixes:
+                modes += prefixes[name[0]]
+                name = name[1:]
+            nick, user, host = name, None, None
+            if '!' in name:
+                # userhost-in-names
+                nick, _, userhost = name.partition('!')
+                user, _, host = userhost.partition('@')
+            member, _ = self._add_member(key, nick, user=user, host=host)
+            names[member] = intern(modes)
+
+    def _on_366(self, client, msg):
+        # <me> <channel> :End of /NAMES list.
+        if len(msg.params) < 2:
+            return
+        key = self.fold(msg.params[1])
+        channel = self.channels.get(key)
+        if channel is None or channel._names is None:
+            return
+        names = channel._names
+        for member in channel.members:
+            if member not in names:
+                self._remove_member(key, member)
+        channel.members = names
+        channel._names = None
+        channel.synced = True
+
+    def _on_005(self, client, msg):
+        for token in msg.params[1:]:
+            name, _, value = token.partition('=')
+            if name == 'CASEMAPPING' and value in _fold_tables:
+                self._set_casemapping(value)
+            elif name == 'PREFIX' and value.startswith('('):
+                modes, _, prefixes = value[1:].partition(')')
+                if len(modes) == len(prefixes):
+                    self.prefix_modes = modes
+                    self._prefixes = dict(zip(prefixes, modes))
+            elif name == 'CHANMODES':
+                kinds = value.split(',')
+                if len(kinds) >= 4:
+                    self.chanmodes = tuple(kinds[:4])
+            elif name == 'CHANTYPES' and value:
+                self.chantypes = value
+
+    def _set_casemapping(self, casemapping):
+        """ Fold the names again, from the nicks and channel names as
+        received.
+        """
+        if casemapping == self.casemapping:
+            return
+        self.casemapping = casemapping
+        self._table = _fold_tables[casemapping]
+        fold = self.fold
+        user_keys = dict((key, intern(fold(record.nick)))
+                for key, record in self.users.items())
+        channel_keys = dict((key, intern(fold(channel.name)))
+                for key, channel in self.channels.items())
+        for record in self.users.values():
+            record.channels = tuple(channel_keys[key] for key in record.channels)
+        for channel in self.channels.values():
+            channel.members = dict((user_keys[key], modes)
+                    for key, modes in channel.members.items())
+            if channel._names is not None:
+                channel._names = dict((user_keys[key], modes)
+                        for key, modes in channel._names.items())
+        self.users = dict((user_keys[key], record) for key, record in self.users.items())
+        self.channels = dict((channel_keys[key], channel)
+                for key, channel in self.channels.items())
@@ -65,6 +65,7 @@ import SocketServer
 import socket
 import select
 import re
+import threading
 
 from geventirc.message import irc_split
 import geventirc.replycode as rpl
@@ -74,6 +75,8 @@ logger = logging.getLogger(__name__)
 SRV_NAME    = "Hircd"
 SRV_VERSION = "0.1a"
 SRV_WELCOME = "Welcome to %s v%s, the ugliest IRC server in the world." % (SRV_NAME, SRV_VERSION)
+SRV_CAPS = ('batch', 'echo-message', 'message-tags')
+ERR_INVALIDCAPCMD = 410
 
 
 class IRCError(Exception):
@@ -110,21 +113,32 @@ class IRCClient(SocketServer.BaseRequestHandler):
         self.nick = None            # Client's currently registered nickname
         self.send_queue = deque()   # Messages to send to client (strings)
         self.channels = {}          # Channels the client is in
+        self.caps = set()           # IRCv3 capabilities enabled by the client
+        self.cap_negotiating = False # Registration waits for CAP END
+        self.welcomed = False
         SocketServer.BaseRequestHandler.__init__(self, request, client_address, server)
 
     def handle(self):
         logger.info('Client connected: %s' % self.client_ident())
+        if self.server.ssl_context is not None:
+            self.request.do_handshake()
 
+        buf = ''
         while True:
-            buf = ''
             ready_to_read, ready_to_write, in_error = select.select([self.request], [], [], 0.1)
+            if self.server.ssl_context is not None and self.request.pending():
+                # Decrypted data already read from the socket
+                ready_to_read = [self.request]
 
-            # Write any commands to the client
+            # Write any commands to the client, many at once
             while self.send_queue:
-                msg = self.send_queue.popleft()
-                logger.debug('to %s: %s' % (self.client_ident(), msg))
+                msgs = []
+                while self.send_queue and len(msgs) < 1000:
+                    msg = self.send_queue.popleft()
+                    logger.debug('to %s: %s' % (self.client_ident(), msg))
+                    msgs.append(msg + '\r\n')
                 try:
-                    self.request.send(msg + '\r\n')
+                    self.request.sendall(''.join(msgs))
                 except socket.error:
                     # Client is disconnected automatically
                     pass
@@ -184,13 +198,12 @@ class IRCClient(SocketServer.BaseRequestHandler):
                 # Someone else is using the nick
                 raise IRCError(rpl.ERR_NICKNAMEINUSE, 'NICK :%s' % nick)
             else:
-                # Nick is available, register, send welcome and MOTD.
+                # Nick is available, register, send welcome and MOTD
+                # unless the capability negotiation is not over.
                 self.nick = nick
                 self.server.clients[nick] = self
-                response = ':%s %03d %s :%s' % (self.server.servername, rpl.RPL_WELCOME, self.nick, SRV_WELCOME)
-                self.send_queue.append(response)
-                response = ':%s %s %s :End of MOTD command.' % (self.server.servername, rpl.RPL_ENDOFMOTD, self.nick)
-                self.send_queue.append(response)
+                if not self.cap_negotiating:
+                    self.welcome()
                 return
         else:
             if self.server.clients.get(nick, None) == self:
@@ -218,6 +231,52 @@ class IRCClient(SocketServer.BaseRequestHandler):
                 # Send a notification of the nick change to the client itself
                 return message
 
+    def welcome(self):
+        """ Send welcome and MOTD once registered.
+        """
+        self.welcomed = True
+        response = ':%s %03d %s :%s' % (self.server.servername, rpl.RPL_WELCOME, self.nick, SRV_WELCOME)
+        self.send_queue.append(response)
+        response = ':%s %s %s :End of MOTD command.' % (self.server.servername, rpl.RPL_ENDOFMOTD, self.nick)
+        self.send_queue.append(response)
+
+    def handle_cap(self, params):
+        """ Handle IRCv3 capability negotiation. Once started before the
+            registration, the welcome is only sent after CAP END.
+        """
+        if self.server.caps is None:
+            raise IRCError(rpl.ERR_UNKNOWNCOMMAND, '%s CAP :Unknown command' % (self.nick or '*'))
+        subcommand = params[0].upper()
+        reply = ':%s CAP %s %%s :%%s' % (self.server.servername, self.nick or '*')
+        if subcommand == 'LS':
+            if not self.welcomed:
+                self.cap_negotiating = True
+            caps = list(self.server.caps)
+            if len(params) > 1 and params[1] >= '302':
+                # Version 302 clients get the list two capabilities a line
+                while len(caps) > 2:
+                    self.send_queue.append(reply % ('LS *', ' '.join(caps[:2])))
+                    caps = caps[2:]
+            return reply % ('LS', ' '.join(caps))
+        elif subcommand == 'LIST':
+            return reply % ('LIST', ' '.join(sorted(self.caps)))
+        elif subcommand == 'REQ':
+            requested = params[1].split() if len(params) > 1 else []
+            if not all(cap.lstrip('-') in self.server.caps for cap in requested):
+                return reply % ('NAK', ' '.join(requested))
+            for cap in requested:
+                if cap.startswith('-'):
+                    self.caps.discard(cap[1:])
+                else:
+                    self.caps.add(cap)
+            return reply % ('ACK', ' '.join(requested))
+        elif subcommand == 'END':
+            self.cap_negotiating = False
+            if self.nick and not self.welcomed:
+                self.welcome()
+        else:
+            raise IRCError(ERR_INVALIDCAPCMD, '%s %s :Invalid CAP command' % (self.nick or '*', subcommand))
+
     def handle_user(self, params):
         """ Handle the USER command which identifies the user to the server.
         """
@@ -304,6 +363,9 @@ class IRCClient(SocketServer.BaseRequestHandler):
                 client.send_queue.append(message)
             else:
                 raise IRCError(rpl.ERR_NOSUCHNICK, 'PRIVMSG :%s' % target)
+        if 'echo-message' in self.caps:
+            # Delivered, send it back to the user
+            self.send_queue.append(message)
 
     def handle_topic(self, params):
         """ Handle a topic command.
@@ -377,6 +439,22 @@ class IRCClient(SocketServer.BaseRequestHandler):
                 client.send_queue.append(response)
             channel.clients.remove(self)
 
+    def handle_netsplit(self, params):
+        """ Send the user the QUITs of `params[0]` users lost in a netsplit,
+            in a batch if the user enabled batch. For testing clients.
+        """
+        count = int(params[0])
+        servers = '%s split.%s' % (self.server.servername, self.server.servername)
+        quits = [':split%d!split@split.%s QUIT :%s' % (i, self.server.servername, servers)
+                for i in range(count)]
+        if 'batch' in self.caps:
+            self.server.batches += 1
+            reference = 'ns%d' % self.server.batches
+            self.send_queue.append(':%s BATCH +%s netsplit %s' % (self.server.servername, reference, servers))
+            quits = ['@batch=%s %s' % (reference, line) for line in quits]
+            quits.append(':%s BATCH -%s' % (self.server.servername, reference))
+        self.send_queue.extend(quits)
+
     def handle_dump(self, params):
         """ Dump internal server information for debugging purposes.
         """
@@ -429,12 +507,35 @@ class IRCServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
     daemon_threads = True
     allow_reuse_address = True
 
-    def __init__(self, server_address, RequestHandlerClass):
+    def __init__(self, server_address, RequestHandlerClass, ssl_context=None, caps=SRV_CAPS):
         self.servername = 'localhost'
+        self.caps = caps # IRCv3 capabilities, None if CAP is not supported
+        self.batches = 0 # Batches sent, for batch references
         self.channels = {} # Existing channels (IRCChannel instances) by channelname
         self.clients = {}  # Connected clients (IRCClient instances) by nickname
+        self.ssl_context = ssl_context # Server side SSLContext for TLS connections
         SocketServer.TCPServer.__init__(self, server_address, RequestHandlerClass)
 
+    def get_request(self):
+        request, client_address = SocketServer.TCPServer.get_request(self)
+        if self.ssl_context is not None:
+            # The handshake is done by the client handler, not by the accept loop
+            request = self.ssl_context.wrap_socket(request, server_side=True,
+                    do_handshake_on_connect=False)
+        return request, client_address
+
+
+def create_server(host, port, **kwargs):
+    """ Start an IRCServer on (host, port) in a daemon thread (a greenlet
+    once gevent monkey patched the threading module), return it.
+    """
+    server = IRCServer((host, port), IRCClient, **kwargs)
+    logger.info('Starting hircd on %s:%s', host, port)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
 
 class Daemon(object):
     """ Daemonize the current process (detach it from the console).
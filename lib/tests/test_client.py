@@ -0,0 +1,231 @@
+import gevent
+from gevent import socket
+
+from geventirc import Client, irc, message
+from geventirc.message import LazyMessage
+
+
+def fill(client, count):
+    for i in range(count):
+        client._enqueue(LazyMessage(':nick!u@h PRIVMSG #chan :%d' % i))
+
+def queued(client):
+    return [msg.raw for msg in client._recv_queue.queue]
+
+def test_drop_oldest():
+    client = Client('localhost', 'bot', recv_queue_size=3,
+            overflow_policy=irc.DROP_OLDEST)
+    fill(client, 5)
+    assert [raw.split(':')[-1] for raw in queued(client)] == ['2', '3', '4']
+    assert client.stats['recv_dropped_oldest'] == 2
+
+def test_drop_command():
+    client = Client('localhost', 'bot', recv_queue_size=3,
+            overflow_policy=irc.DROP_COMMAND)
+    fill(client, 5)
+    assert len(queued(client)) == 3
+    assert client.stats['recv_dropped_command'] == 2
+
+def test_drop_command_blocks_other_commands():
+    client = Client('localhost', 'bot', recv_queue_size=3,
+            overflow_policy=irc.DROP_COMMAND)
+    fill(client, 3)
+    putter = gevent.spawn(client._enqueue, LazyMessage('PING :srv'))
+    gevent.sleep(0)
+    assert client.stats['recv_blocked'] == 1
+    assert not putter.ready()
+    client._recv_queue.get()
+    putter.join(1)
+    assert queued(client)[-1] == 'PING :srv'
+
+
+class RecordingSocket(object):
+
+    def __init__(self):
+        self.sent = []
+
+    def sendall(self, data):
+        self.sent.append(data)
+
+
+def test_send_coalescing():
+    client = Client('localhost', 'bot', send_batch_messages=64)
+    client._socket = sock = RecordingSocket()
+    sender = gevent.spawn(client._send_loop)
+    for i in range(200):
+        client.send_message(message.Join('#chan%d' % i))
+    client.msg('#chan', 'first line\nsecond line')
+    gevent.sleep(0)
+    sender.kill()
+    assert len(sock.sent) == 4
+    data = ''.join(sock.sent)
+    assert data.startswith('JOIN :#chan0\r\nJOIN :#chan1\r\n')
+    assert data.endswith('PRIVMSG #chan :first line\r\nPRIVMSG #chan :second line\r\n')
+    assert client.stats['sent_messages'] == 202
+
+
+def test_unicode_encoding():
+    msg = message.PrivMsg(u'#chan', u'caf\xe9')
+    assert msg.encode() == 'PRIVMSG #chan :caf\xc3\xa9\r\n'
+    assert message.PrivMsg('#chan', 'caf\xe9').encode() == 'PRIVMSG #chan :caf\xe9\r\n'
+
+
+def test_backoff_delay():
+    client = Client('localhost', 'bot', reconnect_delay=1, reconnect_max_delay=10)
+    delays = []
+    for attempt in range(6):
+        client._attempts = attempt
+        delays.append(client.backoff_delay())
+    assert delays == [1, 2, 4, 8, 10, 10]
+    client.reconnect_jitter = 2
+    assert 10 <= client.backoff_delay() <= 12
+
+
+def test_single_reconnect_owner():
+    client = Client('localhost', 'bot', reconnect_delay=10)
+    client.state = irc.CONNECTED
+    client._connection_lost()
+    reconnector = client._reconnector
+    client._connection_lost()
+    client.reconnect(wait=False)
+    assert client._reconnector is reconnector
+    assert client.state == irc.BACKOFF
+    client.stop()
+    assert reconnector.dead
+    client._connection_lost()
+    assert client.state == irc.CLOSED
+
+
+def test_connection_lost_without_auto_reconnect():
+    client = Client('localhost', 'bot', auto_reconnect=False)
+    states = []
+    client.add_state_handler(lambda client, old, new: states.append((old, new)))
+    client.state = irc.CONNECTED
+    client._connection_lost()
+    assert states == [(irc.CONNECTED, irc.CLOSED)]
+    assert client._reconnector is None
+
+
+def test_registration_timeout():
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(5)
+    client = Client('127.0.0.1', 'bot', port=server.getsockname()[1],
+            registration_timeout=0.05, reconnect_delay=10)
+    states = []
+    client.add_state_handler(lambda client, old, new: states.append(new))
+    client.start()
+    with gevent.Timeout(1):
+        while client.state != irc.BACKOFF:
+            gevent.sleep(0.01)
+    assert states == [irc.CONNECTING, irc.REGISTERING, irc.BACKOFF]
+    client.stop()
+    server.close()
+
+
+def test_messages_wait_for_registration():
+    client = Client('localhost', 'bot')
+    client.msg('#chan', 'queued before start')
+    client.send_message(message.Join('#early'))
+    client.send_message(message.Command(['secret'], command='PASS'))
+    client.send_message(message.Join('#later'))
+    client._hold(client._send_queue.drain())
+    client.state = irc.REGISTERING
+    client.send_message(message.Nick('bot'))
+    client.msg('#chan', 'sent while registering')
+    assert [item[0] for item in client._send_queue.drain()] == [
+            'PASS :secret\r\n', 'NICK :bot\r\n']
+    assert client.stats['journal_kept'] == 2
+    assert client.stats['journal_dropped'] == 0
+    client._welcomed()
+    client._group.join()
+    assert [item[0] for item in client._send_queue.drain()] == [
+            'JOIN :#early\r\n',
+            'JOIN :#later\r\n',
+            'PRIVMSG #chan :queued before start\r\n',
+            'PRIVMSG #chan :sent while registering\r\n']
+
+
+def sent(client):
+    return [item[0] for item in client._send_queue.drain()]
+
+def test_cap_negotiation():
+    client = Client('localhost', 'bot', caps=('batch', 'echo-message', 'sasl'))
+    client.caps.start(client)
+    assert sent(client) == ['CAP LS :302\r\n']
+    client._process(LazyMessage(':srv CAP * LS * :batch multi-prefix'))
+    assert not sent(client)
+    client._process(LazyMessage(':srv CAP * LS :echo-message sasl=PLAIN,EXTERNAL'))
+    assert client.caps.available['sasl'] == 'PLAIN,EXTERNAL'
+    assert sent(client) == ['CAP REQ :batch echo-message sasl\r\n']
+    client._process(LazyMessage(':srv CAP * NAK :batch echo-message sasl'))
+    assert sent(client) == ['CAP :END\r\n']
+    assert not client.caps.enabled and not client.caps.negotiating
+    client._process(LazyMessage(':srv CAP bot NEW :batch'))
+    assert sent(client) == ['CAP REQ :batch\r\n']
+    client._process(LazyMessage(':srv CAP bot ACK :batch'))
+    assert 'batch' in client.caps
+    assert not sent(client)
+    client._process(LazyMessage(':srv CAP bot DEL :batch'))
+    assert 'batch' not in client.caps
+
+def test_cap_unknown_command():
+    client = Client('localhost', 'bot', caps=('batch',))
+    client.caps.start(client)
+    client._process(LazyMessage(':srv 421 bot CAP :Unknown command'))
+    assert not client.caps.negotiating
+
+
+def netsplit(client, reference, count, outer=None):
+    tag = '@batch=%s ' % outer if outer else ''
+    client._process(LazyMessage(tag + ':srv BATCH +%s netsplit a.srv b.srv' % reference))
+    for i in range(count):
+        client._process(LazyMessage('@batch=%s :n%d!u@h QUIT :a.srv b.srv' % (reference, i)))
+    client._process(LazyMessage(':srv BATCH -%s' % reference))
+
+def test_batch():
+    client = Client('localhost', 'bot', recv_queue_size=0, inline_handlers=True)
+    batches = []
+    quits = []
+    client.add_handler(lambda client, msg: batches.append(msg), 'BATCH')
+    client.add_handler(lambda client, msg: quits.append(msg), 'QUIT')
+    netsplit(client, 'a', 100)
+    client._process(LazyMessage(':n!u@h QUIT :bye'))
+    assert len(batches) == 1 and len(quits) == 101
+    batch = batches[0]
+    assert (batch.reference, batch.type, batch.params[1:]) == ('a', 'netsplit', ['a.srv', 'b.srv'])
+    assert [msg.command for msg in batch.messages] == ['QUIT'] * 100
+    assert batch.encode() == ':srv BATCH +a netsplit a.srv :b.srv\r\n'
+    assert not client._batches
+
+def test_aggregated_batch():
+    client = Client('localhost', 'bot', recv_queue_size=0, inline_handlers=True,
+            aggregate_batches=('netsplit',))
+    batches = []
+    quits = []
+    client.add_handler(lambda client, msg: batches.append(msg), 'BATCH')
+    client.add_handler(lambda client, msg: quits.append(msg), 'QUIT')
+    netsplit(client, 'a', 100)
+    client._process(LazyMessage(':n!u@h QUIT :bye'))
+    assert len(batches) == 1 and len(quits) == 1
+    assert len(batches[0].messages) == 100
+
+def test_nested_batch():
+    client = Client('localhost', 'bot', recv_queue_size=0, inline_handlers=True)
+    batches = []
+    client.add_handler(lambda client, msg: batches.append(msg), 'BATCH')
+    client._process(LazyMessage(':srv BATCH +outer chathistory #chan'))
+    netsplit(client, 'inner', 2, outer='outer')
+    client._process(LazyMessage('@batch=outer :n!u@h PRIVMSG #chan :hi'))
+    client._process(LazyMessage(':srv BATCH -outer'))
+    assert len(batches) == 1
+    inner, privmsg = batches[0].messages
+    assert inner.type == 'netsplit' and len(inner.messages) == 2
+    assert privmsg.command == 'PRIVMSG'
+
+def test_batch_without_handlers():
+    client = Client('localhost', 'bot', recv_queue_size=0, inline_handlers=True)
+    quits = []
+    client.add_handler(lambda client, msg: quits.append(msg), 'QUIT')
+    netsplit(client, 'a', 10)
+    assert len(quits) == 10
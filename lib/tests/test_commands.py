@@ -0,0 +1,118 @@
+import pytest
+
+from geventirc import Client, handlers
+from geventirc.handlers import BotCommand, CommandError, CommandHandler, CommandTrie
+from geventirc.message import LazyMessage
+
+
+def privmsg(client, target, content, nick='someone'):
+    client._process(LazyMessage(':%s!u@h PRIVMSG %s :%s' % (nick, target, content)))
+
+def sent(client):
+    return [item[0] for item in client._send_queue.drain()]
+
+
+def test_trie():
+    trie = CommandTrie()
+    weather, welcome, time = object(), object(), object()
+    trie.add('weather', weather)
+    trie.add('w', weather)
+    trie.add('welcome', welcome)
+    trie.add('time', time)
+    assert trie.lookup('weather') is weather
+    assert trie.lookup('w') is weather
+    assert trie.lookup('wea') is weather
+    assert trie.lookup('wel') is welcome
+    assert trie.lookup('we') is None
+    assert trie.lookup('t') is time
+    assert trie.lookup('times') is None
+    assert trie.lookup('') is None
+
+def test_parse():
+    command = BotCommand('remind', None, args=[('minutes', int), ('unit', str, 'min'), '*text'])
+    assert command.parse(['5', 'h', 'buy', 'milk']) == {'minutes': 5, 'unit': 'h', 'text': 'buy milk'}
+    assert command.parse(['5']) == {'minutes': 5, 'unit': 'min', 'text': ''}
+    assert command.usage('!') == '!remind <minutes> [unit] [text...]'
+    with pytest.raises(CommandError):
+        command.parse(['five'])
+    with pytest.raises(CommandError):
+        command.parse([])
+    with pytest.raises(CommandError):
+        BotCommand('ping', None).parse(['extra'])
+
+def test_dispatch():
+    client = Client('localhost', 'bot', recv_queue_size=0)
+    commands = CommandHandler()
+    calls = []
+
+    @commands.command(args=['city'], aliases=['w'], blocking=False)
+    def weather(client, msg, city):
+        calls.append(city)
+
+    client.add_handler(commands)
+    privmsg(client, '#chan', '!weather paris')
+    privmsg(client, '#chan', '!W Lyon')
+    privmsg(client, '#chan', '!wea')
+    privmsg(client, '#chan', 'weather nantes')
+    privmsg(client, 'bot', 'weather nantes')
+    assert calls == ['paris', 'Lyon', 'nantes']
+    assert sent(client) == ['PRIVMSG #chan :missing city (usage: !weather <city>)\r\n']
+    assert client.stats['commands'] == 3
+
+def test_cooldowns(monkeypatch):
+    client = Client('localhost', 'bot', recv_queue_size=0)
+    commands = CommandHandler()
+    calls = []
+    commands.add('roll', handlers.inline(lambda client, msg: calls.append(msg.prefix)),
+            user_cooldown=10, channel_cooldown=2, blocking=False)
+    client.add_handler(commands)
+    now = [1000.0]
+    monkeypatch.setattr(handlers.time, 'time', lambda: now[0])
+    privmsg(client, '#chan', '!roll', nick='alice')
+    privmsg(client, '#chan', '!roll', nick='bob')
+    now[0] += 3
+    privmsg(client, '#chan', '!roll', nick='ALICE')
+    privmsg(client, '#chan', '!roll', nick='bob')
+    privmsg(client, '#other', '!roll', nick='carol')
+    assert [prefix.split('!')[0] for prefix in calls] == ['alice', 'bob', 'carol']
+    assert client.stats['command_cooldown'] == 2
+
+def test_usage_replies_cooldown(monkeypatch):
+    client = Client('localhost', 'bot', recv_queue_size=0)
+    commands = CommandHandler()
+    commands.add('weather', handlers.inline(lambda client, msg, city: None),
+            args=['city'], user_cooldown=10, blocking=False)
+    client.add_handler(commands)
+    monkeypatch.setattr(handlers.time, 'time', lambda: 1000.0)
+    for _ in range(5):
+        privmsg(client, '#chan', '!weather', nick='alice')
+    assert sent(client) == ['PRIVMSG #chan :missing city (usage: !weather <city>)\r\n']
+    assert client.stats['command_cooldown'] == 4
+
+def test_case_folding(monkeypatch):
+    client = Client('localhost', 'Bot', recv_queue_size=0)
+    commands = CommandHandler()
+    calls = []
+    commands.add('roll', handlers.inline(lambda client, msg: calls.append(msg.params[0])),
+            user_cooldown=10, blocking=False)
+    client.add_handler(commands)
+    monkeypatch.setattr(handlers.time, 'time', lambda: 1000.0)
+    # direct message without the prefix, to the nick in another case
+    privmsg(client, 'BOT', 'roll', nick='nick[a]')
+    # same nick under the RFC 1459 casemapping
+    privmsg(client, '#chan', '!roll', nick='NICK{A}')
+    assert calls == ['BOT']
+    assert client.stats['command_cooldown'] == 1
+
+def test_blocking_command():
+    client = Client('localhost', 'bot', recv_queue_size=0)
+    commands = CommandHandler(prefix='.')
+    calls = []
+    commands.add('slow', lambda client, msg: calls.append(msg))
+    client.add_handler(commands)
+    privmsg(client, '#chan', '.slow')
+    assert not calls
+    client._pool.join()
+    assert len(calls) == 1
+    commands.remove('slow')
+    assert commands.lookup('slow') is None
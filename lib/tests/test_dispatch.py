@@ -0,0 +1,106 @@
+import pytest
+from geventirc import replycode
+from geventirc import handlers
+from geventirc.dispatch import Dispatcher, normalize_command
+
+
+@pytest.mark.parametrize(("command", "normalized"), (
+    (1, '001'),
+    ('1', '001'),
+    (replycode.ERR_NICKNAMEINUSE, '433'),
+    ('privmsg', 'PRIVMSG'),
+    ('PING', 'PING'),
+))
+def test_normalize_command(command, normalized):
+    assert normalize_command(command) == normalized
+
+
+def handler(client, msg):
+    pass
+
+def other_handler(client, msg):
+    pass
+
+def global_handler(client, msg):
+    pass
+
+
+class Handler(object):
+    commands = ['PRIVMSG', replycode.RPL_WELCOME]
+
+    def __call__(self, client, msg):
+        pass
+
+
+def test_global_handlers_merged():
+    dispatcher = Dispatcher(inline=True)
+    dispatcher.add(global_handler)
+    dispatcher.add(handler, 'PING')
+    assert dispatcher.get('PING') == ((global_handler, handler), ())
+    assert dispatcher.get('PRIVMSG') == ((global_handler,), ())
+
+def test_registration_order_and_dedup():
+    dispatcher = Dispatcher(inline=True)
+    dispatcher.add(handler, 'PING')
+    dispatcher.add(other_handler, 'PING')
+    dispatcher.add(handler, 'ping')
+    assert dispatcher.get('PING') == ((handler, other_handler), ())
+
+def test_commands_attribute():
+    dispatcher = Dispatcher()
+    h = Handler()
+    dispatcher.add(h)
+    assert dispatcher.get('001') == ((), (h,))
+    assert dispatcher.get('PRIVMSG') == ((), (h,))
+    dispatcher.remove(h)
+    assert dispatcher.get('001') == ((), ())
+
+def test_remove():
+    dispatcher = Dispatcher()
+    dispatcher.add(global_handler)
+    dispatcher.add(handler, 'PING', 'PONG')
+    dispatcher.remove(handler, 'PING')
+    assert dispatcher.get('PING') == ((), (global_handler,))
+    assert dispatcher.get('PONG') == ((), (global_handler, handler))
+    dispatcher.remove(global_handler)
+    assert dispatcher.get('PONG') == ((), (handler,))
+    with pytest.raises(ValueError):
+        dispatcher.remove(handler, 'PING')
+
+def test_partial_remove():
+    dispatcher = Dispatcher()
+    dispatcher.add(handler, 'PING', 'PONG')
+    with pytest.raises(ValueError):
+        dispatcher.remove(handler, 'PONG', 'PING', 'JOIN')
+    assert dispatcher.get('PING') == ((), (handler,))
+    assert dispatcher.get('PONG') == ((), (handler,))
+    dispatcher.remove(handler, 'PONG', 'pong')
+    assert dispatcher.get('PONG') == ((), ())
+
+@handlers.blocking
+def blocking_handler(client, msg):
+    pass
+
+def test_blocking_attribute():
+    dispatcher = Dispatcher()
+    dispatcher.add(handlers.ping_handler, 'PING')
+    dispatcher.add(handler, 'PING')
+    assert dispatcher.get('PING') == ((handlers.ping_handler,), (handler,))
+
+    dispatcher = Dispatcher(inline=True)
+    dispatcher.add(blocking_handler, 'PING')
+    dispatcher.add(handler, 'PING')
+    assert dispatcher.get('PING') == ((handler,), (blocking_handler,))
+
+
+def test_client_inline_handlers_order():
+    from geventirc import Client
+    from geventirc.message import LazyMessage
+    client = Client('localhost', 'bot', inline_handlers=True)
+    calls = []
+    client.add_handler(lambda client, msg: calls.append('global'))
+    client.add_handler(lambda client, msg: calls.append(msg.command), 'PING')
+    client.add_handler(lambda client, msg: 1 / 0, 'PING')
+    client.add_handler(lambda client, msg: calls.append('last'), 'PING')
+    client._handle(LazyMessage('PING :srv'))
+    assert calls == ['global', 'PING', 'last']
@@ -0,0 +1,107 @@
+import time
+
+import gevent
+import pytest
+
+from geventirc import Client, message
+from geventirc.flood import TokenBucket, SendQueue, Journal, CONTROL, BULK
+
+
+def test_token_bucket():
+    bucket = TokenBucket(10, 3)
+    assert [bucket.take() for _ in range(4)] == [True, True, True, False]
+    assert 0 < bucket.delay() <= 0.1
+    gevent.sleep(0.11)
+    assert bucket.take()
+
+
+def drain(queue):
+    items = []
+    while queue:
+        items.append(queue.get_nowait()[0])
+    return items
+
+def test_lanes():
+    queue = SendQueue()
+    queue.put('BULK', 'PRIVMSG', '#a', lane=BULK)
+    queue.put('PRIVMSG 1', 'PRIVMSG', '#a')
+    queue.put('PRIVMSG 2', 'PRIVMSG', '#a')
+    queue.put('PONG', 'PONG')
+    queue.put('PRIVMSG 3', 'PRIVMSG', '#a', lane=CONTROL)
+    assert drain(queue) == ['PONG', 'PRIVMSG 3', 'PRIVMSG 1', 'PRIVMSG 2', 'BULK']
+
+def test_fair_targets():
+    queue = SendQueue(fair=True)
+    for i in range(3):
+        queue.put('#a %d' % i, 'PRIVMSG', '#a')
+    queue.put('#b 0', 'PRIVMSG', '#b')
+    queue.put('#c 0', 'PRIVMSG', '#c')
+    assert drain(queue) == ['#a 0', '#b 0', '#c 0', '#a 1', '#a 2']
+
+def test_maxsize():
+    queue = SendQueue(maxsize=1)
+    queue.put('a')
+    assert queue.full()
+    putter = gevent.spawn(queue.put, 'b')
+    gevent.sleep(0)
+    assert not putter.ready()
+    assert queue.get()[0] == 'a'
+    putter.join(1)
+    assert queue.get()[0] == 'b'
+    with pytest.raises(gevent.queue.Empty):
+        queue.get_nowait()
+
+
+def test_journal():
+    queue = SendQueue()
+    queue.put('NICK', 'NICK')
+    queue.put('JOIN', 'JOIN', '#a')
+    for i in range(4):
+        queue.put('PRIVMSG %d' % i, 'PRIVMSG', '#a')
+    queue.put('NOTICE', 'NOTICE', 'nick')
+    journal = Journal(maxsize=3)
+    assert journal.keep(queue.drain()) == (5, 4)
+    assert not queue
+    items, dropped = journal.replay()
+    assert [item[0] for item in items] == ['PRIVMSG 2', 'PRIVMSG 3', 'NOTICE']
+    assert dropped == 0
+    assert not journal
+
+def test_journal_ttl():
+    journal = Journal(ttl=10)
+    now = time.time()
+    journal.keep([('old', '#a', now - 11, 'PRIVMSG'), ('new', '#a', now - 9, 'PRIVMSG')])
+    items, dropped = journal.replay()
+    assert [item[0] for item in items] == ['new']
+    assert dropped == 1
+
+
+class RecordingSocket(object):
+
+    def __init__(self):
+        self.sent = []
+
+    def sendall(self, data):
+        self.sent.append((time.time(), data))
+
+
+def test_client_flood_control():
+    client = Client('localhost', 'bot', flood_rate=50, flood_burst=5)
+    client._socket = sock = RecordingSocket()
+    for i in range(10):
+        client.send_message(message.PrivMsg('#chan', str(i)))
+    client.send_message(message.Pong('bot'))
+    start = time.time()
+    sender = gevent.spawn(client._send_loop)
+    with gevent.Timeout(2):
+        while client.stats['sent_messages'] < 11:
+            gevent.sleep(0.01)
+    sender.kill()
+    lines = ''.join(data for _, data in sock.sent).split('\r\n')[:-1]
+    assert lines[0] == 'PONG :bot'
+    assert lines[1:] == ['PRIVMSG #chan :%d' % i for i in range(10)]
+    # first burst goes out at once, the rest at 50 messages per second
+    assert sock.sent[0][1].count('\r\n') == 5
+    assert sock.sent[-1][0] - start >= 0.1
+    assert client.stats['throttled']
+    assert client.stats['queue_delay_max'] >= 0.1
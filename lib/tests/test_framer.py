@@ -0,0 +1,60 @@
+import pytest
+from geventirc.framer import LineFramer
+
+
+def test_split_lines():
+    framer = LineFramer()
+    assert framer.feed('PING :a\r\nPING :b\r\n') == ['PING :a', 'PING :b']
+    assert len(framer) == 0
+
+def test_partial_line():
+    framer = LineFramer()
+    assert framer.feed(':srv 001 nick :Wel') == []
+    assert framer.feed('come\r') == []
+    assert framer.feed('\n:srv 002') == [':srv 001 nick :Welcome']
+    assert framer.feed(' nick :x\r\n') == [':srv 002 nick :x']
+
+def test_bare_newline():
+    framer = LineFramer()
+    assert framer.feed('PING :a\nPING :b\r\n') == ['PING :a', 'PING :b']
+
+@pytest.mark.parametrize(('chunk',), ((1,), (3,), (7,), (512,)))
+def test_chunked(chunk):
+    data = ''.join(':nick!u@h PRIVMSG #chan :message %d\r\n' % i for i in range(50))
+    framer = LineFramer()
+    lines = []
+    for pos in range(0, len(data), chunk):
+        lines += framer.feed(data[pos:pos + chunk])
+    assert lines == data.split('\r\n')[:-1]
+
+def test_max_line_length():
+    framer = LineFramer(max_line_length=10)
+    assert framer.feed('0123456789abc\r\nPING\r\n') == ['PING']
+    assert framer.dropped == 1
+
+def test_max_line_length_unterminated():
+    framer = LineFramer(max_line_length=10)
+    assert framer.feed('0123456789abc') == []
+    assert len(framer) == 0
+    assert framer.feed('def\r\nPING\r\n') == ['PING']
+    assert framer.dropped == 1
+
+
+class FakeSocket(object):
+
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+
+    def recv_into(self, buf, size):
+        if not self.chunks:
+            return 0
+        data = self.chunks.pop(0)[:size]
+        buf[:len(data)] = data
+        return len(data)
+
+def test_recv_from():
+    framer = LineFramer(recv_size=8)
+    sock = FakeSocket(['PING :a\r', '\nPONG\r\n'])
+    assert framer.recv_from(sock) == []
+    assert framer.recv_from(sock) == ['PING :a', 'PONG']
+    assert framer.recv_from(sock) is None
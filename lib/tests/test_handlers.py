@@ -0,0 +1,41 @@
+import pytest
+
+from geventirc import handlers
+from geventirc.handlers import PrivMsgBuffer
+
+
+def test_buffer_size():
+    buffer = PrivMsgBuffer(maxlen=3)
+    for i, nick in enumerate(['alice', 'bob', 'Alice', 'carol', 'dave']):
+        buffer.append(nick, 'message %d' % i)
+    assert [record.text for record in buffer] == ['message 2', 'message 3', 'message 4']
+    assert [record.text for record in buffer.from_nick('ALICE')] == ['message 2']
+    assert list(buffer.from_nick('bob')) == []
+    assert sorted(buffer.nicks()) == ['Alice', 'carol', 'dave']
+
+def test_buffer_nick_folding():
+    buffer = PrivMsgBuffer(maxlen=2)
+    buffer.append('[Bot]', 'one')
+    buffer.append('{bot}', 'two')
+    buffer.append('dave', 'three')
+    assert [record.text for record in buffer.from_nick('{BOT}')] == ['two']
+    assert sorted(buffer.nicks()) == ['dave', '{bot}']
+    with pytest.raises(ValueError):
+        PrivMsgBuffer(maxlen=0)
+
+def test_buffer_age(monkeypatch):
+    now = [100]
+    monkeypatch.setattr(handlers.time, 'time', lambda: now[0])
+    buffer = PrivMsgBuffer(max_age=10)
+    buffer.append('alice', 'old')
+    now[0] = 105
+    buffer.append('bob', 'newer')
+    now[0] = 111
+    buffer.append('alice', 'new')
+    assert [record.text for record in buffer] == ['newer', 'new']
+    now[0] = 116
+    assert len(buffer) == 1
+    assert [record.text for record in buffer.from_nick('alice')] == ['new']
+    assert buffer.nicks() == ['alice']
+    now[0] = 200
+    assert buffer.nicks() == []
@@ -3,19 +3,20 @@ Created on 29.11.2012
 
 @author: nimrod
 '''
-import gevent, gevent.monkey
+import gevent, gevent.monkey, gevent.event
 gevent.monkey.patch_all()
 
 import pytest
 import logging
 import socket
-import sys
+import ssl
 import os
+import time
 
 import hircd
 
 from geventirc import Client
-from geventirc import handlers, replycode, message
+from geventirc import handlers, replycode, message, irc, tls, cap
 
 TEST_NICK = 'test_cl'
 TEST_PASSWORD = 'testpass'
@@ -37,18 +38,6 @@ def create_client(host, nickname, password=None, **kwargs):
     cl.add_handler(handlers.IRCShutdownHandler())
     return cl
 
-def create_server(host, port):
-    try:
-        ircd = hircd.IRCServer((host, port), hircd.IRCClient)
-        hircd.logger.info('Starting hircd on %s:%s', host, port)
-        gevent.spawn(ircd.serve_forever)
-        hircd.logger.info('hircd started')
-    except socket.error, e:
-        logging.error(repr(e))
-        sys.exit(-2)
-    else:
-        return ircd
-
 
 class TestSetupClass(object):
     """ Fails with PyDev. So make sure to run py.test from console """
@@ -71,7 +60,7 @@ class TestSetupClass(object):
 class TestLocal(object):
     @classmethod
     def setup_class(cls):
-        cls.server = create_server('localhost', TEST_PORT)
+        cls.server = hircd.create_server('localhost', TEST_PORT)
         cls.client = create_client('localhost', TEST_NICK, port=TEST_PORT)
         cls.msgbuff = handlers.PrivMsgBuffer()
         cls.client2 = create_client('localhost', 'OTHERCLIENT')
@@ -116,9 +105,8 @@ class TestLocal(object):
         with gevent.Timeout(0.5):
             while not self.msgbuff.buffer:
                 gevent.sleep(0.05)
-        # print self.msgbuff.buffer[0][0], ' '.join(self.msgbuff.buffer[0][1].params[1:])
-        assert self.msgbuff.buffer[0][0] == self.client.nick
-        assert ' '.join(self.msgbuff.buffer[0][1].params[1:]) == msgtext
+        assert self.msgbuff.buffer[0].nick == self.client.nick
+        assert self.msgbuff.buffer[0].text == msgtext
 
     def test_pingpong(self):
         pass
@@ -136,12 +124,13 @@ class TestLocal(object):
 
     def test_reconnect(self):
         self.client.reconnect()
-        assert len(self.client._send_queue.queue) == 2
-        assert self.client.nick not in self.server.clients
+        assert self.client.state in (irc.REGISTERING, irc.CONNECTED)
+        assert self.client.stats['reconnects'] == 1
         with gevent.Timeout(3):
-            while self.client._send_queue.queue:
+            while self.client.state != irc.CONNECTED:
                 gevent.sleep(0.1)
-        assert not self.client._send_queue.queue # Reconnection commands got send
+        assert not self.client._send_queue # Reconnection commands got send
+        assert self.client.nick in self.server.clients
 
     def test_shutdown(self):
         self.client.stop()
@@ -150,6 +139,233 @@ class TestLocal(object):
         assert self.client._socket is None
 
 
+class TestPriorityLanes(object):
+    """ PING round trip while thousands of PRIVMSGs wait in the send queue
+    """
+    port = TEST_PORT + 1
+    channel = '#lanes'
+
+    @classmethod
+    def setup_class(cls):
+        cls.server = hircd.create_server('localhost', cls.port)
+        cls.client = Client('localhost', 'lanes', port=cls.port,
+                flood_rate=100, flood_burst=10)
+        cls.pong = gevent.event.Event()
+        cls.client.add_handler(lambda client, msg: cls.pong.set(), 'PONG')
+        cls.client.start()
+        cls.client.send_message(message.Join(cls.channel))
+        with gevent.Timeout(1):
+            while cls.channel not in cls.server.channels:
+                gevent.sleep(0.01)
+
+    @classmethod
+    def teardown_class(cls):
+        cls.client.stop()
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def ping(self, lane=None):
+        self.pong.clear()
+        start = time.time()
+        self.client.send_message(message.Ping('localhost'), lane)
+        self.pong.wait(5)
+        assert self.pong.is_set()
+        return time.time() - start
+
+    def test_ping_latency_with_backlog(self):
+        idle = self.ping()
+        for i in range(2000):
+            self.client.send_message(message.PrivMsg(self.channel, 'backlog %d' % i))
+        loaded = self.ping()
+        assert len(self.client._send_queue) > 1000
+        assert loaded < idle + 0.5
+
+
+class TestServerRestart(object):
+    """ Connections dropped by a server restart come back once
+    """
+    port = TEST_PORT + 2
+    channel = '#restart'
+
+    @classmethod
+    def setup_class(cls):
+        cls.server = hircd.create_server('localhost', cls.port)
+        cls.client = Client('localhost', 'restarted', port=cls.port,
+                reconnect_delay=0.05, reconnect_max_delay=0.2)
+        cls.client.add_handler(handlers.ping_handler, 'PING')
+        cls.client.add_handler(handlers.JoinHandler(cls.channel))
+        cls.states = []
+        cls.client.add_state_handler(
+                lambda client, old, new: cls.states.append(new))
+
+    @classmethod
+    def teardown_class(cls):
+        cls.client.stop()
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def wait_connected(self):
+        with gevent.Timeout(3):
+            while self.client.state != irc.CONNECTED:
+                gevent.sleep(0.01)
+
+    def test_connect(self):
+        self.client.start()
+        self.wait_connected()
+        assert self.states == [irc.CONNECTING, irc.REGISTERING, irc.CONNECTED]
+
+    def test_restart(self):
+        del self.states[:]
+        self.server.shutdown()
+        self.server.server_close()
+        for client in self.server.clients.values():
+            client.request.shutdown(socket.SHUT_RDWR)
+        with gevent.Timeout(1):
+            while self.client.stats['reconnect_attempts'] < 3:
+                gevent.sleep(0.01)
+        assert self.client.state == irc.BACKOFF
+        assert self.client._attempts >= 3
+        # queued while disconnected, sent once the channel is joined again
+        self.client.msg(self.channel, 'missed me?')
+        self.client.send_message(message.Ping('localhost'))
+        self.__class__.server = hircd.create_server('localhost', self.port)
+        self.wait_connected()
+        assert self.states[0] == irc.BACKOFF
+        assert self.states[-3:] == [irc.CONNECTING, irc.REGISTERING, irc.CONNECTED]
+        assert irc.CLOSED not in self.states
+        assert self.client.stats['reconnects'] == 1
+        assert self.client._attempts == 0
+        assert self.server.clients.keys() == [self.client.nick]
+        # replayed once queued, the server may not have joined us yet
+        with gevent.Timeout(1):
+            while not self.client.stats['journal_replayed'] or \
+                    self.channel not in self.server.channels:
+                gevent.sleep(0.01)
+        # the PING is not journaled but held until the welcome
+        assert self.client.stats['journal_kept'] == 1
+        assert self.client.stats['journal_dropped'] == 0
+
+    def test_stop_while_backing_off(self):
+        self.client.reconnect_delay = 10
+        self.client.reconnect(wait=False)
+        assert self.client.state == irc.BACKOFF
+        self.client.stop()
+        assert self.client.state == irc.CLOSED
+        assert self.client._reconnector is None
+        self.client.join()
+
+
+class TestTLS(object):
+    """ TLS connection to hircd with a self-signed certificate
+    """
+    port = TEST_PORT + 3
+    certfile = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'localhost.pem')
+
+    @classmethod
+    def setup_class(cls):
+        server_context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+        server_context.load_cert_chain(cls.certfile)
+        cls.server_names = []
+        server_context.set_servername_callback(
+                lambda sock, name, context: cls.server_names.append(name))
+        cls.server = hircd.IRCServer(('localhost', cls.port), hircd.IRCClient,
+                ssl_context=server_context)
+        gevent.spawn(cls.server.serve_forever)
+        cls.context = ssl.create_default_context(cafile=cls.certfile)
+        cls.client = Client('localhost', 'secure', port=cls.port,
+                ssl_context=cls.context, reconnect_delay=0.01)
+
+    @classmethod
+    def teardown_class(cls):
+        cls.client.stop()
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def wait_connected(self):
+        with gevent.Timeout(3):
+            while self.client.state != irc.CONNECTED:
+                gevent.sleep(0.01)
+
+    def test_connect(self):
+        self.client.start()
+        self.wait_connected()
+        assert self.client._socket.cipher()
+        assert self.client._socket.getpeercert()['subject'] == ((('commonName', 'localhost'),),)
+        assert self.server_names == ['localhost']
+
+    def test_reconnect(self):
+        self.client.reconnect()
+        self.wait_connected()
+        if tls.HAS_SESSIONS:
+            assert self.client.stats['tls_resumed'] == 1
+
+    def test_verification_failure(self):
+        client = Client('localhost', 'insecure', port=self.port, ssl=True)
+        with pytest.raises(ssl.SSLError):
+            client.start()
+        assert client.state == irc.CLOSED
+        assert client._socket is None
+
+
+class TestCaps(object):
+    """ Capability negotiation with hircd, batches and echoed messages
+    """
+    port = TEST_PORT + 4
+
+    @classmethod
+    def setup_class(cls):
+        cls.server = hircd.create_server('localhost', cls.port)
+        cls.client = Client('localhost', 'capable', port=cls.port, caps=cap.DEFAULT_CAPS)
+        cls.batches = []
+        cls.privmsgs = []
+        cls.client.add_handler(lambda client, msg: cls.batches.append(msg), 'BATCH')
+        cls.client.add_handler(lambda client, msg: cls.privmsgs.append(msg), 'PRIVMSG')
+
+    @classmethod
+    def teardown_class(cls):
+        cls.client.stop()
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def wait_connected(self, client):
+        with gevent.Timeout(3):
+            while client.state != irc.CONNECTED:
+                gevent.sleep(0.01)
+
+    def test_connect(self):
+        self.client.start()
+        self.wait_connected(self.client)
+        assert self.client.caps.enabled == set(cap.DEFAULT_CAPS)
+        assert self.server.clients['capable'].caps == set(cap.DEFAULT_CAPS)
+
+    def test_batch(self):
+        self.client.send_message(message.Command(['1000'], command='NETSPLIT'))
+        with gevent.Timeout(3):
+            while not self.batches:
+                gevent.sleep(0.01)
+        batch, = self.batches
+        assert batch.type == 'netsplit'
+        assert len(batch.messages) == 1000
+        assert batch.messages[-1].prefix == 'split999!split@split.localhost'
+
+    def test_echo_message(self):
+        self.client.msg('capable', 'hello me')
+        with gevent.Timeout(1):
+            while len(self.privmsgs) < 2:
+                gevent.sleep(0.01)
+        assert [msg.prefix_parts[0] for msg in self.privmsgs] == ['capable', 'capable']
+
+    def test_server_without_cap(self):
+        self.server.caps = None
+        client = Client('localhost', 'incapable', port=self.port, caps=cap.DEFAULT_CAPS)
+        client.start()
+        try:
+            self.wait_connected(client)
+            assert not client.caps.enabled
+        finally:
+            client.stop()
+
+
 @pytest.mark.skipif('True')
 class TestRemote(object):
     """ Run tests against some serious IRC server """
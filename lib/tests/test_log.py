@@ -0,0 +1,65 @@
+import logging
+import time
+
+from geventirc import Client, handlers, irc
+from geventirc.log import IRCLogHandler
+
+
+def sent(client):
+    return [item[0] for item in client._send_queue.drain()]
+
+def handler_and_logger(client, **kwargs):
+    handler = IRCLogHandler(client, '#log', **kwargs)
+    logger = logging.getLogger('test_log.%d' % id(handler))
+    logger.propagate = False
+    logger.addHandler(handler)
+    return handler, logger
+
+
+def test_join_on_welcome():
+    client = Client('localhost', 'bot')
+    handler, _ = handler_and_logger(client)
+    assert any(isinstance(h, handlers.JoinHandler) for h in client._dispatcher.get('001')[0])
+    assert not sent(client)
+    handler.close()
+
+def test_burst_and_summary(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, 'time', lambda: now[0])
+    client = Client('localhost', 'bot')
+    handler, logger = handler_and_logger(client, capacity=50, burst=3)
+    for i in range(100):
+        logger.error('error %d\nTraceback...', i)
+        now[0] += 0.5
+    logger.warning('careful')
+    assert len(handler._records) == 50
+    handler._flush()
+    assert not client._send_queue
+    # queued while disconnected
+    now[0] += 30
+    client.state = irc.CONNECTED
+    handler._flush()
+    assert sent(client) == [
+        'PRIVMSG #log :error 0\r\n',
+        'PRIVMSG #log :error 1\r\n',
+        'PRIVMSG #log :error 2\r\n',
+        'PRIVMSG #log :97 more ERRORs, 1 more WARNINGs in the last 80s\r\n']
+    handler._flush()
+    assert not sent(client)
+    for i in range(5):
+        logger.error('error %d', i)
+    now[0] += 2.5
+    handler._flush()
+    assert sent(client)[-1] == 'PRIVMSG #log :2 more ERRORs in the last 2.5s\r\n'
+    handler.close()
+
+def test_flush_does_not_send():
+    client = Client('localhost', 'bot')
+    client.state = irc.CONNECTED
+    handler, logger = handler_and_logger(client)
+    assert sent(client) == ['JOIN :#log\r\n']
+    logger.error('error')
+    handler.flush()
+    assert not client._send_queue
+    assert len(handler._records) == 1
+    handler.close()
@@ -1,6 +1,7 @@
 import pytest
 from geventirc.message import irc_split, irc_unsplit, prefix_split, \
-        low_level_quote, low_level_dequote, ctcp_quote
+        low_level_quote, low_level_dequote, ctcp_quote, ctcp_dequote, \
+        CTCPMessage, LazyMessage, ProtocolViolationError
 
 message_splits = (
     ('NICK :test_name', ('', 'NICK', ['test_name'])),
@@ -14,7 +15,10 @@ message_splits = (
     (':Angel!wings@irc.org PRIVMSG Wiz :Are you receiving this message ?', 
             ('Angel!wings@irc.org', 'PRIVMSG', ['Wiz', 'Are you receiving this message ?'])),
     ('PRIVMSG kalt%millennium.stealth.net :Do you like cheese?', 
-            ('', 'PRIVMSG', ['kalt%millennium.stealth.net', 'Do you like cheese?']))          
+            ('', 'PRIVMSG', ['kalt%millennium.stealth.net', 'Do you like cheese?'])),
+
+    # IRCv3 message tags are not part of the split
+    ('@time=2012-06-30T23:59:60.419Z :srv NICK test_name', ('srv', 'NICK', ['test_name'])),
 )
 
 @pytest.mark.parametrize(("msg", "msgsplit"),  message_splits)
@@ -52,3 +56,131 @@ def test_ctcp_quoting():
     print repr(encoded)
     assert encoded == 'some mess\x10r\x100age with\x10nspeci:al\x100charaters'
 
+
+quoted_strings = (
+    '',
+    'no special characters',
+    '\rstarts with a special character',
+    'ends with one\0',
+    'M_QUOTE \x10 and \x10\x10 twice',
+    'CTCP \x01 delimiter and \x86 quote',
+)
+
+@pytest.mark.parametrize(("data",), [(s,) for s in quoted_strings])
+def test_quoting_round_trip(data):
+    assert low_level_dequote(low_level_quote(data)) == data
+    assert ctcp_dequote(ctcp_quote(data)) == data
+    assert '\r' not in low_level_quote(data)
+    assert '\x01' not in ctcp_quote(data)
+
+def test_quoting_fast_path():
+    data = 'hello world'
+    assert low_level_quote(data) is data
+    assert low_level_dequote(data) is data
+
+def test_dequote_unknown_sequence():
+    assert low_level_dequote('a\x10xb\x10') == 'axb'
+    assert ctcp_dequote('a\x86\x86b\x86ac\x86z') == 'a\x86b\x01cz'
+
+lazy_messages = (
+    'PING :irc.example.net',
+    ':srv 001 test_cl :Welcome to the network',
+    ':Angel!wings@irc.org PRIVMSG Wiz :Are you receiving this message ?',
+    ':Angel!wings@irc.org PRIVMSG #chan :\x01ACTION waves\x01',
+    ':Angel!wings@irc.org PRIVMSG Wiz :\x01VERSION\x01',
+    '@msgid=42;+example.com/flag :Angel!wings@irc.org PRIVMSG #chan :hi',
+)
+
+@pytest.mark.parametrize(("data",), [(m,) for m in lazy_messages])
+def test_lazy_message(data):
+    lazy = LazyMessage(data)
+    eager = CTCPMessage.decode(data)
+    assert lazy.command == eager.command
+    assert lazy.prefix == eager.prefix
+    assert lazy.params == eager.params
+    assert lazy.ctcp_params == eager.ctcp_params
+    assert lazy.prefix_parts == eager.prefix_parts
+    assert lazy.encode() == data + '\r\n'
+
+def test_lazy_message_routing_does_not_parse_params():
+    lazy = LazyMessage(':Angel!wings@irc.org PRIVMSG Wiz :hello')
+    assert lazy.command == 'PRIVMSG'
+    assert lazy._params is None
+    assert lazy.params == ['Wiz', 'hello']
+
+def test_lazy_message_malformed():
+    lazy = LazyMessage('PING')
+    with pytest.raises(ProtocolViolationError):
+        lazy.command
+
+def test_messages_have_no_dict():
+    from geventirc import message
+    for msg in (LazyMessage(':a!b@c PRIVMSG #chan :hi'),
+            message.PrivMsg('#chan', 'hi'), message.Me('#chan', 'waves'),
+            message.Join('#chan')):
+        assert not hasattr(msg, '__dict__')
+
+def test_prefix_parts_cached():
+    msg = LazyMessage(':Angel!wings@irc.org PRIVMSG Wiz :hi')
+    assert msg.prefix_parts is msg.prefix_parts
+    msg = CTCPMessage('PRIVMSG', ['Wiz'], [], prefix='Angel!wings@irc.org')
+    assert msg.prefix_parts == ('Angel', 'wings', 'irc.org')
+    msg.prefix = 'Trillian'
+    assert msg.prefix_parts == ('Trillian', None, None)
+
+def test_encode_cache():
+    from geventirc.message import EncodeCache, PrivMsg, Me, Join
+    cache = EncodeCache(4)
+    for _ in range(3):
+        assert cache.encode(PrivMsg('#chan', 'hi')) == 'PRIVMSG #chan :hi\r\n'
+        assert cache.encode(Me('nick', 'waves')) == Me('nick', 'waves').encode()
+    assert (cache.hits, cache.misses) == (4, 2)
+    assert cache.hit_rate == 4 / 6.0
+    for i in range(10):
+        cache.encode(Join('#chan%d' % i))
+    assert len(cache) <= 4
+    lazy = LazyMessage('PING :srv')
+    assert cache.encode(lazy) == 'PING :srv\r\n'
+    assert cache.misses == 12
+
+def test_pre_encoded():
+    from geventirc.message import PreEncoded, PrivMsg
+    msg = PreEncoded(PrivMsg('#chan', 'hi'))
+    assert msg.encode() == 'PRIVMSG #chan :hi\r\n'
+    assert msg.command == 'PRIVMSG'
+    assert msg.params == ['#chan', 'hi']
+
+
+tag_splits = (
+    ('@aaa=bbb;ccc;example.com/ddd=eee :nick!ident@host.com PRIVMSG me :Hello',
+        {'aaa': 'bbb', 'ccc': '', 'example.com/ddd': 'eee'}),
+    ('@a=x\\:y\\sz\\\\\\r\\n;b=\\q;c=trail\\ PING :srv',
+        {'a': 'x;y z\\\r\n', 'b': 'q', 'c': 'trail'}),
+    ('@a=;;b PING :srv', {'a': '', 'b': ''}),
+    ('PING :srv', {}),
+)
+
+@pytest.mark.parametrize(("data", "tags"), tag_splits)
+def test_tags(data, tags):
+    from geventirc.message import irc_split_tags, Message
+    assert irc_split_tags(data)[0] == tags
+    assert irc_split_tags(data)[1:] == irc_split(data)
+    assert Message.decode(data).tags == tags
+    assert LazyMessage(data).tags == tags
+
+def test_tags_parsed_on_access():
+    lazy = LazyMessage('@time=2012-06-30T23:59:60.419Z PING :srv')
+    assert lazy.command == 'PING'
+    assert lazy._tags == 'time=2012-06-30T23:59:60.419Z'
+    assert lazy.tags == {'time': '2012-06-30T23:59:60.419Z'}
+    assert lazy.tags is lazy.tags
+
+def test_encode_tags():
+    from geventirc.message import PrivMsg, Message, EncodeCache
+    msg = PrivMsg('#chan', 'hi')
+    msg.tags = {'+draft/reply': 'a;b c', 'label': ''}
+    data = msg.encode()
+    assert data == '@+draft/reply=a\\:b\\sc;label PRIVMSG #chan :hi\r\n'
+    assert Message.decode(data[:-2]).tags == msg.tags
+    assert EncodeCache().encode(msg) == data
+    assert msg.cache_key() is None
@@ -0,0 +1,151 @@
+import gevent, gevent.monkey
+gevent.monkey.patch_all()
+
+import itertools
+import socket
+
+import hircd
+
+from geventirc import ClientPool, handlers
+from geventirc.message import LazyMessage
+from geventirc.routing import Route
+
+TEST_PORT = 6670
+TEST_CHANNEL = '#pool'
+CLIENTS = 20
+
+
+class StalledSocket(object):
+    """ A connection whose peer stopped reading.
+    """
+
+    def sendall(self, data):
+        gevent.sleep(60)
+
+    def shutdown(self, how):
+        pass
+
+    def close(self):
+        pass
+
+
+class TestClientPool(object):
+
+    runs = itertools.count()
+
+    @classmethod
+    def setup_class(cls):
+        cls.server = hircd.create_server('localhost', TEST_PORT)
+
+    @classmethod
+    def teardown_class(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setup_method(self, method):
+        self.pool = ClientPool(stagger=0.005)
+        self.welcomed = []
+        self.pool.add_handler(handlers.ping_handler, 'PING')
+        self.pool.add_handler(handlers.JoinHandler(TEST_CHANNEL))
+        self.pool.add_handler(
+                handlers.inline(lambda client, msg: self.welcomed.append(client.nick)),
+                '001')
+        # the server may not have seen the clients of the previous test leave
+        run = next(self.runs)
+        for i in range(CLIENTS):
+            self.pool.add_client('localhost', 'pooled%d_%d' % (run, i), port=TEST_PORT)
+
+    def teardown_method(self, method):
+        self.pool.stop()
+
+    def start(self):
+        self.pool.start()
+        with gevent.Timeout(3):
+            while len(self.welcomed) < CLIENTS:
+                gevent.sleep(0.01)
+
+    def joined(self):
+        channel = self.server.channels.get(TEST_CHANNEL)
+        if channel is None:
+            return set()
+        return set(client.nick for client in channel.clients)
+
+    def wait_joined(self):
+        nicks = set(client.nick for client in self.pool)
+        with gevent.Timeout(3):
+            while not nicks <= self.joined():
+                gevent.sleep(0.01)
+
+    def send_all(self):
+        """ Send a message from every client, wait until they are sent.
+        """
+        sent = self.pool.stats()['sent_messages']
+        for client in self.pool:
+            client.msg(TEST_CHANNEL, 'hello from %s' % client.nick)
+        with gevent.Timeout(3):
+            while self.pool.stats()['sent_messages'] < sent + CLIENTS:
+                gevent.sleep(0.01)
+
+    def test_start(self):
+        self.start()
+        assert sorted(self.welcomed) == sorted(c.nick for c in self.pool)
+
+    def test_shared_handlers(self):
+        self.start()
+        self.wait_joined()
+        for client in self.pool:
+            assert client.channels == set([TEST_CHANNEL])
+
+    def test_one_greenlet_per_client(self):
+        self.start()
+        for client in self.pool:
+            assert len(client._group) == 1
+
+    def test_scheduler(self):
+        self.start()
+        self.wait_joined()
+        self.send_all()
+
+    def test_stats(self):
+        self.start()
+        self.wait_joined()
+        self.send_all()
+        stats = self.pool.stats()
+        assert stats['clients'] == stats['connected'] == CLIENTS
+        # NICK, USER, JOIN and the message
+        assert stats['sent_messages'] == CLIENTS * 4
+        assert stats['greenlets'] == CLIENTS + 1
+
+
+def test_routed_handlers():
+    pool = ClientPool()
+    calls = []
+    handler = handlers.inline(lambda client, msg: calls.append((client.nick, msg.params[0])))
+    handler.route = Route(targets='#chan')
+    pool.add_handler(handler)
+    clients = [pool.add_client('localhost', nick) for nick in ('a', 'b')]
+    for client in clients:
+        for target in ('#chan', '#other'):
+            client._process(LazyMessage(':n!u@h PRIVMSG %s :hi' % target))
+    assert calls == [('a', '#chan'), ('b', '#chan')]
+    pool.remove_handler(handler)
+    clients[0]._process(LazyMessage(':n!u@h PRIVMSG #chan :hi'))
+    assert len(calls) == 2
+
+def test_stalled_client():
+    pool = ClientPool()
+    stalled, other = [pool.add_client('localhost', nick) for nick in ('stalled', 'other')]
+    stalled._socket = StalledSocket()
+    other._socket, peer = socket.socketpair()
+    pool.scheduler.start()
+    try:
+        for i in range(3):
+            stalled.msg('#chan', 'stuck %d' % i)
+            other.msg('#chan', 'hello %d' % i)
+            with gevent.Timeout(1):
+                assert peer.recv(100) == 'PRIVMSG #chan :hello %d\r\n' % i
+        assert len(stalled._group) == 1
+        assert len(stalled._send_queue) == 2
+    finally:
+        pool.stop()
+    assert not pool.scheduler._writing
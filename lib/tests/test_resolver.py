@@ -0,0 +1,144 @@
+import time
+
+import gevent
+import pytest
+from gevent import socket
+
+from geventirc import resolver
+from geventirc.resolver import AddressCache, interleave, connect_first, create_connection
+
+V4 = socket.AF_INET
+V6 = socket.AF_INET6
+
+
+def info(family, address):
+    return (family, socket.SOCK_STREAM, 6, '', address)
+
+
+def listener():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(5)
+    return sock
+
+def closed_port():
+    sock = listener()
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def test_interleave():
+    infos = [info(V6, 'a'), info(V6, 'b'), info(V6, 'c'), info(V4, '1'), info(V4, '2')]
+    assert [i[4] for i in interleave(infos)] == ['a', '1', 'b', '2', 'c']
+
+
+def test_cache():
+    cache = AddressCache(ttl=60)
+    first = cache.resolve('localhost', 6667)
+    assert cache.resolve('localhost', 6667) is first
+    assert (cache.hits, cache.misses) == (1, 1)
+    cache.invalidate('localhost', 6667)
+    cache.resolve('localhost', 6667)
+    assert cache.misses == 2
+    expired = AddressCache(ttl=0)
+    expired.resolve('localhost', 6667)
+    expired.resolve('localhost', 6667)
+    assert expired.misses == 2
+
+
+def test_connect_first_failover():
+    server = listener()
+    port = server.getsockname()[1]
+    infos = [info(V4, ('127.0.0.1', closed_port())), info(V4, ('127.0.0.1', port))]
+    sock, connected = connect_first(infos, delay=5)
+    assert connected is infos[1]
+    assert sock.getpeername() == ('127.0.0.1', port)
+    sock.close()
+    with pytest.raises(socket.error):
+        connect_first(infos[:1])
+    server.close()
+
+
+def test_connect_first_does_not_wait_for_slow_attempts(monkeypatch):
+    server = listener()
+    port = server.getsockname()[1]
+    connect = resolver._connect
+    killed = []
+
+    def slow_connect(info, timeout):
+        if info[0] == V6:
+            try:
+                gevent.sleep(5)
+            except gevent.GreenletExit:
+                killed.append(info)
+                raise
+        return connect(info, timeout)
+
+    monkeypatch.setattr(resolver, '_connect', slow_connect)
+    infos = [info(V6, ('::1', port)), info(V4, ('127.0.0.1', port))]
+    start = time.time()
+    sock, _ = connect_first(infos, delay=0.05)
+    assert time.time() - start < 1
+    assert sock.family == V4
+    gevent.sleep(0)
+    assert killed == infos[:1]
+    sock.close()
+    server.close()
+
+
+def test_connect_first_unexpected_error(monkeypatch):
+    def broken_connect(info, timeout):
+        raise ValueError('broken')
+
+    monkeypatch.setattr(resolver, '_connect', broken_connect)
+    with gevent.Timeout(1):
+        with pytest.raises(ValueError):
+            connect_first([info(V4, ('127.0.0.1', closed_port()))])
+
+
+def test_connect_first_closes_late_sockets(monkeypatch):
+    server = listener()
+    port = server.getsockname()[1]
+    connect = resolver._connect
+    late = []
+
+    def late_connect(info, timeout):
+        if info[0] == V6:
+            try:
+                gevent.sleep(5)
+            except gevent.GreenletExit:
+                # connected anyway
+                pass
+            sock = connect((V4,) + info[1:4] + (('127.0.0.1', port),), timeout)
+            late.append(sock)
+            return sock
+        return connect(info, timeout)
+
+    monkeypatch.setattr(resolver, '_connect', late_connect)
+    infos = [info(V6, ('::1', port)), info(V4, ('127.0.0.1', port))]
+    sock, _ = connect_first(infos, delay=0.05)
+    assert sock.family == V4
+    gevent.sleep(0.05)
+    assert len(late) == 1
+    with pytest.raises(socket.error):
+        late[0].getpeername()
+    sock.close()
+    server.close()
+
+
+def test_create_connection_fallback_servers():
+    server = listener()
+    port = server.getsockname()[1]
+    cache = AddressCache()
+    servers = [('nonexistent.invalid', port), ('localhost', closed_port()),
+            ('localhost', port)]
+    sock, connected = create_connection(servers, cache=cache)
+    assert connected == ('localhost', port)
+    assert sock.getpeername()[1] == port
+    assert len(cache) == 2
+    sock.close()
+    with pytest.raises(socket.error):
+        create_connection(servers[:2], cache=cache)
+    assert len(cache) == 1
+    server.close()
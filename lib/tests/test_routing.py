@@ -0,0 +1,96 @@
+import pytest
+
+from geventirc import Client, handlers
+from geventirc.message import LazyMessage
+from geventirc.routing import Route
+
+
+def routed(**filters):
+    calls = []
+    handler = handlers.inline(lambda client, msg: calls.append(msg.raw))
+    handler.route = Route(**filters)
+    return handler, calls
+
+def privmsg(client, target, content, nick='someone'):
+    client._process(LazyMessage(':%s!u@h PRIVMSG %s :%s' % (nick, target, content)))
+
+
+def test_filters():
+    client = Client('localhost', 'Bot', recv_queue_size=0)
+    chan, chan_calls = routed(targets='#Chan')
+    direct, direct_calls = routed(direct=True)
+    mention, mention_calls = routed(channel=True, mention=True)
+    weather, weather_calls = routed(keywords=['weather', 'forecast'])
+    digits, digits_calls = routed(targets=['#chan', '#other'], pattern=r'\d{3}')
+    for handler in (chan, direct, mention, weather, digits):
+        client.add_handler(handler)
+    privmsg(client, '#chan', 'the Weather is bad')
+    privmsg(client, '#CHAN', 'hello Bot, call 555')
+    privmsg(client, 'bot', 'hello Bot')
+    privmsg(client, '#other', 'weathers 12')
+    assert len(chan_calls) == 2
+    assert direct_calls == [':someone!u@h PRIVMSG bot :hello Bot']
+    assert mention_calls == [':someone!u@h PRIVMSG #CHAN :hello Bot, call 555']
+    assert weather_calls == [':someone!u@h PRIVMSG #chan :the Weather is bad']
+    assert digits_calls == mention_calls
+
+def test_targets_folding_together():
+    client = Client('localhost', 'Bot', recv_queue_size=0)
+    handler, calls = routed(targets=['#chan', '#CHAN'])
+    client.add_handler(handler)
+    privmsg(client, '#Chan', 'hi')
+    assert len(calls) == 1
+
+def test_targets_casemapping():
+    client = Client('localhost', 'Bot', recv_queue_size=0, track_state=True)
+    handler, calls = routed(targets=['#Foo[x]', '#foo{x}'], keywords=['hi'])
+    client.add_handler(handler)
+    privmsg(client, '#foo[X]', 'hi')
+    assert len(calls) == 1
+    client._process(LazyMessage(':srv 005 Bot CASEMAPPING=ascii :are supported'))
+    privmsg(client, '#foo[X]', 'hi')
+    privmsg(client, '#FOO{X}', 'hi')
+    privmsg(client, '#foo|x', 'hi')
+    assert len(calls) == 3
+
+def test_remove():
+    client = Client('localhost', 'Bot', recv_queue_size=0)
+    handler, calls = routed(keywords=['hi'])
+    client.add_handler(handler)
+    client.remove_handler(handler)
+    privmsg(client, '#chan', 'hi')
+    assert not calls
+    with pytest.raises(ValueError):
+        client.remove_route(handler)
+
+def test_patterns_with_groups_and_flags():
+    client = Client('localhost', 'Bot', recv_queue_size=0)
+    repeated, repeated_calls = routed(pattern=r'(\w)\1')
+    shout, shout_calls = routed(pattern=r'(?i)^HEY')
+    client.add_handler(repeated)
+    client.add_handler(shout)
+    privmsg(client, '#chan', 'hey moo')
+    privmsg(client, '#chan', 'hi')
+    assert len(repeated_calls) == len(shout_calls) == 1
+
+def test_blocking_handlers_run_in_pool():
+    client = Client('localhost', 'Bot', recv_queue_size=0)
+    calls = []
+    handler = handlers.blocking(lambda client, msg: calls.append(msg))
+    client.add_route(handler, Route(direct=True))
+    privmsg(client, 'Bot', 'hello')
+    privmsg(client, '#chan', 'hello')
+    assert not calls
+    client._pool.join()
+    assert len(calls) == 1
+
+def test_stock_handlers_are_routed():
+    client = Client('localhost', 'Bot', recv_queue_size=0)
+    buffer = handlers.PrivMsgBuffer()
+    client.add_handler(buffer)
+    client.add_handler(handlers.ReplyWhenQuoted('busy'))
+    privmsg(client, '#chan', 'hi Bot')
+    privmsg(client, 'Bot', 'psst', nick='friend')
+    assert [record.nick for record in buffer] == ['friend']
+    queued = [item[0] for item in client._send_queue.drain()]
+    assert queued == ['PRIVMSG #chan :busy\r\n']
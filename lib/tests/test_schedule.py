@@ -0,0 +1,216 @@
+import gevent
+import gevent.pool
+import pytest
+
+from geventirc import Client, ClientPool, handlers, irc, schedule
+
+
+class Clock(object):
+
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def run_due(scheduler):
+    """ Run the jobs due now, as the scheduler greenlet would.
+    """
+    heap = scheduler._heap
+    now = schedule.time.time()
+    while heap and heap[0][0] <= now:
+        scheduler._run_job(heap[0][2], now)
+
+
+def test_call_later():
+    scheduler = schedule.Scheduler()
+    calls = []
+    scheduler.call_later(0.02, calls.append, 2)
+    scheduler.call_later(0.01, calls.append, 1)
+    scheduler.call_later(0.5, calls.append, 3)
+    gevent.sleep(0.05)
+    assert calls == [1, 2]
+    assert len(scheduler) == 1
+    scheduler.stop()
+
+def test_earlier_job_wakes_scheduler():
+    scheduler = schedule.Scheduler()
+    calls = []
+    scheduler.call_later(10, calls.append, 'late')
+    gevent.sleep(0)
+    scheduler.call_later(0.01, calls.append, 'early')
+    gevent.sleep(0.03)
+    assert calls == ['early']
+    scheduler.stop()
+
+def test_cancel():
+    scheduler = schedule.Scheduler()
+    calls = []
+    job = scheduler.call_later(0.01, calls.append, 1)
+    every = scheduler.call_every(0.01, calls.append, 2)
+    job.cancel()
+    job.cancel()
+    assert len(scheduler) == 1
+    with gevent.Timeout(1):
+        while len(calls) < 2:
+            gevent.sleep(0.01)
+    every.cancel()
+    count = len(calls)
+    assert set(calls) == set([2])
+    gevent.sleep(0.03)
+    assert len(calls) == count
+    assert len(scheduler) == 0
+    scheduler.stop()
+
+def test_cancelled_jobs_are_dropped():
+    scheduler = schedule.Scheduler(paused=True)
+    jobs = [scheduler.call_later(i, lambda: None) for i in range(200)]
+    for job in jobs[:150]:
+        job.cancel()
+    assert len(scheduler._heap) < 200
+    assert len(scheduler) == 50
+
+def test_interval_must_be_positive():
+    scheduler = schedule.Scheduler(paused=True)
+    for interval in (0, -1):
+        with pytest.raises(ValueError):
+            scheduler.call_every(interval, lambda: None)
+    assert len(scheduler) == 0
+
+def test_missed_ticks(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(schedule.time, 'time', clock)
+    scheduler = schedule.Scheduler(paused=True)
+    calls = []
+    for missed in (schedule.CATCH_UP, schedule.COALESCE, schedule.SKIP):
+        scheduler.call_every(10, calls.append, missed, missed=missed)
+    clock.now = 45
+    run_due(scheduler)
+    assert calls.count(schedule.CATCH_UP) == 4
+    assert calls.count(schedule.COALESCE) == 1
+    assert calls.count(schedule.SKIP) == 0
+    assert sorted(job.base for _, _, job in scheduler._heap) == [50, 50, 50]
+    del calls[:]
+    clock.now = 50
+    run_due(scheduler)
+    assert sorted(calls) == sorted([schedule.CATCH_UP, schedule.COALESCE, schedule.SKIP])
+
+def test_jitter(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(schedule.time, 'time', clock)
+    scheduler = schedule.Scheduler(paused=True)
+    job = scheduler.call_every(10, lambda: None, jitter=2)
+    for tick in range(1, 50):
+        assert job.base == 10 * tick
+        assert job.base <= job.due <= job.base + 2
+        clock.now = job.due
+        run_due(scheduler)
+
+def test_failing_job_is_rescheduled(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(schedule.time, 'time', clock)
+    scheduler = schedule.Scheduler(paused=True)
+    calls = []
+
+    def fail():
+        calls.append(clock.now)
+        raise RuntimeError('oops')
+
+    job = scheduler.call_every(10, fail)
+    for now in (10, 20):
+        clock.now = now
+        run_due(scheduler)
+    assert calls == [10, 20]
+    assert job.active and len(scheduler) == 1
+
+def test_blocking_job():
+    pool = gevent.pool.Pool(2)
+    scheduler = schedule.Scheduler(pool)
+    calls = []
+
+    def slow():
+        gevent.sleep(0.05)
+        calls.append('slow')
+
+    scheduler.call_later(0, slow, blocking=True)
+    scheduler.call_later(0.01, calls.append, 'fast')
+    gevent.sleep(0.02)
+    assert calls == ['fast']
+    assert len(pool) == 1
+    pool.join()
+    assert calls == ['fast', 'slow']
+    scheduler.stop()
+
+def test_pause_and_resume():
+    scheduler = schedule.Scheduler(paused=True)
+    calls = []
+    scheduler.call_later(0, calls.append, 1)
+    gevent.sleep(0.01)
+    assert not calls
+    scheduler.resume()
+    gevent.sleep(0.01)
+    assert calls == [1]
+    scheduler.pause()
+    scheduler.call_later(0, calls.append, 2)
+    gevent.sleep(0.01)
+    assert calls == [1]
+    assert scheduler._runner is None
+    scheduler.resume()
+    gevent.sleep(0.01)
+    assert calls == [1, 2]
+    scheduler.stop()
+
+def test_client_timers_follow_connection():
+    client = Client('localhost', 'bot')
+    assert client.timers.paused
+    client._set_state(irc.REGISTERING)
+    assert client.timers.paused
+    client._set_state(irc.CONNECTED)
+    assert not client.timers.paused
+    client._set_state(irc.BACKOFF)
+    assert client.timers.paused
+
+def test_periodic_message():
+    client = Client('localhost', 'bot')
+    handler = handlers.PeriodicMessage('#chan', 'news', wait=10)
+    client.add_handler(handler)
+    assert handler in client._dispatcher.get('001')[0]
+    handler(client, None)
+    job = handler.jobs[client]
+    handler(client, None)
+    assert handler.jobs == {client: job}
+    assert len(client.timers) == 1
+    assert job.missed == schedule.SKIP
+    job.func(*job.args)
+    assert [item[0] for item in client._send_queue.drain()] == ['PRIVMSG #chan :news\r\n']
+    handler.cancel()
+    assert not handler.jobs
+    assert len(client.timers) == 0
+
+def test_periodic_message_in_pool():
+    pool = ClientPool()
+    handler = handlers.PeriodicMessage('#chan', 'news', wait=10)
+    pool.add_handler(handler)
+    clients = [pool.add_client('localhost', nick) for nick in ('a', 'b')]
+    for client in clients:
+        handler(client, None)
+    assert [len(client.timers) for client in clients] == [1, 1]
+    handler.cancel(clients[0])
+    assert [len(client.timers) for client in clients] == [0, 1]
+    handler.cancel()
+    assert not handler.jobs
+    assert len(clients[1].timers) == 0
+
+def test_periodic_message_dropped_on_stop():
+    client = Client('localhost', 'bot')
+    handler = handlers.PeriodicMessage('#chan', 'news', wait=10)
+    client.add_handler(handler)
+    handler(client, None)
+    client._set_state(irc.CONNECTED)
+    client._set_state(irc.BACKOFF)
+    assert client in handler.jobs
+    client.stop()
+    assert not handler.jobs
+    assert len(client.timers) == 0
+    assert not client._state_handlers
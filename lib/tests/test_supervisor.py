@@ -0,0 +1,136 @@
+import gevent, gevent.monkey
+gevent.monkey.patch_all()
+
+import os
+import signal
+import socket
+import subprocess
+import sys
+
+from geventirc import handlers, replycode
+from geventirc.supervisor import Supervisor
+
+# ports of the two networks, sharded to different workers
+TEST_PORTS = (6680, 6684)
+CLIENTS = 3
+
+SERVER = """
+import hircd
+hircd.IRCServer(('localhost', %d), hircd.IRCClient).serve_forever()
+"""
+
+
+def start_server(port):
+    """ Run hircd in its own process, the workers are forked from this one
+    and would get a copy of an in-process server.
+    """
+    tests = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([tests, os.path.dirname(tests)]))
+    process = subprocess.Popen([sys.executable, '-c', SERVER % port], cwd=tests, env=env)
+    with gevent.Timeout(5):
+        while 1:
+            try:
+                socket.create_connection(('localhost', port)).close()
+                return process
+            except socket.error:
+                gevent.sleep(0.05)
+
+SUPERVISOR = """
+import sys
+from geventirc.supervisor import Supervisor
+supervisor = Supervisor(workers=1)
+supervisor.start()
+sys.stdout.write('%d\\n' % supervisor.workers[0].pid)
+sys.stdout.flush()
+supervisor.join()
+"""
+
+
+def setup_worker(worker):
+    pool = worker.pool
+    pool.add_handler(handlers.ping_handler, 'PING')
+    pool.add_handler(handlers.nick_in_use_handler, replycode.ERR_NICKNAMEINUSE)
+    pool.add_handler(
+            handlers.inline(lambda client, msg: worker.publish('welcome', client.nick)),
+            '001')
+    worker.subscribe('welcome',
+            lambda worker, nick, origin: worker.publish('seen', [nick, worker.index]))
+
+
+class TestSupervisor(object):
+
+    @classmethod
+    def setup_class(cls):
+        cls.servers = [start_server(port) for port in TEST_PORTS]
+        cls.supervisor = Supervisor(workers=2, setup=setup_worker,
+                restart_delay=0.1, stagger=0.005)
+        cls.welcomed = []
+        cls.seen = []
+        cls.supervisor.subscribe('welcome',
+                lambda nick, origin: cls.welcomed.append((origin, nick)))
+        cls.supervisor.subscribe('seen',
+                lambda data, origin: cls.seen.append(tuple(data)))
+        for port in TEST_PORTS:
+            for i in range(CLIENTS):
+                cls.supervisor.add_client('localhost', 'sharded%d_%d' % (port, i), port=port)
+        cls.supervisor.start()
+
+    @classmethod
+    def teardown_class(cls):
+        cls.supervisor.stop()
+        for server in cls.servers:
+            server.kill()
+            server.wait()
+
+    def wait_for(self, condition, timeout=5):
+        with gevent.Timeout(timeout):
+            while not condition():
+                gevent.sleep(0.01)
+
+    def test_sharding(self):
+        self.wait_for(lambda: len(self.welcomed) == 2 * CLIENTS)
+        for origin, nick in self.welcomed:
+            port = int(nick[len('sharded'):].split('_')[0])
+            assert origin == self.supervisor.shard('localhost:%d' % port)
+        assert set(origin for origin, nick in self.welcomed) == set([0, 1])
+
+    def test_events_forwarded_to_other_workers(self):
+        self.wait_for(lambda: len(self.seen) == 2 * CLIENTS)
+        origins = dict((nick, origin) for origin, nick in self.welcomed)
+        for nick, index in self.seen:
+            assert index != origins[nick]
+
+    def test_restart(self):
+        self.wait_for(lambda: len(self.welcomed) == 2 * CLIENTS)
+        worker = self.supervisor.workers[0]
+        del self.welcomed[:]
+        os.kill(worker.pid, signal.SIGKILL)
+        self.wait_for(lambda: self.supervisor.workers.get(0, worker) is not worker)
+        self.wait_for(lambda: len(self.welcomed) == CLIENTS)
+        assert set(origin for origin, nick in self.welcomed) == set([0])
+
+
+def test_worker_exits_with_supervisor():
+    lib = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=lib)
+    process = subprocess.Popen([sys.executable, '-c', SUPERVISOR],
+            stdout=subprocess.PIPE, env=env)
+    pid = int(process.stdout.readline())
+    process.kill()
+    process.wait()
+
+    def running():
+        try:
+            with open('/proc/%d/stat' % pid) as stat:
+                # a zombie waiting for init to reap it is gone too
+                return stat.read().split(')')[-1].split()[0] != 'Z'
+        except IOError:
+            return False
+
+    try:
+        with gevent.Timeout(5):
+            while running():
+                gevent.sleep(0.05)
+    finally:
+        if running():
+            os.kill(pid, signal.SIGKILL)
@@ -0,0 +1,102 @@
+from geventirc import Client
+from geventirc.message import LazyMessage
+
+
+def feed(client, *lines):
+    for line in lines:
+        client._process(LazyMessage(line))
+
+def joined(nick='Bot', **kwargs):
+    client = Client('localhost', nick, recv_queue_size=0, track_state=True, **kwargs)
+    feed(client,
+        ':Bot!b@h JOIN #Chan',
+        ':srv 353 Bot = #chan :Bot @Alice +bob!b@bob.host',
+        ':srv 366 Bot #chan :End of /NAMES list.')
+    return client, client.tracker
+
+
+def test_names():
+    client, tracker = joined()
+    channel = tracker.channel('#CHAN')
+    assert channel.name == '#Chan' and channel.synced
+    assert sorted(tracker.nicks('#chan')) == ['Alice', 'Bot', 'bob']
+    assert tracker.modes('alice', '#chan') == 'o'
+    assert tracker.modes('BOB', '#chan') == 'v'
+    assert tracker.user('bob').host == 'bob.host'
+    assert tracker.channels_of('ALICE') == ['#Chan']
+
+def test_events_while_receiving_names():
+    client = Client('localhost', 'bot', recv_queue_size=0, track_state=True)
+    tracker = client.tracker
+    feed(client,
+        ':bot!b@h JOIN #c',
+        ':srv 353 bot = #c :bot alice dave @erin',
+        ':alice!a@h QUIT :gone',
+        ':bob!b@h JOIN #c',
+        ':dave!d@h NICK david',
+        ':erin!e@h MODE #c -o+v erin erin',
+        ':srv 366 bot #c :End of /NAMES list.')
+    assert sorted(tracker.nicks('#c')) == ['bob', 'bot', 'david', 'erin']
+    assert tracker.user('alice') is None and tracker.user('dave') is None
+    assert tracker.modes('erin', '#c') == 'v'
+    feed(client, ':bob!b@h PART #c')
+    assert tracker.user('bob') is None
+
+def test_join_part_kick_quit():
+    client, tracker = joined()
+    feed(client,
+        ':Bot!b@h JOIN #other',
+        ':carol!c@h JOIN #chan',
+        ':carol!c@h JOIN #other',
+        ':Alice!a@h PART #chan :bye',
+        ':Alice!a@h KICK #chan bob :out')
+    assert sorted(tracker.nicks('#chan')) == ['Bot', 'carol']
+    assert tracker.user('alice') is None and tracker.user('bob') is None
+    assert sorted(tracker.channels_of('carol')) == ['#Chan', '#other']
+    feed(client, ':carol!c@h QUIT :gone')
+    assert tracker.nicks('#chan') == ['Bot']
+    assert tracker.nicks('#other') == ['Bot']
+    feed(client, ':Bot!b@h PART #chan')
+    assert tracker.channel('#chan') is None
+    assert tracker.channels_of('Bot') == ['#other']
+
+def test_batched_netsplit():
+    for aggregate in ((), ('netsplit',)):
+        client, tracker = joined(aggregate_batches=aggregate, inline_handlers=True)
+        batches = []
+        client.add_handler(lambda client, msg: batches.append(msg), 'BATCH')
+        feed(client,
+            ':srv BATCH +ns netsplit a.srv b.srv',
+            '@batch=ns :Alice!a@h QUIT :a.srv b.srv',
+            '@batch=ns :bob!b@bob.host QUIT :a.srv b.srv',
+            ':srv BATCH -ns')
+        assert len(batches) == 1
+        assert tracker.nicks('#chan') == ['Bot']
+        assert tracker.user('alice') is None
+
+def test_nick_and_modes():
+    client, tracker = joined()
+    feed(client,
+        ':Alice!a@h NICK Alicia',
+        ':Alicia!a@h MODE #chan +v-o+kl bob Alicia secret 10',
+        ':Alicia!a@h MODE #chan +ov bob Alicia')
+    assert tracker.user('alice') is None
+    assert tracker.user('ALICIA').nick == 'Alicia'
+    assert tracker.modes('alicia', '#chan') == 'v'
+    assert tracker.modes('bob', '#chan') == 'ov'
+    assert tracker.channel('#chan').modes == {'k': 'secret', 'l': '10'}
+
+def test_casemapping():
+    client, tracker = joined()
+    feed(client, ':X!x@h JOIN #chan')
+    assert tracker.is_member('x', '#chan')
+    feed(client, ':[Y]!y@h JOIN #chan')
+    assert tracker.is_member('{y}', '#chan')
+    feed(client, ':srv 005 Bot CASEMAPPING=ascii PREFIX=(qov)~@+ :are supported by this server')
+    assert not tracker.is_member('{y}', '#chan')
+    assert tracker.is_member('[y]', '#chan')
+    assert tracker.modes('alice', '#CHAN') == 'o'
+    feed(client, ':srv 353 Bot = #chan :~@Zed', ':srv 366 Bot #chan :End')
+    assert tracker.nicks('#chan') == ['Zed']
+    assert tracker.modes('zed', '#chan') == 'qo'
+    assert tracker.user('x') is None